@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from scrapy.http import HtmlResponse, Request  # type: ignore[import-untyped]
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from scrapy.statscollectors import MemoryStatsCollector  # type: ignore[import-untyped]
+from twisted.internet.defer import DeferredList, inlineCallbacks, maybeDeferred
+from types import SimpleNamespace
+from typing import Any, Callable, Generator
+
+from scrdbcaching import (
+    DatabaseCachingMiddleware,
+    SerializableItem,
+    SerializingDatabasePipeline,
+    UrlSetSpider,
+)
+from scrdbcaching.backends import load_backend
+
+
+# Measures what the cache costs per request, against the sqlite backend in a
+# temporary directory standing in for the database server:
+#
+# - writes: SerializingDatabasePipeline.process_item() is fed items with
+#   synthetic bodies of each of the --sizes, once per --insert-batch-rows
+#   value, and the items per second and MB per second stored are reported.
+# - lookups: DatabaseCachingMiddleware.process_request() is driven with
+#   requests for stored URLs (hits) and unstored ones (misses) by as many
+#   concurrent workers as each of the --concurrency values, with the
+#   middleware's lookup thread pool sized to match, and the p50 and p99
+#   latencies and requests per second are reported.
+#
+# Peak memory is measured with tracemalloc on a separate pass of each
+# measurement, so the tracing overhead doesn't skew the timings. The dbcache/
+# stats the components published during the timed pass are included too.
+#
+# The storage formats can be picked with --codec and --headers-format, so runs
+# can be compared before a format change. With --json the results are printed
+# as JSON; with --output they're also written to that file.
+
+
+ENCODING: str = "utf-8"
+
+WORDS: tuple[str, ...] = (
+    "the", "of", "and", "court", "report", "public", "records", "county",
+    "district", "filed", "case", "notice", "hearing", "order", "motion",
+    "session", "committee", "budget", "meeting", "agenda", "minutes", "vote",
+)
+
+HEADERS: dict[bytes, list[bytes]] = {
+    b"Date": [b"Wed, 14 Oct 2026 18:02:11 GMT"],
+    b"Content-Type": [b"text/html; charset=utf-8"],
+    b"Cache-Control": [b"private, max-age=0, must-revalidate"],
+    b"Server": [b"nginx"],
+    b"Etag": [b'W/"5f3a-18b2c0f1e6d"'],
+    b"Set-Cookie": [b"session=" + b"a1b2c3d4" * 40 + b"; Path=/; Secure; HttpOnly"],
+}
+
+
+# Builds an HTML body of about `size` bytes out of tagged runs of words, which
+# compresses about as well as real pages do.
+def synthetic_body(size: int, rng: random.Random) -> bytes:
+    parts: list[str] = ["<html><head><title>page</title></head><body>"]
+    length: int = len(parts[0])
+    while length < size:
+        paragraph: str = (
+            "<p class=\"entry\">" + " ".join(rng.choices(WORDS, k=40)) + "</p>\n"
+        )
+        parts.append(paragraph)
+        length += len(paragraph)
+    parts.append("</body></html>")
+    return "".join(parts).encode(ENCODING)
+
+
+# One item per size per repeat. The bodies of each size share most of their
+# content, but each gets a unique tail so no two rows are identical.
+def synthetic_items(sizes: list[int], per_size: int, seed: int) -> list[SerializableItem]:
+    rng: random.Random = random.Random(seed)
+    items: list[SerializableItem] = list()
+    for size in sizes:
+        body: bytes = synthetic_body(size, rng)
+        for i in range(per_size):
+            url: str = f"https://bench.example.com/{size}/{i}"
+            response: HtmlResponse = HtmlResponse(
+                url=url,
+                status=200,
+                headers=HEADERS,
+                body=body + f"<!-- {url} -->".encode(ENCODING),
+                encoding=ENCODING,
+            )
+            items.append(SerializableItem.from_htmlresponse(response))
+    return items
+
+
+def make_settings(args: argparse.Namespace, path: str, **overrides: Any) -> Settings:
+    settings: Settings = Settings()
+    settings.setdict(
+        {
+            "DBCACHE_BACKEND": "sqlite",
+            "DBCACHE_SQLITE_PATH": path,
+            "DBCACHE_BODY_CODEC": args.codec,
+            "DBCACHE_HEADERS_FORMAT": args.headers_format,
+            **overrides,
+        }
+    )
+    return settings
+
+
+# Instances a spider on a crawler that's just enough of one for the middleware
+# and pipeline.
+def make_spider(settings: Settings) -> UrlSetSpider:
+    spider: UrlSetSpider = UrlSetSpider(name="bench")
+    crawler: SimpleNamespace = SimpleNamespace(
+        settings=settings,
+        signals=SimpleNamespace(connect=lambda *args, **kwargs: None),
+        spider=spider,
+        engine=None,
+    )
+    crawler.stats = MemoryStatsCollector(crawler)
+    spider.settings = settings
+    spider.crawler = crawler
+    return spider
+
+
+def dbcache_stats(spider: UrlSetSpider) -> dict[str, Any]:
+    return {
+        key: value
+        for key, value in spider.crawler.stats.get_stats().items()
+        if key.startswith("dbcache/")
+    }
+
+
+def latency_summary(latencies: list[float], elapsed: float) -> dict[str, float]:
+    quantiles: list[float] = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "p50_ms": quantiles[49] * 1e3,
+        "p99_ms": quantiles[98] * 1e3,
+        "mean_ms": statistics.fmean(latencies) * 1e3,
+        "requests_per_s": len(latencies) / elapsed,
+    }
+
+
+# Runs func() with tracemalloc on, and returns the peak bytes allocated while
+# it ran.
+def peak_memory(func: Callable[[], Any]) -> Generator[Any, Any, int]:
+    tracemalloc.start()
+    try:
+        yield maybeDeferred(func)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def write_items(
+    args: argparse.Namespace, path: str, items: list[SerializableItem], batch_rows: int
+) -> tuple[float, dict[str, Any]]:
+    if os.path.exists(path):
+        os.remove(path)
+    settings: Settings = make_settings(args, path, DBCACHE_INSERT_BATCH_ROWS=batch_rows)
+    spider: UrlSetSpider = make_spider(settings)
+    pipeline: SerializingDatabasePipeline = SerializingDatabasePipeline()
+    pipeline.open_spider(spider)
+    start_time: float = time.perf_counter()
+    for item in items:
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+    return time.perf_counter() - start_time, dbcache_stats(spider)
+
+
+@inlineCallbacks
+def bench_writes(
+    args: argparse.Namespace, path: str, items: list[SerializableItem], batch_rows: int
+) -> Generator[Any, Any, dict[str, Any]]:
+    elapsed, stats = write_items(args, path, items, batch_rows)
+    peak_bytes: int = yield from peak_memory(
+        lambda: write_items(args, path, items, batch_rows)
+    )
+    body_bytes: int = sum(len(item["body"]) for item in items)
+    return {
+        "insert_batch_rows": batch_rows,
+        "items": len(items),
+        "seconds": elapsed,
+        "items_per_s": len(items) / elapsed,
+        "mb_per_s": body_bytes / elapsed / 1e6,
+        "peak_bytes": peak_bytes,
+        "stats": stats,
+    }
+
+
+# Instances the middleware the way from_crawler() would.
+def make_middleware(
+    args: argparse.Namespace, spider: UrlSetSpider, concurrency: int
+) -> DatabaseCachingMiddleware:
+    return DatabaseCachingMiddleware(
+        backend=load_backend(spider.settings, "bench"),
+        concurrent_requests=concurrency,
+        credits_used=0,
+        credits_threshold=sys.maxsize,
+        crawler=spider.crawler,
+        async_lookups=True,
+        lookup_threads=concurrency,
+        batch_size=args.batch_size,
+    )
+
+
+# Sends the URLs through process_request() from `concurrency` workers, each
+# waiting on its own lookups one after another, and returns the latency of
+# each lookup and the total elapsed time.
+@inlineCallbacks
+def drive_lookups(
+    middleware: DatabaseCachingMiddleware,
+    spider: UrlSetSpider,
+    urls: list[str],
+    concurrency: int,
+) -> Generator[Any, Any, tuple[list[float], float]]:
+    latencies: list[float] = list()
+
+    @inlineCallbacks
+    def worker(worker_urls: list[str]) -> Generator[Any, Any, None]:
+        for url in worker_urls:
+            lookup_start: float = time.perf_counter()
+            yield maybeDeferred(middleware.process_request, Request(url), spider)
+            latencies.append(time.perf_counter() - lookup_start)
+
+    start_time: float = time.perf_counter()
+    yield DeferredList(
+        [worker(urls[i::concurrency]) for i in range(concurrency)],
+        fireOnOneErrback=True,
+        consumeErrors=True,
+    )
+    return latencies, time.perf_counter() - start_time
+
+
+@inlineCallbacks
+def bench_lookups(
+    args: argparse.Namespace, path: str, stored_urls: list[str], concurrency: int
+) -> Generator[Any, Any, dict[str, Any]]:
+    rng: random.Random = random.Random(args.seed)
+    hit_urls: list[str] = rng.choices(stored_urls, k=args.lookups)
+    miss_urls: list[str] = [
+        f"https://bench.example.com/missing/{i}" for i in range(args.lookups)
+    ]
+    spider: UrlSetSpider = make_spider(make_settings(args, path))
+    middleware: DatabaseCachingMiddleware = make_middleware(args, spider, concurrency)
+    result: dict[str, Any] = {"concurrency": concurrency}
+    try:
+        for kind, urls in (("hit", hit_urls), ("miss", miss_urls)):
+            latencies, elapsed = yield drive_lookups(middleware, spider, urls, concurrency)
+            result[kind] = latency_summary(latencies, elapsed)
+        result["stats"] = dbcache_stats(spider)
+        result["peak_bytes"] = yield from peak_memory(
+            lambda: drive_lookups(middleware, spider, hit_urls + miss_urls, concurrency)
+        )
+    finally:
+        middleware.on_spider_closed(spider, "finished")
+    return result
+
+
+@inlineCallbacks
+def run(args: argparse.Namespace, directory: str) -> Generator[Any, Any, dict[str, Any]]:
+    path: str = os.path.join(directory, "pages2.sqlite3")
+    items: list[SerializableItem] = synthetic_items(args.sizes, args.items_per_size, args.seed)
+    results: dict[str, Any] = {
+        "config": {
+            "sizes": args.sizes,
+            "items_per_size": args.items_per_size,
+            "lookups": args.lookups,
+            "codec": args.codec,
+            "headers_format": args.headers_format,
+            "batch_size": args.batch_size,
+        },
+        "writes": [],
+        "lookups": [],
+    }
+    for batch_rows in args.insert_batch_rows:
+        results["writes"].append((yield bench_writes(args, path, items, batch_rows)))
+    # The database from the last write run is what the lookups are served from.
+    stored_urls: list[str] = [item["url"] for item in items]
+    del items
+    for concurrency in args.concurrency:
+        results["lookups"].append(
+            (yield bench_lookups(args, path, stored_urls, concurrency))
+        )
+    return results
+
+
+def int_list(value: str) -> list[int]:
+    return [int(part) for part in value.split(",")]
+
+
+def print_results(results: dict[str, Any]) -> None:
+    for write in results["writes"]:
+        print(
+            f"write  batch {write['insert_batch_rows']:>4}: "
+            f"{write['items_per_s']:8.1f} items/s, {write['mb_per_s']:7.2f} MB/s, "
+            f"peak {write['peak_bytes'] / 1e6:7.2f} MB"
+        )
+    for lookup in results["lookups"]:
+        for kind in ("hit", "miss"):
+            summary: dict[str, float] = lookup[kind]
+            print(
+                f"lookup x{lookup['concurrency']:<3} {kind:>4}: "
+                f"p50 {summary['p50_ms']:7.3f} ms, p99 {summary['p99_ms']:7.3f} ms, "
+                f"{summary['requests_per_s']:8.1f} req/s"
+            )
+        print(f"lookup x{lookup['concurrency']:<3} peak {lookup['peak_bytes'] / 1e6:7.2f} MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark cache lookups and pipeline writes against sqlite."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int_list,
+        default=[10_240, 102_400, 524_288, 2_097_152],
+        help="comma-separated body sizes in bytes",
+    )
+    parser.add_argument(
+        "--items-per-size", type=int, default=25, help="items stored per body size"
+    )
+    parser.add_argument(
+        "--lookups", type=int, default=500, help="hit and miss lookups per level"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int_list,
+        default=[1, 4, 16],
+        help="comma-separated lookup concurrency levels",
+    )
+    parser.add_argument(
+        "--insert-batch-rows",
+        type=int_list,
+        default=[0, 50],
+        help="comma-separated DBCACHE_INSERT_BATCH_ROWS values to write with",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=0, help="DBCACHE_BATCH_SIZE for lookups"
+    )
+    parser.add_argument("--codec", default="text", help="DBCACHE_BODY_CODEC")
+    parser.add_argument(
+        "--headers-format", default="json", help="DBCACHE_HEADERS_FORMAT"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--json", action="store_true", help="print the results as JSON"
+    )
+    parser.add_argument(
+        "--output", default=None, help="also write the JSON results to this file"
+    )
+    args: argparse.Namespace = parser.parse_args()
+
+    # The reactor can only be run once per process, so everything is run
+    # inside the one run of it.
+    from twisted.internet import task
+
+    def run_in_reactor(reactor: Any) -> Any:
+        directory: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()  # type: ignore[type-arg]
+        deferred = run(args, directory.name)
+        deferred.addBoth(lambda result: (directory.cleanup(), result)[1])
+        deferred.addCallback(report)
+        return deferred
+
+    def report(results: dict[str, Any]) -> None:
+        if args.output is not None:
+            with open(args.output, "w") as fh:
+                json.dump(results, fh, indent=2)
+        if args.json:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        else:
+            print_results(results)
+
+    task.react(run_in_reactor)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import sys
+import timeit
+
+from scrdbcaching.headers import headers_from_row, pack_headers
+
+
+# Compares the cost of the two formats response headers can be stored in: the
+# original JSON format, which has to decode every name and value to str on the
+# way in and encode it back to bytes on the way out, and the binary format,
+# which packs and unpacks the bytes as they are. Both the write path (what
+# SerializableItem.to_dict() does) and the read path (what
+# DatabaseCachingMiddleware does on every cache hit) are timed, along with the
+# stored size.
+
+
+ENCODING: str = "utf-8"
+
+
+# A representative set of response headers, including the long Set-Cookie and
+# Content-Security-Policy values that overflow the headers column's
+# VARCHAR(1024) in the JSON format.
+def sample_headers() -> dict[bytes, list[bytes]]:
+    return {
+        b"Date": [b"Wed, 14 Oct 2026 18:02:11 GMT"],
+        b"Content-Type": [b"text/html; charset=utf-8"],
+        b"Cache-Control": [b"private, max-age=0, must-revalidate"],
+        b"Server": [b"nginx"],
+        b"Vary": [b"Accept-Encoding"],
+        b"Etag": [b'W/"5f3a-18b2c0f1e6d"'],
+        b"Last-Modified": [b"Tue, 13 Oct 2026 09:41:57 GMT"],
+        b"X-Frame-Options": [b"SAMEORIGIN"],
+        b"X-Content-Type-Options": [b"nosniff"],
+        b"Strict-Transport-Security": [b"max-age=31536000; includeSubDomains"],
+        b"Set-Cookie": [
+            b"session=" + b"a1b2c3d4" * 40 + b"; Path=/; Secure; HttpOnly",
+            b"tracking=" + b"0123456789abcdef" * 12 + b"; Path=/; Max-Age=31536000",
+            b"prefs=lang%3Den%26tz%3DUTC; Path=/",
+        ],
+        b"Content-Security-Policy": [
+            b"default-src 'self'; "
+            + b" ".join(b"https://cdn%d.example.com" % i for i in range(40))
+        ],
+    }
+
+
+def json_write(headers: dict[bytes, list[bytes]]) -> str:
+    return json.dumps(
+        {
+            key.decode(ENCODING): [v.decode(ENCODING) for v in value]
+            for key, value in headers.items()
+        }
+    )
+
+
+def json_read(stored: str) -> dict[bytes, list[bytes]]:
+    return headers_from_row({"headers": stored, "encoding": ENCODING})
+
+
+def binary_write(headers: dict[bytes, list[bytes]]) -> bytes:
+    return pack_headers(headers)
+
+
+def binary_read(stored: bytes) -> dict[bytes, list[bytes]]:
+    return headers_from_row({"headers_blob": stored, "encoding": ENCODING})
+
+
+# Returns the mean time per call in microseconds, taking the best of several
+# repeats.
+def time_call(func, arg, number: int, repeat: int) -> float:  # type: ignore[no-untyped-def]
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=repeat)) / number * 1e6
+
+
+def run(number: int, repeat: int) -> dict[str, dict[str, float]]:
+    headers: dict[bytes, list[bytes]] = sample_headers()
+    json_stored: str = json_write(headers)
+    binary_stored: bytes = binary_write(headers)
+    assert json_read(json_stored) == binary_read(binary_stored) == headers
+    return {
+        "json": {
+            "write_us": time_call(json_write, headers, number, repeat),
+            "read_us": time_call(json_read, json_stored, number, repeat),
+            "stored_bytes": len(json_stored.encode(ENCODING)),
+        },
+        "binary": {
+            "write_us": time_call(binary_write, headers, number, repeat),
+            "read_us": time_call(binary_read, binary_stored, number, repeat),
+            "stored_bytes": len(binary_stored),
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the JSON and binary stored header formats."
+    )
+    parser.add_argument("--number", type=int, default=20_000, help="calls per repeat")
+    parser.add_argument("--repeat", type=int, default=5, help="repeats per timing")
+    parser.add_argument(
+        "--json", action="store_true", help="print the results as JSON"
+    )
+    args: argparse.Namespace = parser.parse_args()
+    results: dict[str, dict[str, float]] = run(args.number, args.repeat)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    for name, result in results.items():
+        print(
+            f"{name:>6}: write {result['write_us']:7.2f} us, "
+            f"read {result['read_us']:7.2f} us, "
+            f"{int(result['stored_bytes'])} bytes stored"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+import argparse
+import sys
+import time
+
+from datetime import datetime, timedelta, timezone
+from logging import Logger
+from scrdbcaching import set_up_logging
+from scrdbcaching.backends import CacheBackend, load_backend, settings_from_env
+from scrdbcaching.capture import parse_status_policy
+from typing import Any, Callable
+
+
+# Keeps the page cache from growing without bound. It runs up to three passes,
+# each made of short transactions of --batch-size rows with --sleep seconds
+# between them, so it can run against a table crawlers are using without
+# holding long locks:
+#
+# 1. Rows of pages2 past their retention period are deleted, or moved into
+#    pages2_history with --archive. Rows are kept for --max-age seconds
+#    (DBCACHE_RETENTION_MAX_AGE), or for the seconds given for their status by
+#    --status-max-age or the DBCACHE_RETENTION_POLICY setting, a dict mapping
+#    statuses to seconds (or to None, for --max-age). 0 means forever, which
+#    is the default. Retention is counted from a row's date, like DBCACHE_TTL.
+#    The table is walked once in _id order, so no index on date is needed.
+#
+# 2. pages2_history is trimmed to the newest --keep-versions versions of each
+#    URL (DBCACHE_KEEP_VERSIONS, if it's not given; 0 keeps them all), and
+#    versions older than --history-max-age seconds are deleted. If the table
+#    is partitioned by month, as pages2.sql creates it, whole months past
+#    --history-max-age are dropped first, and partitions are added for the
+#    next --partitions-ahead months. The pass is skipped if there's neither a
+#    version limit nor a maximum age.
+#
+# 3. If bodies are deduplicated (DBCACHE_DEDUP_BODIES), stored bodies that no
+#    row of pages2 or pages2_history references any more are deleted.
+#
+# Every pass can be interrupted and run again.
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Expire, archive and compact rows of the scraping.pages2 table."
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=None,
+        help="seconds rows are kept for; by default the DBCACHE_RETENTION_MAX_AGE "
+        "setting, and 0 keeps them forever",
+    )
+    parser.add_argument(
+        "--status-max-age",
+        action="append",
+        default=[],
+        metavar="STATUS=SECONDS",
+        help="keep rows with this status for this many seconds (may be repeated)",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="move expired rows into pages2_history rather than deleting them",
+    )
+    parser.add_argument(
+        "--keep-versions",
+        type=int,
+        default=None,
+        help="versions of each URL to keep in pages2_history; by default the "
+        "DBCACHE_KEEP_VERSIONS setting, and 0 keeps them all",
+    )
+    parser.add_argument(
+        "--history-max-age",
+        type=float,
+        default=0.0,
+        help="seconds versions are kept in pages2_history for; 0 keeps them forever",
+    )
+    parser.add_argument(
+        "--partitions-ahead",
+        type=int,
+        default=3,
+        help="months ahead to have pages2_history partitions for",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="rows to go through per transaction"
+    )
+    parser.add_argument(
+        "--sleep",
+        type=float,
+        default=0.1,
+        help="seconds to pause between batches, to throttle the compaction",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    try:
+        args.status_max_age = {
+            int(status): float(seconds)
+            for status, _, seconds in (
+                option.partition("=") for option in args.status_max_age
+            )
+        }
+    except ValueError:
+        parser.error("--status-max-age must be given as STATUS=SECONDS")
+    return args
+
+
+# Runs one of the backend's batch operations from `start` until it reaches the
+# end of its table, and returns how many rows it deleted in all.
+def run_batches(
+    step: Callable[[Any], tuple[int, Any]],
+    start: Any,
+    sleep: float,
+    description: str,
+    logger: Logger,
+) -> int:
+    total: int = 0
+    position: Any = start
+    start_time: float = time.monotonic()
+    while True:
+        count, position = step(position)
+        total += count
+        if position is None:
+            break
+        if count:
+            logger.info(
+                f"{description}: {total} so far, "
+                f"{total / (time.monotonic() - start_time):.1f}/s"
+            )
+        if sleep > 0:
+            time.sleep(sleep)
+    return total
+
+
+# The test for whether a row has outlived its retention period as of `now`.
+# Rows with no date are never expired, since there's no telling how old they
+# are.
+def retention_test(
+    max_age: float, policy: dict[Any, Any], now: datetime
+) -> Callable[[int, datetime | None], bool]:
+    default_ttl: timedelta | None = timedelta(seconds=max_age) if max_age > 0 else None
+    status_ttls: dict[int, timedelta | None] = parse_status_policy(policy, default_ttl)
+
+    def expired(status: int, date: datetime | None) -> bool:
+        ttl: timedelta | None = status_ttls.get(status, default_ttl)
+        return ttl is not None and date is not None and now - date >= ttl
+
+    return expired
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
+
+    settings: Any = settings_from_env()
+    logger.info("opening connection to database")
+    backend: CacheBackend = load_backend(settings, "compact_pages")
+
+    max_age: float = (
+        args.max_age
+        if args.max_age is not None
+        else settings.getfloat("DBCACHE_RETENTION_MAX_AGE", 0.0)
+    )
+    policy: dict[Any, Any] = dict(settings.getdict("DBCACHE_RETENTION_POLICY"))
+    policy.update(args.status_max_age)
+    keep_versions: int = (
+        args.keep_versions if args.keep_versions is not None else backend.keep_versions
+    )
+    now: datetime = datetime.now(timezone.utc)
+    start_time: float = time.monotonic()
+    try:
+        expired_count: int = 0
+        if max_age > 0 or any(seconds for seconds in policy.values()):
+            expired: Callable[[int, datetime | None], bool] = retention_test(
+                max_age, policy, now
+            )
+            expired_count = run_batches(
+                lambda after: backend.expire_batch(
+                    expired, after, args.batch_size, args.archive
+                ),
+                0,
+                args.sleep,
+                "archived rows" if args.archive else "expired rows",
+                logger,
+            )
+            logger.info(
+                f"{'archived' if args.archive else 'expired'} {expired_count} rows of pages2"
+            )
+
+        trimmed_count: int = 0
+        if keep_versions > 0 or args.history_max_age > 0:
+            before: datetime | None = (
+                now - timedelta(seconds=args.history_max_age)
+                if args.history_max_age > 0
+                else None
+            )
+            dropped: list[str] = backend.rotate_history_partitions(
+                before or datetime.fromtimestamp(0, timezone.utc), args.partitions_ahead
+            )
+            if dropped:
+                logger.info(f"dropped pages2_history partitions {', '.join(dropped)}")
+            trimmed_count = run_batches(
+                lambda after: backend.trim_history_batch(
+                    keep_versions or None, before, after, args.batch_size
+                ),
+                b"",
+                args.sleep,
+                "trimmed versions",
+                logger,
+            )
+            logger.info(f"trimmed {trimmed_count} rows of pages2_history")
+
+        orphan_count: int = 0
+        if backend.dedup_bodies:
+            orphan_count = run_batches(
+                lambda after: backend.delete_orphan_bodies_batch(after, args.batch_size),
+                b"",
+                args.sleep,
+                "deleted orphaned bodies",
+                logger,
+            )
+            logger.info(f"deleted {orphan_count} orphaned bodies")
+    finally:
+        backend.close()
+
+    logger.info(
+        f"compacted in {time.monotonic() - start_time:.2f}s: {expired_count} rows "
+        f"{'archived' if args.archive else 'expired'}, {trimmed_count} versions "
+        f"trimmed, {orphan_count} bodies deleted"
+    )
+
+
+if __name__ == "__main__":
+    main()
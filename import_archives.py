@@ -0,0 +1,591 @@
+#!/usr/bin/python3
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+from datetime import datetime
+from logging import Logger
+from scrapy.http import HtmlResponse  # type: ignore[import-untyped]
+from scrdbcaching import BloomFilter, SerializableItem, set_up_logging
+from scrdbcaching.backends import CacheBackend, load_backend, settings_from_env
+from scrdbcaching.compression import BODY_CODECS
+from scrdbcaching.headers import HEADERS_FORMATS
+from typing import IO, Any, Callable, Iterator
+
+try:
+    import ijson  # type: ignore[import-untyped]
+except ImportError:
+    ijson = None
+
+
+# Imports the pages in existing WARC and HAR archives into the scraping.pages2
+# table, so that a crawl can be served from pages that were fetched by other
+# tools, without spending any API credits on them.
+#
+# WARC files (.warc, or .warc.gz as written by most crawlers, one gzip member
+# per record) contribute their "response" records of HTTP responses; HAR files
+# (.har, or .har.gz) their entries. Records are streamed, so an archive is
+# never read into memory whole; a HAR file is only streamed if the ijson
+# package is installed, and is read whole otherwise. Bodies are stored decoded
+# and de-chunked, as DatabaseCachingMiddleware would have stored them, and
+# only pages whose Content-Type is one of --content-types are imported.
+#
+# Rows are written --batch-rows at a time, each batch as one multi-row INSERT
+# in one transaction, inside the backend's bulk_load(), which relaxes
+# durability for the duration of the import unless --checkpoint is given (see
+# below). With --defer-unique-checks the backend's unique key checks are
+# turned off as well (on MySQL; SQLite has no way to), and duplicates are
+# weeded out here instead: against the rows already stored by a Bloom filter
+# of their keys, with any hit confirmed by looking the URL up, and within the
+# import by the keys seen so far. That needs rows to be keyed by url_hash (see
+# DBCACHE_URL_HASH_KEY), whose digests are compared as they are; the url
+# column's unique key compares URLs case- and accent-insensitively, which
+# can't be matched exactly here, so --defer-unique-checks is refused without
+# it. Within the import, URLs that differ only in case count as the same URL
+# either way. A URL that's already stored keeps its row, and a URL that turns
+# up more than once in the import keeps its first page, unless --replace is
+# given, in which case the last page for each URL wins. --replace can't be
+# combined with --defer-unique-checks.
+#
+# A record that's malformed, such as one with an unparseable status line or
+# Date header, is logged and skipped, and the import carries on.
+#
+# With --checkpoint, how far the import has got through each archive is saved
+# to that file after every batch is committed, so an interrupted import can be
+# run again with the same arguments and pick up where it left off; the
+# records before that point are passed over without being decoded. Batches
+# are committed durably then, so the checkpoint never gets ahead of what's on
+# disk. Archives are identified by their absolute paths.
+
+
+# The exceptions a malformed record can raise while it's turned into a row,
+# which skip the record rather than ending the import.
+MALFORMED_RECORD_ERRORS: tuple[type[Exception], ...] = (
+    ValueError,
+    LookupError,
+    TypeError,
+    zlib.error,
+)
+
+# The response headers that describe the body as it came over the wire rather
+# than as it's stored, which is decoded and whole.
+DROPPED_HEADERS: frozenset[bytes] = frozenset(
+    (b"content-encoding", b"content-length", b"transfer-encoding")
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Import pages from WARC and HAR archives into the scraping.pages2 table."
+    )
+    parser.add_argument("archives", nargs="+", help="the WARC or HAR files to import")
+    parser.add_argument(
+        "--format",
+        choices=("auto", "warc", "har"),
+        default="auto",
+        help="the archives' format; by default it's told by their names",
+    )
+    parser.add_argument(
+        "--batch-rows", type=int, default=1000, help="rows written per transaction"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="save progress to this file, and resume from it if it exists",
+    )
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="overwrite rows for URLs that are already stored",
+    )
+    parser.add_argument(
+        "--defer-unique-checks",
+        action="store_true",
+        help="skip the database's unique key checks, and check for duplicates here",
+    )
+    parser.add_argument(
+        "--content-types",
+        default="text/html,application/xhtml+xml",
+        help="comma-separated content types of the pages to import",
+    )
+    parser.add_argument(
+        "--body-codec",
+        choices=BODY_CODECS,
+        default=None,
+        help="how bodies are stored; by default the DBCACHE_BODY_CODEC setting",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=None,
+        help="by default the DBCACHE_BODY_COMPRESSION_LEVEL setting",
+    )
+    parser.add_argument(
+        "--headers-format",
+        choices=HEADERS_FORMATS,
+        default=None,
+        help="how headers are stored; by default the DBCACHE_HEADERS_FORMAT setting",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    if args.replace and args.defer_unique_checks:
+        parser.error("--replace can't be combined with --defer-unique-checks")
+    if args.batch_rows < 1:
+        parser.error("--batch-rows must be at least 1")
+    args.content_types = tuple(
+        content_type.strip().lower().encode()
+        for content_type in args.content_types.split(",")
+        if content_type.strip()
+    )
+    return args
+
+
+def archive_format(path: str, args: argparse.Namespace) -> str:
+    if args.format != "auto":
+        return args.format  # type: ignore[no-any-return]
+    return "har" if path.removesuffix(".gz").endswith(".har") else "warc"
+
+
+def open_archive(path: str) -> IO[bytes]:
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+# An imported page, as read from either kind of archive. The headers are the
+# ones that describe the stored body; `encoding` is set if the body's encoding
+# is known regardless of the headers, and `date` is when the page was fetched.
+class ArchivedPage:
+    url: str
+    status: int
+    headers: list[tuple[bytes, bytes]]
+    body: bytes
+    encoding: str | None
+    date: datetime | None
+
+    def __init__(
+        self,
+        url: str,
+        status: int,
+        headers: list[tuple[bytes, bytes]],
+        body: bytes,
+        encoding: str | None = None,
+        date: datetime | None = None,
+    ) -> None:
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.encoding = encoding
+        self.date = date
+
+
+# Parses an ISO 8601 timestamp as found in WARC-Date headers and HAR
+# startedDateTime fields, where a "Z" suffix stands for UTC.
+def parse_timestamp(value: str) -> datetime | None:
+    try:
+        return datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+# Yields a WARC file's records as their numbers, headers, with lowercased
+# names, and content blocks. Only one record is held in memory at a time. The
+# first `skip` records aren't yielded, and their blocks aren't even read.
+def iter_warc_records(
+    fh: IO[bytes], skip: int = 0
+) -> Iterator[tuple[int, dict[str, str], bytes]]:
+    number: int = -1
+    while True:
+        line: bytes = fh.readline()
+        if not line:
+            return
+        if not line.strip():
+            # The blank lines that end the previous record.
+            continue
+        if not line.startswith(b"WARC/"):
+            raise ValueError(f"expected a WARC record, found {line[:40]!r}")
+        headers: dict[str, str] = dict()
+        while True:
+            line = fh.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("utf-8", "replace").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        number += 1
+        length: int = int(headers.get("content-length", "0"))
+        if number < skip:
+            fh.seek(length, os.SEEK_CUR)
+            continue
+        yield number, headers, fh.read(length)
+
+
+def dechunk(body: bytes) -> bytes:
+    chunks: list[bytes] = list()
+    position: int = 0
+    while position < len(body):
+        line_end: int = body.find(b"\r\n", position)
+        if line_end < 0:
+            break
+        size: int = int(body[position:line_end].split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            break
+        chunks.append(body[line_end + 2 : line_end + 2 + size])
+        position = line_end + 2 + size + 2
+    return b"".join(chunks)
+
+
+# Undoes a body's Content-Encoding, or returns None if it's one that can't be.
+def decode_content(body: bytes, content_encoding: bytes) -> bytes | None:
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding in (b"", b"identity"):
+        return body
+    try:
+        if content_encoding in (b"gzip", b"x-gzip"):
+            return zlib.decompress(body, zlib.MAX_WBITS | 32)
+        if content_encoding == b"deflate":
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                # Some servers send raw deflate data with no zlib header.
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+    except zlib.error:
+        return None
+    return None
+
+
+# Turns a WARC response record, whose block is a whole HTTP response, into a
+# page, or returns None if its body can't be decoded.
+def page_from_warc(record: tuple[dict[str, str], bytes]) -> ArchivedPage | None:
+    headers, block = record
+    head, _, body = block.partition(b"\r\n\r\n")
+    lines: list[bytes] = head.split(b"\r\n")
+    status: int = int(lines[0].split()[1])
+    http_headers: list[tuple[bytes, bytes]] = [
+        (name.strip(), value.strip())
+        for name, _, value in (line.partition(b":") for line in lines[1:] if b":" in line)
+    ]
+    wire_headers: dict[bytes, bytes] = {name.lower(): value for name, value in http_headers}
+    if wire_headers.get(b"transfer-encoding", b"").strip().lower() == b"chunked":
+        body = dechunk(body)
+    decoded: bytes | None = decode_content(body, wire_headers.get(b"content-encoding", b""))
+    if decoded is None:
+        return None
+    return ArchivedPage(
+        url=headers["warc-target-uri"].strip("<>"),
+        status=status,
+        headers=[
+            (name, value)
+            for name, value in http_headers
+            if name.lower() not in DROPPED_HEADERS
+        ],
+        body=decoded,
+        date=parse_timestamp(headers.get("warc-date", "")),
+    )
+
+
+# Yields a WARC file's response records from the skip'th record on, as their
+# record numbers (counting every record) and records, for page_from_warc().
+def iter_warc_responses(
+    fh: IO[bytes], skip: int = 0
+) -> Iterator[tuple[int, tuple[dict[str, str], bytes]]]:
+    for number, headers, block in iter_warc_records(fh, skip):
+        if headers.get("warc-type") == "response" and headers.get(
+            "content-type", ""
+        ).startswith("application/http"):
+            yield number, (headers, block)
+
+
+# Turns a HAR entry into a page, or returns None if it has no body. A body
+# that isn't base64-encoded is text, which is stored encoded as UTF-8 whatever
+# charset the headers name.
+def page_from_har(entry: dict[str, Any]) -> ArchivedPage | None:
+    response: dict[str, Any] = entry["response"]
+    content: dict[str, Any] = response.get("content", dict())
+    text: str | None = content.get("text")
+    if text is None:
+        return None
+    encoding: str | None = None
+    if content.get("encoding") == "base64":
+        body: bytes = base64.b64decode(text)
+    else:
+        body = text.encode("utf-8")
+        encoding = "utf-8"
+    headers: list[tuple[bytes, bytes]] = [
+        (header["name"].encode("latin-1"), header["value"].encode("latin-1", "replace"))
+        for header in response.get("headers", list())
+        if header["name"].encode("latin-1").lower() not in DROPPED_HEADERS
+        # HTTP/2 pseudo-headers, which some browsers export.
+        and not header["name"].startswith(":")
+    ]
+    if content.get("mimeType") and not any(
+        name.lower() == b"content-type" for name, _ in headers
+    ):
+        headers.append((b"Content-Type", content["mimeType"].encode("latin-1")))
+    return ArchivedPage(
+        url=entry["request"]["url"],
+        status=int(response["status"]),
+        headers=headers,
+        body=body,
+        encoding=encoding,
+        date=parse_timestamp(entry.get("startedDateTime", "")),
+    )
+
+
+# Yields a HAR file's entries from the skip'th on, as their numbers and
+# entries, for page_from_har().
+def iter_har_entries(
+    fh: IO[bytes], skip: int = 0
+) -> Iterator[tuple[int, dict[str, Any]]]:
+    entries: Any = (
+        ijson.items(fh, "log.entries.item")
+        if ijson is not None
+        else json.load(fh)["log"]["entries"]
+    )
+    for number, entry in enumerate(entries):
+        if number >= skip:
+            yield number, entry
+
+
+# Builds the row for a page the same way SerializingDatabasePipeline would
+# have, if it had been crawled. If the page has no Date header, its row is
+# dated when the archive says it was fetched, rather than now.
+def row_from_page(page: ArchivedPage, args: argparse.Namespace) -> dict[str, Any]:
+    response: HtmlResponse = HtmlResponse(
+        url=page.url,
+        status=page.status,
+        headers=page.headers,
+        body=page.body,
+        encoding=page.encoding,
+    )
+    item: SerializableItem = SerializableItem.from_htmlresponse(  # type: ignore[assignment]
+        response, keep_bytes=args.body_codec != "text"
+    )
+    if "Date" not in response.headers and page.date is not None:
+        item["date"] = page.date
+    return item.to_dict(args.body_codec, args.compression_level, args.headers_format)
+
+
+def wanted(page: ArchivedPage, args: argparse.Namespace) -> bool:
+    for name, value in page.headers:
+        if name.lower() == b"content-type":
+            return value.split(b";")[0].strip().lower() in args.content_types
+    return True
+
+
+# How far the import has got through each archive, saved to a JSON file. It's
+# replaced atomically, so an import killed while saving it leaves the previous
+# version.
+class Checkpoint:
+    path: str | None
+    state: dict[str, dict[str, Any]]
+
+    def __init__(self, path: str | None) -> None:
+        self.path = path
+        self.state = dict()
+        if path is not None and os.path.exists(path):
+            with open(path) as fh:
+                self.state = json.load(fh)
+
+    # The number of records of the archive already dealt with, and whether
+    # it's finished.
+    def position(self, archive: str) -> tuple[int, bool]:
+        entry: dict[str, Any] = self.state.get(os.path.abspath(archive), dict())
+        return int(entry.get("records", 0)), bool(entry.get("done", False))
+
+    def save(self, archive: str, records: int, done: bool = False) -> None:
+        if self.path is None:
+            return
+        self.state[os.path.abspath(archive)] = dict(records=records, done=done)
+        temp_path: str = f"{self.path}.tmp"
+        with open(temp_path, "w") as fh:
+            json.dump(self.state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, self.path)
+
+
+# Writes batches of rows, counting what's stored and skipped. Rows for URLs
+# already imported are weeded out before they're written, keeping the first,
+# unless rows are being replaced; then only the last row for each URL in a
+# batch is written, and later batches replace earlier ones. If `existing` is
+# set, unique key checks are deferred, and rows for URLs that are already
+# stored are weeded out too. URLs are told apart as the url column's
+# case-insensitive collation does, by casefolding them, as the Bloom filter
+# and get_many() do; url_hash digests are compared as they are.
+class BatchWriter:
+    backend: CacheBackend
+    on_existing: str
+    existing: BloomFilter | None
+    seen: set[str | bytes]
+    stored: int
+    duplicates: int
+
+    def __init__(
+        self, backend: CacheBackend, on_existing: str, existing: BloomFilter | None
+    ) -> None:
+        self.backend = backend
+        self.on_existing = on_existing
+        self.existing = existing
+        self.seen = set()
+        self.stored = 0
+        self.duplicates = 0
+
+    def _unique_key(self, url: str) -> str | bytes:
+        key: str | bytes = self.backend.key_for(url)
+        return key if isinstance(key, bytes) else key.casefold()
+
+    def _new_rows(self, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        if self.on_existing == "replace":
+            return list({self._unique_key(row["url"]): row for row in rows}.values())
+        new_rows: list[dict[str, Any]] = list()
+        for row in rows:
+            key: str | bytes = self._unique_key(row["url"])
+            if key not in self.seen:
+                self.seen.add(key)
+                new_rows.append(row)
+        if self.existing is not None:
+            # The filter can only say a URL might be stored; they're looked
+            # up to be sure, which with a low false positive rate is rare.
+            maybe_stored: list[str] = [
+                row["url"]
+                for row in new_rows
+                if self.backend.key_for(row["url"]) in self.existing
+            ]
+            if maybe_stored:
+                stored: dict[str, dict[str, Any]] = self.backend.get_many(maybe_stored)
+                new_rows = [row for row in new_rows if row["url"] not in stored]
+        return new_rows
+
+    def write(self, rows: list[dict[str, Any]]) -> None:
+        new_rows: list[dict[str, Any]] = self._new_rows(rows)
+        self.duplicates += len(rows) - len(new_rows)
+        if new_rows:
+            self.backend.put_many(new_rows, on_existing=self.on_existing)
+        self.stored += len(new_rows)
+
+
+# Imports one archive, skipping the records the checkpoint says were dealt
+# with already. Returns the number of pages read from it, and the number of
+# malformed records skipped.
+def import_archive(
+    path: str,
+    args: argparse.Namespace,
+    writer: BatchWriter,
+    checkpoint: Checkpoint,
+    logger: Logger,
+) -> tuple[int, int]:
+    resume_from, done = checkpoint.position(path)
+    if done:
+        logger.info(f"{path}: already imported; skipping")
+        return 0, 0
+    if resume_from:
+        logger.info(f"{path}: resuming after record {resume_from}")
+    archived: Iterator[tuple[int, Any]]
+    to_page: Callable[[Any], ArchivedPage | None]
+    page_count: int = 0
+    malformed_count: int = 0
+    batch: list[dict[str, Any]] = list()
+    records: int = resume_from
+    start_time: float = time.monotonic()
+    with open_archive(path) as fh:
+        if archive_format(path, args) == "har":
+            archived, to_page = iter_har_entries(fh, resume_from), page_from_har
+        else:
+            archived, to_page = iter_warc_responses(fh, resume_from), page_from_warc
+        for number, record in archived:
+            records = number + 1
+            try:
+                page: ArchivedPage | None = to_page(record)
+                if page is None or not wanted(page, args):
+                    continue
+                row: dict[str, Any] = row_from_page(page, args)
+            except MALFORMED_RECORD_ERRORS as exception:
+                malformed_count += 1
+                logger.warning(
+                    f"{path}: skipping malformed record {number}: "
+                    f"{exception.__class__.__name__}: {exception}"
+                )
+                continue
+            page_count += 1
+            batch.append(row)
+            if len(batch) >= args.batch_rows:
+                writer.write(batch)
+                batch = list()
+                checkpoint.save(path, records)
+                logger.info(
+                    f"{path}: {records} records read, {writer.stored} rows stored; "
+                    f"{page_count / (time.monotonic() - start_time):.1f} rows/s"
+                )
+    if batch:
+        writer.write(batch)
+    checkpoint.save(path, records, done=True)
+    return page_count, malformed_count
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
+
+    settings: Any = settings_from_env()
+    if args.body_codec is None:
+        args.body_codec = settings.get("DBCACHE_BODY_CODEC", "text")
+    if args.compression_level is None:
+        args.compression_level = settings.getint("DBCACHE_BODY_COMPRESSION_LEVEL", -1)
+    if args.headers_format is None:
+        args.headers_format = settings.get("DBCACHE_HEADERS_FORMAT", "json")
+
+    logger.info("opening connection to database")
+    backend: CacheBackend = load_backend(settings, "import_archives")
+    if args.defer_unique_checks and not backend.url_hash_key:
+        backend.close()
+        sys.exit(
+            "--defer-unique-checks needs rows keyed by url_hash; set "
+            "DBCACHE_URL_HASH_KEY, or leave unique key checks to the database"
+        )
+    checkpoint: Checkpoint = Checkpoint(args.checkpoint)
+
+    existing: BloomFilter | None = None
+    if args.defer_unique_checks:
+        existing = BloomFilter(max(backend.count() * 2, 100_000), 0.001)
+        for key in backend.iter_keys():
+            existing.add(key)
+        logger.info(
+            f"built filter of {existing.size_bytes} bytes over {len(existing)} "
+            "stored URLs"
+        )
+    writer: BatchWriter = BatchWriter(
+        backend, "replace" if args.replace else "ignore", existing
+    )
+
+    page_count: int = 0
+    malformed_count: int = 0
+    start_time: float = time.monotonic()
+    try:
+        with backend.bulk_load(
+            unchecked=args.defer_unique_checks, durable=args.checkpoint is not None
+        ):
+            for path in args.archives:
+                count, malformed = import_archive(path, args, writer, checkpoint, logger)
+                page_count += count
+                malformed_count += malformed
+                logger.info(
+                    f"{path}: imported {count} pages, skipping {malformed} malformed records"
+                )
+    finally:
+        backend.close()
+
+    elapsed: float = time.monotonic() - start_time
+    logger.info(
+        f"read {page_count} pages and stored {writer.stored} rows, skipping "
+        f"{writer.duplicates} duplicates and {malformed_count} malformed records, "
+        f"in {elapsed:.2f}s "
+        f"({writer.stored / elapsed if elapsed > 0 else 0:.1f} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
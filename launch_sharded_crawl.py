@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from logging import Logger
+from scrdbcaching import CreditLedger, load_credit_ledger, set_up_logging
+from scrdbcaching.backends import settings_from_env
+from typing import IO
+
+
+# Runs a crawl as several `scrapy crawl` processes, each crawling one shard of
+# the spider's start requests, that between them spend a single API credit
+# budget. It's run from the scrapy project directory, like `scrapy crawl`.
+#
+# The project has to have scrdbcaching.ShardingMiddleware in its
+# SPIDER_MIDDLEWARES, which splits the start requests between the shards (and
+# does nothing in an unsharded crawl), and DatabaseCachingMiddleware in its
+# DOWNLOADER_MIDDLEWARES as usual. Each process is given its shard with the
+# DBCACHE_SHARD_INDEX and DBCACHE_SHARD_COUNT settings, and the credit ledger
+# to reserve credits from with DBCACHE_CREDIT_LEDGER; see
+# scrdbcaching.credits.
+#
+# The ledger is set to --credits-used and --credits-threshold before the
+# shards start. The "file" ledger only works for shards on one machine. To
+# spread the shards of one crawl over several machines, use the "mysql" ledger,
+# start the launcher on one machine with the --shards it should run out of the
+# --shard-count, and on each of the others with --join and the shards it
+# should run, so that it uses the ledger as it is.
+#
+# Each shard's output goes to its own log file in --log-dir, and with
+# --jobdir-base each gets its own JOBDIR under it so it can be resumed.
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run a crawl as several processes sharing one API credit budget."
+    )
+    parser.add_argument("spider", help="the name of the spider to run")
+    parser.add_argument(
+        "--shard-count", type=int, required=True, help="how many shards there are"
+    )
+    parser.add_argument(
+        "--shards",
+        default=None,
+        help="comma-separated indexes of the shards to run here; by default all",
+    )
+    parser.add_argument("--credits-used", type=int, default=0)
+    parser.add_argument("--credits-threshold", type=int, required=True)
+    parser.add_argument(
+        "--join",
+        action="store_true",
+        help="use the ledger as it is rather than setting it first",
+    )
+    parser.add_argument(
+        "--ledger",
+        default="file",
+        help="the credit ledger: 'file', 'mysql' or a CreditLedger import path",
+    )
+    parser.add_argument(
+        "--ledger-path",
+        default="credits.ledger",
+        help="the file the 'file' ledger is kept in",
+    )
+    parser.add_argument(
+        "--ledger-name",
+        default="default",
+        help="the name of the budget in the 'mysql' ledger",
+    )
+    parser.add_argument(
+        "--credit-block",
+        type=int,
+        default=100,
+        help="credits each process reserves from the ledger at a time",
+    )
+    parser.add_argument(
+        "--log-dir", default=".", help="the directory shards' log files go in"
+    )
+    parser.add_argument(
+        "--jobdir-base",
+        default=None,
+        help="give each shard a JOBDIR in this directory",
+    )
+    parser.add_argument(
+        "-a",
+        dest="spider_args",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set a spider argument (may be repeated)",
+    )
+    parser.add_argument(
+        "-s",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set or override a setting (may be repeated)",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    if args.shard_count < 1:
+        parser.error("--shard-count must be at least 1")
+    args.shard_indexes = (
+        [int(index) for index in args.shards.split(",")]
+        if args.shards is not None
+        else list(range(args.shard_count))
+    )
+    if any(not 0 <= index < args.shard_count for index in args.shard_indexes):
+        parser.error(f"--shards must be between 0 and {args.shard_count - 1}")
+    return args
+
+
+# The `scrapy crawl` command line for a shard.
+def shard_command(args: argparse.Namespace, index: int) -> list[str]:
+    settings: dict[str, str] = {
+        "DBCACHE_SHARD_INDEX": str(index),
+        "DBCACHE_SHARD_COUNT": str(args.shard_count),
+        "DBCACHE_CREDIT_LEDGER": args.ledger,
+        "DBCACHE_CREDIT_LEDGER_PATH": os.path.abspath(args.ledger_path),
+        "DBCACHE_CREDIT_LEDGER_NAME": args.ledger_name,
+        "DBCACHE_CREDIT_BLOCK": str(args.credit_block),
+    }
+    if args.jobdir_base is not None:
+        settings["JOBDIR"] = os.path.join(args.jobdir_base, f"shard-{index}")
+    command: list[str] = [
+        "scrapy",
+        "crawl",
+        args.spider,
+        "-a",
+        f"credits_used={args.credits_used}",
+        "-a",
+        f"credits_threshold={args.credits_threshold}",
+    ]
+    for option in args.spider_args:
+        command += ["-a", option]
+    for name, value in settings.items():
+        command += ["-s", f"{name}={value}"]
+    for option in args.settings:
+        command += ["-s", option]
+    return command
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
+
+    ledger: CreditLedger = load_credit_ledger(  # type: ignore[assignment]
+        settings_from_env(
+            DBCACHE_CREDIT_LEDGER=args.ledger,
+            DBCACHE_CREDIT_LEDGER_PATH=args.ledger_path,
+            DBCACHE_CREDIT_LEDGER_NAME=args.ledger_name,
+        )
+    )
+    if args.join:
+        ledger.open(args.credits_used, args.credits_threshold)
+    else:
+        ledger.reset(args.credits_used, args.credits_threshold)
+    credits_used, credits_threshold = ledger.balance()
+    logger.info(f"credit ledger at {credits_used} of {credits_threshold} credits used")
+
+    processes: dict[int, subprocess.Popen] = dict()  # type: ignore[type-arg]
+    log_files: list[IO[bytes]] = list()
+    start_time: float = time.monotonic()
+    try:
+        for index in args.shard_indexes:
+            log_path: str = os.path.join(args.log_dir, f"{args.spider}_shard{index}.log")
+            log_file: IO[bytes] = open(log_path, "ab")
+            log_files.append(log_file)
+            processes[index] = subprocess.Popen(
+                shard_command(args, index), stdout=log_file, stderr=subprocess.STDOUT
+            )
+            logger.info(
+                f"started shard {index} of {args.shard_count} as process "
+                f"{processes[index].pid}, logging to {log_path}"
+            )
+        for index, process in processes.items():
+            returncode: int = process.wait()
+            logger.info(f"shard {index} exited with status {returncode}")
+    except KeyboardInterrupt:
+        # Passing the interrupt on, so each shard shuts down as gracefully as
+        # it would from a Ctrl-C of its own and hands back its unspent
+        # credits.
+        logger.warning("interrupted; stopping shards")
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            process.wait()
+    finally:
+        for log_file in log_files:
+            log_file.close()
+
+    credits_used, credits_threshold = ledger.balance()
+    ledger.close()
+    logger.info(
+        f"ran {len(processes)} shards in {time.monotonic() - start_time:.1f}s; "
+        f"credit ledger at {credits_used} of {credits_threshold} credits used"
+    )
+
+
+if __name__ == "__main__":
+    main()
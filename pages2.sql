@@ -1,11 +1,81 @@
+-- Rows are looked up by url, unless the DBCACHE_URL_HASH_KEY setting is True,
+-- in which case they're looked up by url_hash, the SHA-1 digest of the URL's
+-- canonical form (see scrdbcaching.url_digest()). Crawlers only write url_hash
+-- with the setting on, so the column is nullable and url_key is kept until
+-- every crawler has it on; then `pages2_migrate.py url-hash --finalize`
+-- backfills any rows still without a digest, makes url_hash NOT NULL and drops
+-- url_key. Tables from before url_hash existed can be converted with
+-- `pages2_migrate.py url-hash` too.
 CREATE TABLE pages2 (
     `_id` INT AUTO_INCREMENT NOT NULL,
     `url` VARCHAR(768) NOT NULL,
+    `url_hash` BINARY(20),
     `status` SMALLINT NOT NULL,
     `encoding` VARCHAR(16) NOT NULL,
-    `headers` VARCHAR(1024) NOT NULL,
+    `headers` VARCHAR(1024),
+    `headers_blob` BLOB,
     `date` TIMESTAMP,
-    `body` MEDIUMTEXT NOT NULL,
+    `body` MEDIUMTEXT,
+    `body_blob` MEDIUMBLOB,
+    `body_codec` VARCHAR(8) NOT NULL DEFAULT 'text',
+    `body_hash` BINARY(32),
     PRIMARY KEY (`_id`),
-    UNIQUE KEY `url_key` (`url`)
-) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
\ No newline at end of file
+    UNIQUE KEY `url_key` (`url`),
+    UNIQUE KEY `url_hash_key` (`url_hash`),
+    KEY `body_hash_key` (`body_hash`)
+) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Earlier versions of pages2 rows. If the DBCACHE_KEEP_VERSIONS setting is
+-- nonzero, a row is copied here before a fetch replaces it, and
+-- compact_pages.py can move expired rows here rather than deleting them; it
+-- also trims the history to that many versions per URL. The table is
+-- partitioned by month of the page's date, so that history past its retention
+-- period can be dropped a partition at a time; compact_pages.py adds
+-- partitions for the months ahead by splitting them off pmax. The single
+-- month below is just a starting point. Existing databases can be given the
+-- table with `pages2_migrate.py history`.
+CREATE TABLE pages2_history (
+    `_id` BIGINT AUTO_INCREMENT NOT NULL,
+    `url` VARCHAR(768) NOT NULL,
+    `url_hash` BINARY(20) NOT NULL,
+    `status` SMALLINT NOT NULL,
+    `encoding` VARCHAR(16) NOT NULL,
+    `headers` VARCHAR(1024),
+    `headers_blob` BLOB,
+    `date` TIMESTAMP NOT NULL,
+    `body` MEDIUMTEXT,
+    `body_blob` MEDIUMBLOB,
+    `body_codec` VARCHAR(8) NOT NULL DEFAULT 'text',
+    `body_hash` BINARY(32),
+    `archived_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`_id`, `date`),
+    KEY `url_hash_date_key` (`url_hash`, `date`),
+    KEY `body_hash_key` (`body_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+PARTITION BY RANGE (UNIX_TIMESTAMP(`date`)) (
+    PARTITION p202610 VALUES LESS THAN (UNIX_TIMESTAMP('2026-11-01 00:00:00')),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- Page bodies, stored once each and referenced from pages2.body_hash by their
+-- SHA-256 digest (see scrdbcaching.compression.body_digest()), if the
+-- DBCACHE_DEDUP_BODIES setting is True. Existing rows can be moved over with
+-- `pages2_migrate.py dedup-bodies`.
+CREATE TABLE bodies (
+    `body_hash` BINARY(32) NOT NULL,
+    `body` MEDIUMTEXT,
+    `body_blob` MEDIUMBLOB,
+    `body_codec` VARCHAR(8) NOT NULL DEFAULT 'text',
+    PRIMARY KEY (`body_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- API credit budgets shared by the processes of a sharded crawl, if the
+-- DBCACHE_CREDIT_LEDGER setting is "mysql"; see scrdbcaching.credits. Each is
+-- a row named by DBCACHE_CREDIT_LEDGER_NAME, and credits_used counts every
+-- credit reserved from it.
+CREATE TABLE credit_ledger (
+    `name` VARCHAR(64) NOT NULL,
+    `credits_used` BIGINT NOT NULL DEFAULT 0,
+    `credits_threshold` BIGINT NOT NULL,
+    PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+
+import argparse
+import decouple
+import json
+import sys
+import time
+
+from datetime import datetime, timedelta, timezone
+from logging import Logger
+from MySQLdb.cursors import DictCursor
+from MySQLdb import Connect, Connection
+from scrdbcaching import compress_body, set_up_logging, url_digest
+from scrdbcaching.compression import BODY_CODECS, body_digest, body_from_row
+from scrdbcaching.headers import HEADERS_FORMATS, headers_from_row, pack_headers
+
+
+MYSQL_USERNAME: str = decouple.config("MYSQL_USERNAME")
+MYSQL_PASSWORD: str = decouple.config("MYSQL_PASSWORD")
+MYSQL_DATABASE: str = decouple.config("MYSQL_DATABASE")
+MYSQL_HOST: str = decouple.config("MYSQL_HOST")
+MYSQL_CHARSET: str = decouple.config("MYSQL_CHARSET")
+
+
+# Converts existing rows of the scraping.pages2 table to newer storage formats.
+# Each subcommand works through the table in batches of rows ordered by _id,
+# committing after every batch, so it can run against a live table without
+# holding long locks, and can be interrupted and rerun: rows that are already
+# in the target format are skipped.
+
+
+def open_connection() -> Connection:
+    return Connect(
+        user=MYSQL_USERNAME,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DATABASE,
+        host=MYSQL_HOST,
+        charset=MYSQL_CHARSET,
+    )
+
+
+# Adds any of the given columns that the pages2 table doesn't have yet. The
+# dict maps column names to their definitions.
+def ensure_columns(
+    dbconn: Connection, columns: dict[str, str], logger: Logger
+) -> None:
+    dbcurs: DictCursor = dbconn.cursor(DictCursor)
+    dbcurs.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'pages2';"
+    )
+    existing: set[str] = {record["COLUMN_NAME"] for record in dbcurs.fetchall()}
+    for name, definition in columns.items():
+        if name in existing:
+            continue
+        logger.info(f"adding column {name} to pages2")
+        dbcurs.execute(f"ALTER TABLE pages2 ADD COLUMN `{name}` {definition};")
+    dbcurs.close()
+
+
+# Re-encodes the body of every row that isn't already stored with the target
+# codec. Rows whose bodies have been moved to the bodies table are left alone.
+def migrate_compress(dbconn: Connection, args: argparse.Namespace, logger: Logger) -> None:
+    ensure_columns(
+        dbconn,
+        {
+            "body_blob": "MEDIUMBLOB AFTER `body`",
+            "body_codec": "VARCHAR(8) NOT NULL DEFAULT 'text' AFTER `body_blob`",
+        },
+        logger,
+    )
+    dbcurs: DictCursor = dbconn.cursor(DictCursor)
+    # Compressed rows keep their body in body_blob, so body has to be allowed
+    # to be NULL. That's a table rebuild, so it's only done if it's needed.
+    dbcurs.execute(
+        "SELECT IS_NULLABLE FROM information_schema.COLUMNS WHERE "
+        "TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'pages2' AND COLUMN_NAME = 'body';"
+    )
+    if dbcurs.fetchone()["IS_NULLABLE"] == "NO":  # type: ignore[index]
+        logger.info("making column body of pages2 nullable")
+        dbcurs.execute("ALTER TABLE pages2 MODIFY `body` MEDIUMTEXT;")
+    last_id: int = 0
+    converted: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+    while True:
+        dbcurs.execute(
+            "SELECT _id, encoding, body, body_blob, body_codec FROM pages2 "
+            "WHERE _id > %(last_id)s AND body_codec != %(codec)s "
+            "AND (body IS NOT NULL OR body_blob IS NOT NULL) "
+            "ORDER BY _id LIMIT %(batch_size)s;",
+            dict(last_id=last_id, codec=args.codec, batch_size=args.batch_size),
+        )
+        records: tuple[dict[str, str | bytes | int], ...] = dbcurs.fetchall()
+        if not records:
+            break
+        updates: list[dict[str, str | bytes | int | None]] = list()
+        for record in records:
+            body: bytes = body_from_row(record)
+            bytes_before += len(body)
+            if args.codec == "text":
+                updates.append(
+                    dict(
+                        _id=record["_id"],
+                        body=body.decode(record["encoding"]),  # type: ignore[arg-type]
+                        body_blob=None,
+                        body_codec="text",
+                    )
+                )
+                bytes_after += len(body)
+            else:
+                blob: bytes = (
+                    body
+                    if args.codec == "raw"
+                    else compress_body(body, args.codec, args.level)
+                )
+                updates.append(
+                    dict(_id=record["_id"], body=None, body_blob=blob, body_codec=args.codec)
+                )
+                bytes_after += len(blob)
+        dbcurs.executemany(
+            "UPDATE pages2 SET body = %(body)s, body_blob = %(body_blob)s, "
+            "body_codec = %(body_codec)s WHERE _id = %(_id)s;",
+            updates,
+        )
+        dbconn.commit()
+        last_id = records[-1]["_id"]  # type: ignore[assignment]
+        converted += len(records)
+        logger.info(
+            f"converted {converted} rows to '{args.codec}' (last _id {last_id}); "
+            f"{bytes_before} bytes of bodies now stored in {bytes_after} bytes"
+        )
+        if args.sleep > 0:
+            time.sleep(args.sleep)
+    dbcurs.close()
+
+
+# Converts the headers of every row that isn't already stored in the target
+# format.
+def migrate_headers(dbconn: Connection, args: argparse.Namespace, logger: Logger) -> None:
+    ensure_columns(dbconn, {"headers_blob": "BLOB AFTER `headers`"}, logger)
+    dbcurs: DictCursor = dbconn.cursor(DictCursor)
+    # Rows with binary headers have no JSON headers, so headers has to be
+    # allowed to be NULL.
+    dbcurs.execute(
+        "SELECT IS_NULLABLE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = "
+        "DATABASE() AND TABLE_NAME = 'pages2' AND COLUMN_NAME = 'headers';"
+    )
+    if dbcurs.fetchone()["IS_NULLABLE"] == "NO":  # type: ignore[index]
+        logger.info("making column headers of pages2 nullable")
+        dbcurs.execute("ALTER TABLE pages2 MODIFY `headers` VARCHAR(1024);")
+    condition: str = (
+        "headers_blob IS NULL" if args.format == "binary" else "headers_blob IS NOT NULL"
+    )
+    last_id: int = 0
+    converted: int = 0
+    while True:
+        dbcurs.execute(
+            "SELECT _id, encoding, headers, headers_blob FROM pages2 "
+            f"WHERE _id > %(last_id)s AND {condition} "
+            "ORDER BY _id LIMIT %(batch_size)s;",
+            dict(last_id=last_id, batch_size=args.batch_size),
+        )
+        records: tuple[dict[str, str | bytes | int], ...] = dbcurs.fetchall()
+        if not records:
+            break
+        updates: list[dict[str, str | bytes | int | None]] = list()
+        for record in records:
+            headers: dict[bytes, list[bytes]] = headers_from_row(record)
+            encoding: str = record["encoding"]  # type: ignore[assignment]
+            if args.format == "binary":
+                updates.append(
+                    dict(
+                        _id=record["_id"],
+                        headers=None,
+                        headers_blob=pack_headers(headers),
+                    )
+                )
+            else:
+                updates.append(
+                    dict(
+                        _id=record["_id"],
+                        headers=json.dumps(
+                            {
+                                key.decode(encoding): [v.decode(encoding) for v in value]
+                                for key, value in headers.items()
+                            }
+                        ),
+                        headers_blob=None,
+                    )
+                )
+        dbcurs.executemany(
+            "UPDATE pages2 SET headers = %(headers)s, headers_blob = %(headers_blob)s "
+            "WHERE _id = %(_id)s;",
+            updates,
+        )
+        dbconn.commit()
+        last_id = records[-1]["_id"]  # type: ignore[assignment]
+        converted += len(records)
+        logger.info(
+            f"converted headers of {converted} rows to '{args.format}' "
+            f"(last _id {last_id})"
+        )
+        if args.sleep > 0:
+            time.sleep(args.sleep)
+    dbcurs.close()
+
+
+# Backfills the url_hash column and makes it the table's unique key. The
+# backfill makes passes over the table until no row is left without a digest,
+# so rows inserted by crawlers still running without DBCACHE_URL_HASH_KEY are
+# picked up too. Equivalent URLs canonicalize to the same digest, so if the
+# table holds more than one of them the unique key can't be added until all
+# but the newest are deleted, which is only done with --drop-duplicates. With
+# --finalize, url_hash is made NOT NULL and the old url_key index is dropped;
+# that should only be done once every crawler is writing url_hash.
+def migrate_url_hash(dbconn: Connection, args: argparse.Namespace, logger: Logger) -> None:
+    ensure_columns(dbconn, {"url_hash": "BINARY(20) AFTER `url`"}, logger)
+    dbcurs: DictCursor = dbconn.cursor(DictCursor)
+    converted: int = 0
+    while True:
+        last_id: int = 0
+        converted_this_pass: int = 0
+        while True:
+            dbcurs.execute(
+                "SELECT _id, url FROM pages2 WHERE _id > %(last_id)s AND "
+                "url_hash IS NULL ORDER BY _id LIMIT %(batch_size)s;",
+                dict(last_id=last_id, batch_size=args.batch_size),
+            )
+            records: tuple[dict[str, str | int], ...] = dbcurs.fetchall()
+            if not records:
+                break
+            dbcurs.executemany(
+                "UPDATE pages2 SET url_hash = %(url_hash)s WHERE _id = %(_id)s;",
+                [
+                    dict(_id=record["_id"], url_hash=url_digest(record["url"]))  # type: ignore[arg-type]
+                    for record in records
+                ],
+            )
+            dbconn.commit()
+            last_id = records[-1]["_id"]  # type: ignore[assignment]
+            converted_this_pass += len(records)
+            logger.info(
+                f"backfilled url_hash of {converted + converted_this_pass} rows "
+                f"(last _id {last_id})"
+            )
+            if args.sleep > 0:
+                time.sleep(args.sleep)
+        converted += converted_this_pass
+        if converted_this_pass == 0:
+            break
+
+    dbcurs.execute(
+        "SELECT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = "
+        "DATABASE() AND TABLE_NAME = 'pages2';"
+    )
+    indexes: set[str] = {record["INDEX_NAME"] for record in dbcurs.fetchall()}
+    if "url_hash_key" not in indexes:
+        dbcurs.execute(
+            "SELECT url_hash, COUNT(*) AS copies, MAX(_id) AS newest_id FROM pages2 "
+            "GROUP BY url_hash HAVING COUNT(*) > 1;"
+        )
+        duplicates: tuple[dict[str, bytes | int], ...] = dbcurs.fetchall()
+        if duplicates and not args.drop_duplicates:
+            logger.error(
+                f"{len(duplicates)} URL digests are shared by more than one row; "
+                "rerun with --drop-duplicates to keep only the newest row for "
+                "each, then the unique key can be added"
+            )
+            dbcurs.close()
+            return
+        for duplicate in duplicates:
+            dbcurs.execute(
+                "DELETE FROM pages2 WHERE url_hash = %(url_hash)s AND _id < %(newest_id)s;",
+                duplicate,
+            )
+            dbconn.commit()
+        if duplicates:
+            logger.info(f"dropped older duplicates of {len(duplicates)} URL digests")
+        logger.info("adding unique key url_hash_key to pages2")
+        dbcurs.execute(
+            "ALTER TABLE pages2 ADD UNIQUE KEY `url_hash_key` (`url_hash`), "
+            "ALGORITHM=INPLACE, LOCK=NONE;"
+        )
+
+    if args.finalize:
+        logger.info("making column url_hash of pages2 NOT NULL")
+        dbcurs.execute("ALTER TABLE pages2 MODIFY `url_hash` BINARY(20) NOT NULL;")
+        if "url_key" in indexes:
+            logger.info("dropping index url_key from pages2")
+            dbcurs.execute(
+                "ALTER TABLE pages2 DROP INDEX `url_key`, ALGORITHM=INPLACE, LOCK=NONE;"
+            )
+    dbcurs.close()
+
+
+# Moves the body of every row that still has its own into the bodies table,
+# storing each distinct body once, and points the row at it by body_hash.
+# Bodies keep the codec they were stored with, so `compress` should be run
+# first if they're to be converted. Crawlers should have DBCACHE_DEDUP_BODIES
+# set to True before this is run, or they won't find the moved bodies.
+def migrate_dedup_bodies(
+    dbconn: Connection, args: argparse.Namespace, logger: Logger
+) -> None:
+    ensure_columns(dbconn, {"body_hash": "BINARY(32) AFTER `body_codec`"}, logger)
+    dbcurs: DictCursor = dbconn.cursor(DictCursor)
+    dbcurs.execute(
+        "CREATE TABLE IF NOT EXISTS bodies ("
+        "`body_hash` BINARY(32) NOT NULL, "
+        "`body` MEDIUMTEXT, "
+        "`body_blob` MEDIUMBLOB, "
+        "`body_codec` VARCHAR(8) NOT NULL DEFAULT 'text', "
+        "PRIMARY KEY (`body_hash`)"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"
+    )
+    last_id: int = 0
+    converted: int = 0
+    bodies_stored: int = 0
+    bytes_freed: int = 0
+    while True:
+        dbcurs.execute(
+            "SELECT _id, body, body_blob, body_codec FROM pages2 "
+            "WHERE _id > %(last_id)s AND body_hash IS NULL "
+            "AND (body IS NOT NULL OR body_blob IS NOT NULL) "
+            "ORDER BY _id LIMIT %(batch_size)s;",
+            dict(last_id=last_id, batch_size=args.batch_size),
+        )
+        records: tuple[dict[str, str | bytes | int], ...] = dbcurs.fetchall()
+        if not records:
+            break
+        bodies: dict[bytes, dict[str, str | bytes | int | None]] = dict()
+        updates: list[dict[str, bytes | int]] = list()
+        for record in records:
+            digest: bytes = body_digest(record)
+            bodies.setdefault(
+                digest,
+                dict(
+                    body_hash=digest,
+                    body=record["body"],
+                    body_blob=record["body_blob"],
+                    body_codec=record["body_codec"],
+                ),
+            )
+            updates.append(dict(_id=record["_id"], body_hash=digest))  # type: ignore[arg-type]
+        placeholders: str = ", ".join(["%s"] * len(bodies))
+        dbcurs.execute(
+            f"SELECT body_hash FROM bodies WHERE body_hash IN ({placeholders});",
+            tuple(bodies),
+        )
+        stored: set[bytes] = {record["body_hash"] for record in dbcurs.fetchall()}
+        new_bodies: list[dict[str, str | bytes | int | None]] = [
+            body for digest, body in bodies.items() if digest not in stored
+        ]
+        if new_bodies:
+            dbcurs.executemany(
+                "INSERT IGNORE INTO bodies (body_hash, body, body_blob, body_codec) "
+                "VALUES (%(body_hash)s, %(body)s, %(body_blob)s, %(body_codec)s);",
+                new_bodies,
+            )
+        dbcurs.executemany(
+            "UPDATE pages2 SET body = NULL, body_blob = NULL, body_hash = %(body_hash)s "
+            "WHERE _id = %(_id)s;",
+            updates,
+        )
+        dbconn.commit()
+        last_id = records[-1]["_id"]  # type: ignore[assignment]
+        converted += len(records)
+        bodies_stored += len(new_bodies)
+        bytes_freed += sum(
+            len(record["body"] or record["body_blob"])  # type: ignore[arg-type]
+            for record in records
+        ) - sum(len(body["body"] or body["body_blob"]) for body in new_bodies)  # type: ignore[arg-type]
+        logger.info(
+            f"moved bodies of {converted} rows into {bodies_stored} stored bodies "
+            f"(last _id {last_id}); {bytes_freed} bytes of duplicates dropped"
+        )
+        if args.sleep > 0:
+            time.sleep(args.sleep)
+    dbcurs.close()
+
+
+# Creates the pages2_history table that DBCACHE_KEEP_VERSIONS and
+# compact_pages.py keep earlier versions of rows in, partitioned by month
+# starting with the current one, and indexes pages2's body_hash column so that
+# compact_pages.py can find bodies no row references any more.
+def migrate_history(dbconn: Connection, args: argparse.Namespace, logger: Logger) -> None:
+    ensure_columns(dbconn, {"body_hash": "BINARY(32) AFTER `body_codec`"}, logger)
+    dbcurs: DictCursor = dbconn.cursor(DictCursor)
+    dbcurs.execute(
+        "SELECT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = "
+        "DATABASE() AND TABLE_NAME = 'pages2';"
+    )
+    if "body_hash_key" not in {record["INDEX_NAME"] for record in dbcurs.fetchall()}:
+        logger.info("adding index body_hash_key to pages2")
+        dbcurs.execute(
+            "ALTER TABLE pages2 ADD KEY `body_hash_key` (`body_hash`), "
+            "ALGORITHM=INPLACE, LOCK=NONE;"
+        )
+    month: datetime = datetime.now(timezone.utc).replace(day=1)
+    next_month: datetime = (month + timedelta(days=32)).replace(day=1)
+    logger.info("creating table pages2_history if it doesn't exist")
+    dbcurs.execute(
+        "CREATE TABLE IF NOT EXISTS pages2_history ("
+        "`_id` BIGINT AUTO_INCREMENT NOT NULL, "
+        "`url` VARCHAR(768) NOT NULL, "
+        "`url_hash` BINARY(20) NOT NULL, "
+        "`status` SMALLINT NOT NULL, "
+        "`encoding` VARCHAR(16) NOT NULL, "
+        "`headers` VARCHAR(1024), "
+        "`headers_blob` BLOB, "
+        "`date` TIMESTAMP NOT NULL, "
+        "`body` MEDIUMTEXT, "
+        "`body_blob` MEDIUMBLOB, "
+        "`body_codec` VARCHAR(8) NOT NULL DEFAULT 'text', "
+        "`body_hash` BINARY(32), "
+        "`archived_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+        "PRIMARY KEY (`_id`, `date`), "
+        "KEY `url_hash_date_key` (`url_hash`, `date`), "
+        "KEY `body_hash_key` (`body_hash`)"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci "
+        "PARTITION BY RANGE (UNIX_TIMESTAMP(`date`)) ("
+        f"PARTITION p{month:%Y%m} VALUES LESS THAN "
+        f"(UNIX_TIMESTAMP('{next_month:%Y-%m-%d} 00:00:00')), "
+        "PARTITION pmax VALUES LESS THAN MAXVALUE);"
+    )
+    dbcurs.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Migrate rows of the scraping.pages2 table to a new format."
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="rows to convert per transaction"
+    )
+    parser.add_argument(
+        "--sleep",
+        type=float,
+        default=0.0,
+        help="seconds to pause between batches, to throttle the migration",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compress_parser = subparsers.add_parser(
+        "compress", help="store page bodies with a different body codec"
+    )
+    compress_parser.add_argument("codec", choices=BODY_CODECS)
+    compress_parser.add_argument(
+        "--level", type=int, default=-1, help="compression level"
+    )
+    compress_parser.set_defaults(migrate=migrate_compress)
+
+    headers_parser = subparsers.add_parser(
+        "headers", help="store response headers in a different format"
+    )
+    headers_parser.add_argument("format", choices=HEADERS_FORMATS)
+    headers_parser.set_defaults(migrate=migrate_headers)
+
+    url_hash_parser = subparsers.add_parser(
+        "url-hash", help="backfill url_hash and make it the lookup key"
+    )
+    url_hash_parser.add_argument(
+        "--drop-duplicates",
+        action="store_true",
+        help="delete all but the newest of rows whose URLs canonicalize the same",
+    )
+    url_hash_parser.add_argument(
+        "--finalize",
+        action="store_true",
+        help="make url_hash NOT NULL and drop the old url_key index",
+    )
+    url_hash_parser.set_defaults(migrate=migrate_url_hash)
+
+    dedup_bodies_parser = subparsers.add_parser(
+        "dedup-bodies", help="store each distinct page body once in the bodies table"
+    )
+    dedup_bodies_parser.set_defaults(migrate=migrate_dedup_bodies)
+
+    history_parser = subparsers.add_parser(
+        "history", help="create the pages2_history table for DBCACHE_KEEP_VERSIONS"
+    )
+    history_parser.set_defaults(migrate=migrate_history)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
+    logger.info("opening connection to database")
+    dbconn: Connection = open_connection()
+    try:
+        args.migrate(dbconn, args, logger)
+    finally:
+        dbconn.close()
+
+
+if __name__ == "__main__":
+    main()
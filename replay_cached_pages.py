@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import sys
+
+from logging import Logger
+from scrapy import Spider  # type: ignore[import-untyped]
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from scrapy.utils.misc import load_object  # type: ignore[import-untyped]
+from scrapy.utils.project import get_project_settings  # type: ignore[import-untyped]
+from scrdbcaching import ReplayEngine, set_up_logging
+from scrdbcaching.backends import CacheBackend, load_backend
+from typing import Any
+
+
+# Re-parses pages in the scraping.pages2 table with a spider's current
+# callbacks, without recrawling; see scrdbcaching.ReplayEngine. It's run from
+# the scrapy project directory, like `scrapy crawl`, and uses the project's
+# settings, spiders and ITEM_PIPELINES.
+#
+# Every row in an _id range and/or matching a SQL LIKE pattern on the URL is
+# handed to --callback, spread over --processes processes. With --follow the
+# selected rows are only where replaying starts, and the requests the
+# callbacks make are followed through the cache to their own callbacks.
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Re-run a spider's callbacks over pages cached in the "
+        "scraping.pages2 table."
+    )
+    parser.add_argument(
+        "spider", help="the name of a spider in the project, or its import path"
+    )
+    parser.add_argument(
+        "--start-id", type=int, default=None, help="replay rows from this _id on"
+    )
+    parser.add_argument(
+        "--end-id", type=int, default=None, help="replay rows up to this _id"
+    )
+    parser.add_argument(
+        "--url-pattern",
+        default=None,
+        help="replay rows whose URLs match this SQL LIKE pattern",
+    )
+    parser.add_argument(
+        "--callback",
+        default="parse",
+        help="the spider method the selected rows are handed to",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="follow the requests the callbacks make through the cache",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes running callbacks",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="rows sent to a worker at a time"
+    )
+    parser.add_argument(
+        "-a",
+        dest="spider_args",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set a spider argument (may be repeated)",
+    )
+    parser.add_argument(
+        "-s",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set or override a setting (may be repeated)",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    for option in args.spider_args + args.settings:
+        if "=" not in option:
+            parser.error(f"'{option}' isn't of the form NAME=VALUE")
+    return args
+
+
+def load_spidercls(name: str, settings: Settings) -> type[Spider]:
+    if "." in name:
+        return load_object(name)  # type: ignore[no-any-return]
+    spider_loader: Any = load_object(settings["SPIDER_LOADER_CLASS"]).from_settings(
+        settings
+    )
+    return spider_loader.load(name)  # type: ignore[no-any-return]
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
+
+    settings: Settings = get_project_settings()
+    settings.setdict(
+        dict(option.split("=", 1) for option in args.settings), priority="cmdline"
+    )
+    spidercls: type[Spider] = load_spidercls(args.spider, settings)
+
+    logger.info("opening connection to database")
+    backend: CacheBackend = load_backend(settings, "replay_cached_pages")
+    engine: ReplayEngine = ReplayEngine(
+        spidercls,
+        settings,
+        backend,
+        spider_kwargs=dict(option.split("=", 1) for option in args.spider_args),
+        processes=args.processes,
+        batch_size=args.batch_size,
+        callback=args.callback,
+        follow=args.follow,
+    )
+    try:
+        stats: dict[str, Any] = engine.run(
+            backend.iter_range(
+                start_id=args.start_id,
+                end_id=args.end_id,
+                batch_size=max(args.batch_size, 1000),
+                url_like=args.url_pattern,
+            )
+        )
+    finally:
+        backend.close()
+    for key, value in sorted(stats.items()):
+        logger.info(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,329 @@
 #!/usr/bin/python3
 
-import decouple
+import argparse
+import gzip
+import io
 import os
 import sys
+import tarfile
+import time
+import uuid
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from http import HTTPStatus
 from logging import Logger
-from MySQLdb.cursors import DictCursor
-from MySQLdb import Connect, Connection
-from scrdbcaching import set_up_logging, text2slug
+from scrdbcaching import body_from_row, headers_from_row, set_up_logging, text2slug
+from scrdbcaching.backends import CacheBackend, load_backend, settings_from_env
+from typing import Any, Callable, Iterable, Iterator
 
 
-MYSQL_USERNAME: str = decouple.config("MYSQL_USERNAME")
-MYSQL_PASSWORD: str = decouple.config("MYSQL_PASSWORD")
-MYSQL_DATABASE: str = decouple.config("MYSQL_DATABASE")
-MYSQL_HOST: str = decouple.config("MYSQL_HOST")
-MYSQL_CHARSET: str = decouple.config("MYSQL_CHARSET")
+# Exports the bodies of rows of the scraping.pages2 table, either one file per
+# row into a directory, or all into a single tar or WARC archive.
+#
+# Rows are picked either by listing their _ids, or by an _id range and/or a SQL
+# LIKE pattern on the URL. The latter are streamed from the database in
+# --batch-size batches over a single query rather than being fetched one at a
+# time. Decompressing the bodies and writing the files is done on a pool of
+# --threads threads, with only a bounded number of rows in flight at once, so
+# memory use stays flat however many rows are exported.
 
 
-if len(sys.argv) < 3:
-    print(
-        "Please specify at minimum 2 arguments: a directory and a numerical "
-        "ID of a row in the scraping.pages2 MySQL database."
+# The response headers that describe the body as it came over the wire rather
+# than as it's stored, which is decoded and whole; they're left out of WARC
+# records, and Content-Length is replaced with the stored body's length.
+WARC_DROPPED_HEADERS: frozenset[bytes] = frozenset(
+    (b"content-encoding", b"content-length", b"transfer-encoding")
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Export page bodies from the scraping.pages2 table to files."
+    )
+    parser.add_argument(
+        "dest",
+        help="the directory to write a file per row to, or with --archive the "
+        "archive file to write",
+    )
+    parser.add_argument(
+        "ids", nargs="*", type=int, help="_ids of the rows to export"
+    )
+    parser.add_argument(
+        "--start-id", type=int, default=None, help="export rows from this _id on"
+    )
+    parser.add_argument(
+        "--end-id", type=int, default=None, help="export rows up to this _id"
     )
-    exit(1)
+    parser.add_argument(
+        "--url-pattern",
+        default=None,
+        help="export rows whose URLs match this SQL LIKE pattern",
+    )
+    parser.add_argument(
+        "--archive",
+        choices=("tar", "warc"),
+        default=None,
+        help="write a single archive of this type instead of a file per row; "
+        "it's gzipped if its name ends in .gz",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="rows fetched per round trip"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="threads writing files"
+    )
+    args: argparse.Namespace = parser.parse_args()
+    ranged: bool = (
+        args.start_id is not None
+        or args.end_id is not None
+        or args.url_pattern is not None
+    )
+    if args.ids and ranged:
+        parser.error("_ids can't be given along with --start-id, --end-id or --url-pattern")
+    if not args.ids and not ranged:
+        parser.error(
+            "give either one or more _ids, or at least one of --start-id, "
+            "--end-id and --url-pattern"
+        )
+    if args.archive is None and not os.path.isdir(args.dest):
+        parser.error("dest must be a path to a directory that exists")
+    return args
 
-dir: str = sys.argv[1]
 
-if not os.path.exists(dir):
-    print("The first argument must be a path to a directory that exists.")
-    exit(1)
+# Yields the selected rows. Listed _ids are each fetched on their own, and an
+# _id that doesn't exist is an error; a range or pattern is streamed.
+def iter_rows(backend: CacheBackend, args: argparse.Namespace) -> Iterator[dict[str, Any]]:
+    if not args.ids:
+        yield from backend.iter_range(
+            start_id=args.start_id,
+            end_id=args.end_id,
+            batch_size=args.batch_size,
+            url_like=args.url_pattern,
+        )
+        return
+    for _id in args.ids:
+        record: None | dict[str, Any] = next(
+            backend.iter_range(start_id=_id, end_id=_id), None
+        )
+        if record is None:
+            print(
+                f"ERROR: value of _id {_id} does not correspond to a row in the "
+                "scraping.pages2 table!"
+            )
+            exit(1)
+        yield record
 
-ids: list[str | int] = list(sys.argv[2:])
 
-try:
-    for i in range(len(ids)):
-        ids[i] = int(ids[i])
-except ValueError:
-    print(
-        f"Every argument after the first must be an integer. (Argument "
-        f"'{ids[i]}' is not an integer."
-    )
-    exit(1)
+# Like executor.map(), but only submits up to `window` items ahead of the
+# result being consumed, rather than the whole iterable at once. Results are
+# yielded in order.
+def bounded_map(
+    executor: ThreadPoolExecutor,
+    func: Callable[[dict[str, Any]], Any],
+    items: Iterable[dict[str, Any]],
+    window: int,
+) -> Iterator[Any]:
+    pending: deque[Future] = deque()  # type: ignore[type-arg]
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
 
-logger.info("opening connection to database")
+def file_name(record: dict[str, Any]) -> str:
+    url_slug: str = text2slug(record["url"])
+    if not url_slug.endswith((".html", ".htm")):
+        url_slug += ".html"
+    return url_slug
 
-dbconn: Connection = Connect(
-    user=MYSQL_USERNAME,
-    password=MYSQL_PASSWORD,
-    database=MYSQL_DATABASE,
-    host=MYSQL_HOST,
-    charset=MYSQL_CHARSET,
-)
-dbcurs: DictCursor = dbconn.cursor(DictCursor)
 
-for _id in ids:
-    dbcurs.execute(
-        "SELECT url, body FROM pages2 WHERE _id = %(_id)s;", dict(_id=_id)
+# Writes a row's body to its own file in the directory. The body is written
+# out in the page's own encoding, decompressing it first if it was stored
+# compressed.
+def write_file(directory: str, record: dict[str, Any]) -> tuple[int, str, int]:
+    filename: str = os.path.join(directory, file_name(record))
+    body: bytes = body_from_row(record)
+    with open(filename, "wb") as fh:
+        fh.write(body)
+    return record["_id"], filename, len(body)
+
+
+def record_date(record: dict[str, Any]) -> datetime:
+    date: datetime | None = record.get("date")
+    if date is None:
+        return datetime.now(timezone.utc)
+    return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+
+def warc_record(warc_type: str, headers: dict[str, str], payload: bytes) -> bytes:
+    header_lines: list[str] = [
+        "WARC/1.0",
+        f"WARC-Type: {warc_type}",
+        f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>",
+    ]
+    header_lines.extend(f"{key}: {value}" for key, value in headers.items())
+    header_lines.append(f"Content-Length: {len(payload)}")
+    return "\r\n".join(header_lines).encode("utf-8") + b"\r\n\r\n" + payload + b"\r\n\r\n"
+
+
+def warc_date(date: datetime) -> str:
+    return date.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# Renders a row as a WARC response record, holding the response's status line,
+# headers and body as an HTTP message.
+def warc_response(record: dict[str, Any]) -> bytes:
+    body: bytes = body_from_row(record)
+    try:
+        reason: str = HTTPStatus(record["status"]).phrase
+    except ValueError:
+        reason = ""
+    http_lines: list[bytes] = [f"HTTP/1.1 {record['status']} {reason}".encode("utf-8")]
+    for key, values in headers_from_row(record).items():
+        if key.lower() in WARC_DROPPED_HEADERS:
+            continue
+        http_lines.extend(key + b": " + value for value in values)
+    http_lines.append(b"Content-Length: %d" % len(body))
+    return warc_record(
+        "response",
+        {
+            "WARC-Date": warc_date(record_date(record)),
+            "WARC-Target-URI": record["url"],
+            "Content-Type": "application/http; msgtype=response",
+        },
+        b"\r\n".join(http_lines) + b"\r\n\r\n" + body,
     )
-    record: None | dict[str, str] = dbcurs.fetchone()
-    if record is None:
-        print(
-            f"ERROR: value of _id {_id} does not correspond to a row in the "
-            "scraping.pages2 table!"
+
+
+# Writes rows to a WARC file. Each record is rendered, and gzipped on its own
+# if the file is to be gzipped (as .warc.gz readers expect), on the thread
+# pool; only appending them to the file happens in order on the main thread.
+class WarcArchive:
+    fh: io.BufferedWriter
+    compress: bool
+
+    def __init__(self, path: str) -> None:
+        self.fh = open(path, "wb")
+        self.compress = path.endswith(".gz")
+        self.fh.write(
+            self._encode(
+                warc_record(
+                    "warcinfo",
+                    {
+                        "WARC-Date": warc_date(datetime.now(timezone.utc)),
+                        "WARC-Filename": os.path.basename(path),
+                        "Content-Type": "application/warc-fields",
+                    },
+                    b"software: scraped_docs_db_to_file.py\r\nformat: WARC File Format 1.0\r\n",
+                )
+            )
         )
-        exit(1)
-    url_slug = text2slug(record["url"])
-    if not url_slug.endswith((".html", ".htm")):
-        url_slug += ".html"
-    filename = os.path.join(dir, url_slug)
-    with open(filename, "wt") as fh:
-        fh.write(record["body"])
-    logger.info(f"id {_id}: wrote {len(record['body'])} bytes to file {filename}")
 
+    def _encode(self, data: bytes) -> bytes:
+        return gzip.compress(data) if self.compress else data
+
+    def render(self, record: dict[str, Any]) -> tuple[int, bytes]:
+        return record["_id"], self._encode(warc_response(record))
+
+    def append(self, rendered: tuple[int, bytes]) -> int:
+        self.fh.write(rendered[1])
+        return len(rendered[1])
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+# Writes rows to a tar file, one member per row named as the file would have
+# been. Bodies are decompressed on the thread pool; the tar stream itself,
+# gzipped if its name ends in .gz, is written on the main thread.
+class TarArchive:
+    tar: tarfile.TarFile
+
+    def __init__(self, path: str) -> None:
+        self.tar = tarfile.open(path, "w:gz" if path.endswith(".gz") else "w")
+
+    def render(self, record: dict[str, Any]) -> tuple[tarfile.TarInfo, bytes]:
+        body: bytes = body_from_row(record)
+        info: tarfile.TarInfo = tarfile.TarInfo(name=file_name(record))
+        info.size = len(body)
+        info.mtime = int(record_date(record).timestamp())
+        return info, body
+
+    def append(self, rendered: tuple[tarfile.TarInfo, bytes]) -> int:
+        info, body = rendered
+        self.tar.addfile(info, io.BytesIO(body))
+        return info.size
+
+    def close(self) -> None:
+        self.tar.close()
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logger: Logger = set_up_logging(sys.argv[0].removesuffix((".py")))
+
+    logger.info("opening connection to database")
+
+    # The page cache backend is picked by the DBCACHE_BACKEND setting, read
+    # from the environment or the .env file along with the MySQL credentials.
+    backend: CacheBackend = load_backend(settings_from_env(), "scraped_docs_db_to_file")
+
+    archive: WarcArchive | TarArchive | None = None
+    if args.archive == "warc":
+        archive = WarcArchive(args.dest)
+    elif args.archive == "tar":
+        archive = TarArchive(args.dest)
+
+    # Twice as many rows in flight as there are threads keeps every thread
+    # busy while the next batch is being fetched.
+    window: int = max(args.threads, 1) * 2
+    row_count: int = 0
+    byte_count: int = 0
+    start_time: float = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(args.threads, 1)) as executor:
+            if archive is None:
+                for _id, filename, size in bounded_map(
+                    executor,
+                    lambda record: write_file(args.dest, record),
+                    iter_rows(backend, args),
+                    window,
+                ):
+                    row_count += 1
+                    byte_count += size
+                    if args.ids:
+                        logger.info(f"id {_id}: wrote {size} bytes to file {filename}")
+                    elif row_count % args.batch_size == 0:
+                        logger.info(
+                            f"wrote {row_count} rows, {byte_count} bytes; "
+                            f"{row_count / (time.monotonic() - start_time):.1f} rows/s"
+                        )
+            else:
+                for rendered in bounded_map(
+                    executor, archive.render, iter_rows(backend, args), window
+                ):
+                    row_count += 1
+                    byte_count += archive.append(rendered)  # type: ignore[arg-type]
+                    if row_count % args.batch_size == 0:
+                        logger.info(
+                            f"archived {row_count} rows, {byte_count} bytes; "
+                            f"{row_count / (time.monotonic() - start_time):.1f} rows/s"
+                        )
+    finally:
+        if archive is not None:
+            archive.close()
+        backend.close()
+
+    elapsed: float = time.monotonic() - start_time
+    logger.info(
+        f"exported {row_count} rows, {byte_count} bytes, in {elapsed:.2f}s "
+        f"({row_count / elapsed if elapsed > 0 else 0:.1f} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,59 @@
 #!/usr/bin/python3
 
+from .backends import CacheBackend, load_backend
+from .batching import LookupBatcher
+from .bloom import BloomFilter
+from .compression import body_from_row, compress_body, decompress_body
+from .credits import CreditLedger, FileCreditLedger, load_credit_ledger
+from .headers import headers_from_row, pack_headers, unpack_headers
 from .items import SerializableItem
-from .middlewares import DatabaseCachingMiddleware
+from .memcache import LruRowCache
+from .middlewares import DatabaseCachingMiddleware, RenderingRateLimitingMiddleware
 from .pipelines import SerializingDatabasePipeline
+from .ratelimit import TokenBucket
+from .replay import ReplayEngine
+from .sharding import ShardingMiddleware, shard_of
 from .spider import UrlSetSpider
-from .utility import join_strs_w_comma_conj, set_up_logging, text2slug
+from .stats import CacheStats
+from .utility import (
+    canonical_url,
+    debug_logging_enabled,
+    join_strs_w_comma_conj,
+    set_up_logging,
+    text2slug,
+    url_digest,
+)
 
 
 __all__ = (
     "SerializableItem",
+    "CacheBackend",
+    "load_backend",
+    "LruRowCache",
+    "LookupBatcher",
+    "BloomFilter",
+    "body_from_row",
+    "compress_body",
+    "decompress_body",
+    "headers_from_row",
+    "pack_headers",
+    "unpack_headers",
     "DatabaseCachingMiddleware",
+    "RenderingRateLimitingMiddleware",
+    "TokenBucket",
+    "CreditLedger",
+    "FileCreditLedger",
+    "load_credit_ledger",
+    "ShardingMiddleware",
+    "shard_of",
+    "ReplayEngine",
+    "CacheStats",
     "SerializingDatabasePipeline",
     "UrlSetSpider",
+    "canonical_url",
+    "debug_logging_enabled",
     "join_strs_w_comma_conj",
     "set_up_logging",
     "text2slug",
+    "url_digest",
 )
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from scrapy.utils.misc import load_object  # type: ignore[import-untyped]
+from typing import Any
+
+from .base import CacheBackend, ROW_COLUMNS
+
+
+__all__ = ("CacheBackend", "ROW_COLUMNS", "load_backend", "settings_from_env")
+
+
+# The backends that can be picked by name with the DBCACHE_BACKEND setting.
+# Their modules are only imported when they're picked, so a backend's driver
+# doesn't need to be installed unless it's used.
+BACKENDS: dict[str, str] = {
+    "mysql": "scrdbcaching.backends.mysql.MySQLBackend",
+    "sqlite": "scrdbcaching.backends.sqlite.SQLiteBackend",
+}
+
+
+# Instances the page cache backend named by the DBCACHE_BACKEND setting: one of
+# the names in BACKENDS, or the import path of a CacheBackend subclass. It
+# defaults to "mysql". The name is used to label the backend's resources, such
+# as its connection pool. Backends loaded for the same crawler share their
+# connection pools.
+def load_backend(settings: Any, name: str, crawler: Any = None) -> CacheBackend:
+    backend: str = settings.get("DBCACHE_BACKEND", "mysql")
+    backend_cls: type[CacheBackend] = load_object(BACKENDS.get(backend, backend))
+    return backend_cls.from_settings(settings, name, crawler)
+
+
+# The settings the backends read, for scripts that run outside of scrapy and so
+# have no project settings.
+ENV_SETTINGS: tuple[str, ...] = (
+    "MYSQL_USERNAME",
+    "MYSQL_PASSWORD",
+    "MYSQL_DATABASE",
+    "MYSQL_HOST",
+    "MYSQL_CHARSET",
+    "MYSQL_REPLICA_HOST",
+    "DBCACHE_BACKEND",
+    "DBCACHE_SQLITE_PATH",
+    "DBCACHE_SQLITE_MMAP_SIZE",
+    "DBCACHE_URL_HASH_KEY",
+    "DBCACHE_DEDUP_BODIES",
+    "DBCACHE_BODY_CODEC",
+    "DBCACHE_BODY_COMPRESSION_LEVEL",
+    "DBCACHE_HEADERS_FORMAT",
+    "DBCACHE_KEEP_VERSIONS",
+    "DBCACHE_RETENTION_MAX_AGE",
+    "DBCACHE_RETENTION_POLICY",
+    "DBCACHE_POOL_SIZE",
+    "DBCACHE_POOL_RECYCLE",
+    "DBCACHE_POOL_PING_INTERVAL",
+    "DBCACHE_POOL_TIMEOUT",
+)
+
+
+# Builds a Settings object for load_backend() from the environment or a .env
+# file, read with python-decouple the same way the scripts read the MySQL
+# credentials. Any keyword arguments are set on top.
+def settings_from_env(**overrides: Any) -> Settings:
+    import decouple
+
+    settings: Settings = Settings({"CONCURRENT_REQUESTS": 1})
+    for name in ENV_SETTINGS:
+        value: str | None = decouple.config(name, default=None)
+        if value is not None:
+            settings.set(name, value)
+    settings.setdict(overrides)
+    return settings
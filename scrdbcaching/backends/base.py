@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+import logging
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Iterator
+
+from ..compression import body_digest
+from ..stats import CacheStats
+from ..utility import canonical_url, url_digest
+
+
+__all__ = ("BODY_COLUMNS", "CacheBackend", "HISTORY_COLUMNS", "ROW_COLUMNS")
+
+
+# The columns of a pages2 row that a cache lookup returns. Rows are passed
+# around as dicts with these keys; rows from iter_range() also have `_id`.
+ROW_COLUMNS: tuple[str, ...] = (
+    "url",
+    "date",
+    "status",
+    "encoding",
+    "headers",
+    "headers_blob",
+    "body",
+    "body_blob",
+    "body_codec",
+)
+
+# The columns put_many() writes. Rows handed to it are dicts as returned by
+# SerializableItem.to_dict().
+INSERT_COLUMNS: tuple[str, ...] = (
+    "url",
+    "status",
+    "encoding",
+    "headers",
+    "headers_blob",
+    "date",
+    "body",
+    "body_blob",
+    "body_codec",
+)
+
+# The columns that hold a row's body. If bodies are deduplicated they're kept
+# in the bodies table, keyed by body_digest(), and the pages2 row only holds
+# the digest in its body_hash column.
+BODY_COLUMNS: tuple[str, ...] = ("body", "body_blob", "body_codec")
+
+# The columns of a pages2 row that are copied into pages2_history when it's
+# archived. History rows are always keyed by url_hash.
+HISTORY_COLUMNS: tuple[str, ...] = INSERT_COLUMNS + ("url_hash", "body_hash")
+
+
+# The interface DatabaseCachingMiddleware, SerializingDatabasePipeline and the
+# scripts use to read and write the page cache, so that where it's stored can
+# be chosen with the DBCACHE_BACKEND setting. Subclasses implement get_many(),
+# put_many(), touch(), iter_range(), iter_keys() and count(), and a
+# from_settings() classmethod that load_backend() instances them with.
+#
+# get() and get_many() may be called from several threads at once, so
+# implementations have to be thread-safe.
+#
+# If dedup_bodies is True, each distinct body is stored once in the bodies
+# table and rows reference it by digest; see select_rows_sql() and
+# split_bodies(), which implementations use to read and write that layout.
+#
+# If keep_versions is nonzero, a row that put_many() replaces is first copied
+# into the pages2_history table, in the same transaction, so that older
+# versions of a page are kept while pages2 only ever holds the newest, which
+# is the one that's served. compact_pages.py trims the history down to
+# keep_versions versions per URL. expire_batch(), trim_history_batch(),
+# delete_orphan_bodies_batch() and rotate_history_partitions() are the
+# maintenance operations it's built on; each batch is a short transaction of
+# its own, so they can run against a live table.
+#
+# Implementations record how long their queries take, and anything else worth
+# timing, to `stats`. It does nothing until the middleware or pipeline using
+# the backend swaps in one that publishes to the crawler's stats collector.
+class CacheBackend:
+    url_hash_key: bool
+    dedup_bodies: bool
+    keep_versions: int
+    stats: CacheStats
+
+    def __init__(
+        self, url_hash_key: bool = False, dedup_bodies: bool = False, keep_versions: int = 0
+    ) -> None:
+        self.url_hash_key = url_hash_key
+        self.dedup_bodies = dedup_bodies
+        self.keep_versions = max(int(keep_versions), 0)
+        self.stats = CacheStats()
+
+    # If a crawler is given, resources that can be shared between the
+    # backends opened for it, such as connection pools, are.
+    @classmethod
+    def from_settings(
+        cls, settings: Any, name: str, crawler: Any = None
+    ) -> "CacheBackend":
+        raise NotImplementedError
+
+    # Returns the row for a URL, or None if there isn't one.
+    def get(self, url: str) -> dict[str, Any] | None:
+        return self.get_many([url]).get(url)
+
+    # Returns a dict mapping each of the URLs that has a row to its row.
+    def get_many(self, urls: list[str]) -> dict[str, dict[str, Any]]:
+        raise NotImplementedError
+
+    # Stores rows in one transaction. on_existing says what happens to a row
+    # whose URL is already stored: "error" makes it an error, "ignore" leaves
+    # the stored row as it is, and "replace" overwrites it.
+    def put_many(
+        self, rows: Iterable[dict[str, Any]], on_existing: str = "error"
+    ) -> None:
+        raise NotImplementedError
+
+    # Sets the date of the row for a URL, marking it as fresh as of then.
+    def touch(self, url: str, date: datetime) -> None:
+        raise NotImplementedError
+
+    # Yields every row with an _id between start_id and end_id inclusive, in
+    # _id order, fetching them batch_size at a time. Either bound can be None.
+    # If url_like is given, only rows whose URLs match that SQL LIKE pattern
+    # are yielded.
+    def iter_range(
+        self,
+        start_id: int | None = None,
+        end_id: int | None = None,
+        batch_size: int = 1000,
+        url_like: str | None = None,
+    ) -> Iterator[dict[str, Any]]:
+        raise NotImplementedError
+
+    # Yields the lookup key of every row: its url_hash if the backend is keyed
+    # by url_hash, or its url otherwise. Used to build the URL membership
+    # filter.
+    def iter_keys(self, batch_size: int = 10_000) -> Iterator[str | bytes]:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    # Walks pages2 in _id order, `limit` rows from the one after `after` at a
+    # time, and deletes the rows of the batch for which expired(status, date)
+    # is True, copying them into pages2_history first if archive is True. A
+    # row that's replaced between being read and being deleted is left alone.
+    # Returns how many rows were deleted and the _id to carry on after, which
+    # is None once the end of the table has been reached.
+    def expire_batch(
+        self,
+        expired: Callable[[int, datetime | None], bool],
+        after: int = 0,
+        limit: int = 1000,
+        archive: bool = False,
+    ) -> tuple[int, int | None]:
+        raise NotImplementedError
+
+    # Deletes the history rows of the URLs whose url_hash comes after `after`,
+    # up to about `limit` rows' worth, that are older than the newest `keep`
+    # versions of their URL if keep isn't None, or dated before `before` if
+    # that isn't None. Returns how many were deleted and the url_hash to carry
+    # on after, which is None once the end of the table has been reached.
+    def trim_history_batch(
+        self,
+        keep: int | None,
+        before: datetime | None,
+        after: bytes = b"",
+        limit: int = 1000,
+    ) -> tuple[int, bytes | None]:
+        raise NotImplementedError
+
+    # Deletes the stored bodies, out of the next `limit` after `after` by
+    # body_hash, that no row of pages2 or pages2_history references any more.
+    # Returns how many were deleted and the body_hash to carry on after, which
+    # is None once the end of the table has been reached.
+    def delete_orphan_bodies_batch(
+        self, after: bytes = b"", limit: int = 1000
+    ) -> tuple[int, bytes | None]:
+        raise NotImplementedError
+
+    # If pages2_history is partitioned by date, drops the partitions that only
+    # hold rows dated before `before`, which is much cheaper than deleting
+    # them, adds partitions for the next `months_ahead` months if they're
+    # missing, and returns the names of the dropped partitions. Backends whose
+    # history isn't partitioned do nothing.
+    def rotate_history_partitions(
+        self, before: datetime, months_ahead: int = 3
+    ) -> list[str]:
+        return list()
+
+    # Wraps a bulk load: many put_many() calls in a row, all from the calling
+    # thread, during which the backend may trade durability or per-row
+    # checking for speed. If unchecked is True, the caller guarantees that
+    # none of the rows it stores are already stored or repeat each other, so
+    # unique key checks can be skipped where the database allows it. If
+    # durable is True, every put_many() must be on disk once it returns, as it
+    # is outside a bulk load, since the caller records its progress as it goes.
+    @contextmanager
+    def bulk_load(self, unchecked: bool = False, durable: bool = False) -> Iterator[None]:
+        yield
+
+    # The start of a SELECT of the given columns of pages2 rows, up to where
+    # its WHERE clause would go. If bodies are deduplicated, the bodies table
+    # is joined in to fill in the body columns of rows that reference a
+    # stored body; rows stored before deduplication was turned on still have
+    # their own. The bodies table has none of pages2's other columns, so the
+    # WHERE clause needn't qualify them.
+    def select_rows_sql(self, columns: tuple[str, ...]) -> str:
+        if not self.dedup_bodies:
+            return f"SELECT {', '.join(columns)} FROM pages2"
+        select: str = ", ".join(
+            f"COALESCE(bodies.{column}, pages2.{column})"
+            if column in BODY_COLUMNS
+            else f"pages2.{column}"
+            for column in columns
+        )
+        return (
+            f"SELECT {select} FROM pages2 "
+            "LEFT JOIN bodies ON bodies.body_hash = pages2.body_hash"
+        )
+
+    # Splits rows to be stored with deduplicated bodies into the pages2 rows,
+    # whose bodies are replaced by their body_hash, and the distinct bodies,
+    # keyed by digest.
+    @staticmethod
+    def split_bodies(
+        rows: Iterable[dict[str, Any]],
+    ) -> tuple[list[dict[str, Any]], dict[bytes, dict[str, Any]]]:
+        page_rows: list[dict[str, Any]] = list()
+        bodies: dict[bytes, dict[str, Any]] = dict()
+        for row in rows:
+            digest: bytes = body_digest(row)
+            bodies.setdefault(
+                digest, {column: row[column] for column in BODY_COLUMNS}
+            )
+            page_rows.append(dict(row, body=None, body_blob=None, body_hash=digest))
+        return page_rows, bodies
+
+    # Dates from the database can come back naive, in which case they're UTC,
+    # as DatabaseCachingMiddleware takes them to be.
+    @staticmethod
+    def utc_date(date: datetime | None) -> datetime | None:
+        if date is not None and date.tzinfo is None:
+            return date.replace(tzinfo=timezone.utc)
+        return date
+
+    # The key a URL is looked up by, as yielded by iter_keys().
+    def key_for(self, url: str) -> str | bytes:
+        return url_digest(url) if self.url_hash_key else url
+
+    # Checks that a row found by url_hash really is for the requested URL,
+    # rather than for a different URL whose digest collides with it.
+    @staticmethod
+    def same_url(row_url: str, url: str) -> bool:
+        if row_url == url or canonical_url(row_url) == canonical_url(url):
+            return True
+        logging.warning(
+            f"CacheBackend.same_url(): url_hash of URL '{url}' collides with "
+            f"that of stored URL '{row_url}'; treating as a miss"
+        )
+        return False
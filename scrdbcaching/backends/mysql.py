@@ -0,0 +1,598 @@
+#!/usr/bin/python3
+
+import threading
+
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from mysql.connector.abstracts import MySQLConnectionAbstract
+from mysql.connector.cursor import MySQLCursor
+from mysql.connector.errors import Error
+from typing import Any, Callable, Iterable, Iterator
+
+from ..utility import url_digest
+from .base import BODY_COLUMNS, CacheBackend, HISTORY_COLUMNS, INSERT_COLUMNS, ROW_COLUMNS
+from .pool import ConnectionPool, PooledConnection, shared_pool
+
+
+__all__ = ("MySQLBackend",)
+
+
+# The original page cache: the pages2 table of a MySQL database, reached
+# through a ConnectionPool. Rows are looked up by url, or by url_hash if
+# url_hash_key is True. If dedup_bodies is True, bodies are kept in the bodies
+# table (see pages2.sql), and a body that's already there isn't sent to the
+# server again.
+#
+# If read_pool is given, lookups (get(), get_many(), iter_range(), iter_keys()
+# and count()) go to it, normally a pool of connections to a read replica,
+# and only writes go to `pool`. A replica may lag behind the primary, so a
+# page stored moments ago can still be a miss there.
+#
+# If keep_versions is nonzero, replaced rows are kept in pages2_history, which
+# is keyed by url_hash, so url_hash_key has to be True too. pages2.sql
+# partitions pages2_history by month, and rotate_history_partitions() drops and
+# adds partitions as the history ages; the months are those of the server's
+# time zone.
+class MySQLBackend(CacheBackend):
+    pool: ConnectionPool
+    read_pool: ConnectionPool | None
+    closed: bool
+    local: threading.local
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        read_pool: ConnectionPool | None = None,
+        url_hash_key: bool = False,
+        dedup_bodies: bool = False,
+        keep_versions: int = 0,
+    ) -> None:
+        if keep_versions and not url_hash_key:
+            raise ValueError(
+                "DBCACHE_KEEP_VERSIONS setting needs DBCACHE_URL_HASH_KEY to be True"
+            )
+        super().__init__(url_hash_key, dedup_bodies, keep_versions)
+        self.pool = pool
+        self.read_pool = read_pool
+        self.closed = False
+        # Holds the connection a thread's bulk load is pinned to.
+        self.local = threading.local()
+
+    # The pool is sized by DBCACHE_POOL_SIZE, which defaults to
+    # CONCURRENT_REQUESTS. Connections are recycled after DBCACHE_POOL_RECYCLE
+    # seconds, pinged if they've been idle for DBCACHE_POOL_PING_INTERVAL
+    # seconds, and a checkout waits up to DBCACHE_POOL_TIMEOUT seconds for one
+    # to be free. If MYSQL_REPLICA_HOST is set, lookups go to a second pool of
+    # the same size connected to that host, with the same credentials.
+    #
+    # If a crawler is given, the pools are shared with every other backend
+    # opened for it, so the middleware and the pipeline draw on the same
+    # connections; otherwise the backend has pools of its own, named `name`.
+    @classmethod
+    def from_settings(
+        cls, settings: Any, name: str, crawler: Any = None
+    ) -> "MySQLBackend":
+        connect_args: dict[str, Any] = dict(
+            user=settings.get("MYSQL_USERNAME"),
+            password=settings.get("MYSQL_PASSWORD"),
+            host=settings.get("MYSQL_HOST"),
+            database=settings.get("MYSQL_DATABASE"),
+            charset=settings.get("MYSQL_CHARSET"),
+        )
+        replica_host: str | None = settings.get("MYSQL_REPLICA_HOST") or None
+
+        def pool_for(role: str, host: str) -> ConnectionPool:
+            def factory() -> ConnectionPool:
+                return ConnectionPool(
+                    name=f"dbcache-{role}" if crawler is not None else f"{name}-{role}",
+                    size=settings.getint("DBCACHE_POOL_SIZE", 0)
+                    or settings.getint("CONCURRENT_REQUESTS"),
+                    connect_args=dict(connect_args, host=host),
+                    recycle=settings.getfloat("DBCACHE_POOL_RECYCLE", 3600.0),
+                    ping_interval=settings.getfloat("DBCACHE_POOL_PING_INTERVAL", 30.0),
+                    timeout=settings.getfloat("DBCACHE_POOL_TIMEOUT", 30.0),
+                )
+
+            if crawler is None:
+                return factory()
+            return shared_pool(crawler, role, factory)
+
+        return cls(
+            pool=pool_for("primary", connect_args["host"]),
+            read_pool=(
+                pool_for("replica", replica_host) if replica_host is not None else None
+            ),
+            url_hash_key=settings.getbool("DBCACHE_URL_HASH_KEY", False),
+            dedup_bodies=settings.getbool("DBCACHE_DEDUP_BODIES", False),
+            keep_versions=settings.getint("DBCACHE_KEEP_VERSIONS", 0),
+        )
+
+    # Checks a connection out of the primary pool, or out of the read pool if
+    # `read` is True and there is one, for the duration of a with block,
+    # timing how long it had to wait for one. A thread in the middle of a bulk
+    # load uses the connection it's pinned to instead, for everything but
+    # reads that can go to the read pool.
+    @contextmanager
+    def _connection(self, read: bool = False) -> Iterator[MySQLConnectionAbstract]:
+        pinned: MySQLConnectionAbstract | None = getattr(self.local, "pinned", None)
+        if pinned is not None and not (read and self.read_pool is not None):
+            yield pinned
+            return
+        pool: ConnectionPool = (
+            self.read_pool if read and self.read_pool is not None else self.pool
+        )
+        with self.stats.timer("pool_wait"):
+            pooled: PooledConnection = pool.checkout()
+        broken: bool = False
+        try:
+            yield pooled.conn
+        except Error:
+            broken = not pooled.conn.is_connected()
+            raise
+        finally:
+            pool.checkin(pooled, broken)
+
+    def get(self, url: str) -> dict[str, Any] | None:
+        # Getting a connection from the pool
+        with self._connection(read=True) as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                # Checking the database for a record with this url. The columns
+                # of the pages2 table correspond to the constructor arguments
+                # needed to instance an HtmlResponse, plus 'date' for
+                # If-Modified-Since usage where needed.
+                with self.stats.timer("query"):
+                    if self.url_hash_key:
+                        db_cursor.execute(
+                            f"{self.select_rows_sql(ROW_COLUMNS)} "
+                            "WHERE url_hash = %(url_hash)s;",
+                            dict(url_hash=url_digest(url)),
+                        )
+                    else:
+                        db_cursor.execute(
+                            f"{self.select_rows_sql(ROW_COLUMNS)} WHERE url = %(url)s;",
+                            dict(url=url),
+                        )
+                    row: tuple[Any, ...] | None = db_cursor.fetchone()  # type:ignore
+            finally:
+                db_cursor.close()
+        if row is None:
+            return None
+        if self.url_hash_key and not self.same_url(row[0], url):
+            return None
+        return dict(zip(ROW_COLUMNS, row))
+
+    def get_many(self, urls: list[str]) -> dict[str, dict[str, Any]]:
+        if self.url_hash_key:
+            return self._get_many_by_hash(urls)
+        with self._connection(read=True) as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                placeholders: str = ", ".join(["%s"] * len(urls))
+                with self.stats.timer("query"):
+                    db_cursor.execute(
+                        f"{self.select_rows_sql(ROW_COLUMNS)} "
+                        f"WHERE url IN ({placeholders});",
+                        tuple(urls),
+                    )
+                    rows: dict[str, dict[str, Any]] = {
+                        row[0]: dict(zip(ROW_COLUMNS, row))  # type: ignore[index]
+                        for row in db_cursor.fetchall()
+                    }
+            finally:
+                db_cursor.close()
+        # The url column's collation is case-insensitive, so a row can match a
+        # URL that differs from it in case, just as it would with the single
+        # row lookup. Those are matched up here.
+        unmatched: list[str] = [url for url in urls if url not in rows]
+        if unmatched and len(rows) > 0:
+            rows_by_casefold: dict[str, dict[str, Any]] = {
+                key.casefold(): row for key, row in rows.items()
+            }
+            for url in unmatched:
+                if url.casefold() in rows_by_casefold:
+                    rows[url] = rows_by_casefold[url.casefold()]
+        return rows
+
+    # The url_hash equivalent of get_many(). Several of the URLs can share a
+    # digest if they canonicalize the same, so each digest maps back to a list
+    # of URLs.
+    def _get_many_by_hash(self, urls: list[str]) -> dict[str, dict[str, Any]]:
+        urls_by_digest: dict[bytes, list[str]] = dict()
+        for url in urls:
+            urls_by_digest.setdefault(url_digest(url), []).append(url)
+        with self._connection(read=True) as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                placeholders: str = ", ".join(["%s"] * len(urls_by_digest))
+                # The url_hash column is fetched too, after the usual ones, so
+                # rows can be matched up with the URLs they're for.
+                with self.stats.timer("query"):
+                    db_cursor.execute(
+                        f"{self.select_rows_sql(ROW_COLUMNS + ('url_hash',))} "
+                        f"WHERE url_hash IN ({placeholders});",
+                        tuple(urls_by_digest),
+                    )
+                    fetched: list[tuple[Any, ...]] = db_cursor.fetchall()  # type: ignore[assignment]
+            finally:
+                db_cursor.close()
+        rows: dict[str, dict[str, Any]] = dict()
+        for fetched_row in fetched:
+            row: dict[str, Any] = dict(zip(ROW_COLUMNS, fetched_row))
+            for url in urls_by_digest.get(bytes(fetched_row[-1]), []):
+                if self.same_url(row["url"], url):
+                    rows[url] = row
+        return rows
+
+    def put_many(
+        self, rows: Iterable[dict[str, Any]], on_existing: str = "error"
+    ) -> None:
+        columns: tuple[str, ...] = (
+            INSERT_COLUMNS
+            + (("url_hash",) if self.url_hash_key else ())
+            + (("body_hash",) if self.dedup_bodies else ())
+        )
+        page_rows: list[dict[str, Any]] = list(rows)
+        bodies: dict[bytes, dict[str, Any]] = dict()
+        if self.dedup_bodies:
+            page_rows, bodies = self.split_bodies(page_rows)
+        sql: str = (
+            f"INSERT INTO pages2 ({', '.join(f'`{column}`' for column in columns)}) "
+            f"VALUES ({', '.join(f'%({column})s' for column in columns)})"
+        )
+        if on_existing == "ignore":
+            sql += " ON DUPLICATE KEY UPDATE `_id` = `_id`"
+        elif on_existing == "replace":
+            sql += " ON DUPLICATE KEY UPDATE " + ", ".join(
+                f"`{column}` = VALUES(`{column}`)" for column in columns
+            )
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                if bodies:
+                    self._put_bodies(db_cursor, bodies, len(page_rows))
+                if on_existing == "replace" and self.keep_versions:
+                    digests: set[bytes] = {url_digest(row["url"]) for row in page_rows}
+                    with self.stats.timer("archive"):
+                        db_cursor.execute(
+                            f"{self._archive_sql()} WHERE url_hash IN "
+                            f"({', '.join(['%s'] * len(digests))});",
+                            tuple(digests),
+                        )
+                # mysql.connector rewrites an executemany() of an INSERT into a
+                # single multi-row INSERT statement.
+                with self.stats.timer("insert"):
+                    db_cursor.executemany(sql, page_rows)
+                with self.stats.timer("commit"):
+                    db_conn.commit()
+            finally:
+                # Any transaction left open by a failure is rolled back when
+                # the connection goes back in the pool.
+                db_cursor.close()
+
+    # Stores whichever of the bodies the bodies table doesn't have yet, in the
+    # same transaction as the rows that reference them. The ones it has are
+    # never sent. Another writer could store the same body in between, so a
+    # duplicate is ignored rather than being an error.
+    def _put_bodies(
+        self, db_cursor: MySQLCursor, bodies: dict[bytes, dict[str, Any]], row_count: int
+    ) -> None:
+        placeholders: str = ", ".join(["%s"] * len(bodies))
+        db_cursor.execute(
+            f"SELECT body_hash FROM bodies WHERE body_hash IN ({placeholders});",
+            tuple(bodies),
+        )
+        stored: set[bytes] = {bytes(digest) for (digest,) in db_cursor.fetchall()}  # type: ignore[misc]
+        new_bodies: list[dict[str, Any]] = [
+            dict(body, body_hash=digest)
+            for digest, body in bodies.items()
+            if digest not in stored
+        ]
+        self.stats.inc("bodies_deduplicated", row_count - len(new_bodies))
+        if not new_bodies:
+            return
+        columns: tuple[str, ...] = ("body_hash",) + BODY_COLUMNS
+        with self.stats.timer("insert_bodies"):
+            db_cursor.executemany(
+                f"INSERT INTO bodies ({', '.join(f'`{column}`' for column in columns)}) "
+                f"VALUES ({', '.join(f'%({column})s' for column in columns)}) "
+                "ON DUPLICATE KEY UPDATE `body_hash` = `body_hash`",
+                new_bodies,
+            )
+
+    # The start of a statement that copies pages2 rows into pages2_history, up
+    # to where its WHERE clause would go. History rows are partitioned by date,
+    # so they have to have one; and if bodies aren't deduplicated, pages2 might
+    # be too old to have a body_hash column.
+    def _archive_sql(self) -> str:
+        select: str = ", ".join(
+            "COALESCE(`date`, CURRENT_TIMESTAMP)"
+            if column == "date"
+            else "NULL"
+            if column == "body_hash" and not self.dedup_bodies
+            else f"`{column}`"
+            for column in HISTORY_COLUMNS
+        )
+        return (
+            f"INSERT INTO pages2_history ({', '.join(f'`{column}`' for column in HISTORY_COLUMNS)}) "
+            f"SELECT {select} FROM pages2"
+        )
+
+    def touch(self, url: str, date: datetime) -> None:
+        key_column: str = "url_hash" if self.url_hash_key else "url"
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute(
+                    f"UPDATE pages2 SET date = %(date)s WHERE {key_column} = %(key)s;",
+                    dict(date=date, key=self.key_for(url)),
+                )
+                db_conn.commit()
+            finally:
+                db_cursor.close()
+
+    def iter_range(
+        self,
+        start_id: int | None = None,
+        end_id: int | None = None,
+        batch_size: int = 1000,
+        url_like: str | None = None,
+    ) -> Iterator[dict[str, Any]]:
+        columns: tuple[str, ...] = ("_id",) + ROW_COLUMNS
+        conditions: list[str] = list()
+        if start_id is not None:
+            conditions.append("_id >= %(start_id)s")
+        if end_id is not None:
+            conditions.append("_id <= %(end_id)s")
+        if url_like is not None:
+            conditions.append("url LIKE %(url_like)s")
+        where: str = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with self._connection(read=True) as db_conn:
+            # mysql.connector cursors are unbuffered by default, so rows are
+            # streamed from the server as they're fetched rather than all
+            # being read into memory up front.
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute(
+                    f"{self.select_rows_sql(columns)} {where}ORDER BY _id;",
+                    dict(start_id=start_id, end_id=end_id, url_like=url_like),
+                )
+                while True:
+                    rows: list[tuple[Any, ...]] = db_cursor.fetchmany(batch_size)  # type: ignore[assignment]
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield dict(zip(columns, row))
+            finally:
+                db_cursor.close()
+
+    def iter_keys(self, batch_size: int = 10_000) -> Iterator[str | bytes]:
+        key_column: str = "url_hash" if self.url_hash_key else "url"
+        with self._connection(read=True) as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute(f"SELECT {key_column} FROM pages2;")
+                while True:
+                    rows: list[tuple[Any, ...]] = db_cursor.fetchmany(batch_size)  # type: ignore[assignment]
+                    if not rows:
+                        break
+                    for (key,) in rows:
+                        yield bytes(key) if self.url_hash_key else key
+            finally:
+                db_cursor.close()
+
+    def count(self) -> int:
+        with self._connection(read=True) as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute("SELECT COUNT(*) FROM pages2;")
+                # fetchall() rather than fetchone() so the unbuffered cursor
+                # has consumed the whole result before it's closed.
+                return db_cursor.fetchall()[0][0]  # type: ignore[index, no-any-return]
+            finally:
+                db_cursor.close()
+
+    # Reads the batch from the primary, since that's what it's deleted from.
+    def expire_batch(
+        self,
+        expired: Callable[[int, datetime | None], bool],
+        after: int = 0,
+        limit: int = 1000,
+        archive: bool = False,
+    ) -> tuple[int, int | None]:
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute(
+                    "SELECT _id, status, date FROM pages2 WHERE _id > %(after)s "
+                    "ORDER BY _id LIMIT %(limit)s;",
+                    dict(after=after, limit=limit),
+                )
+                rows: list[tuple[Any, ...]] = db_cursor.fetchall()  # type: ignore[assignment]
+                if not rows:
+                    return 0, None
+                doomed: list[dict[str, Any]] = [
+                    dict(_id=_id, date=date)
+                    for _id, status, date in rows
+                    if expired(status, self.utc_date(date))
+                ]
+                deleted: int = 0
+                if doomed:
+                    # Matching the date as well as the _id leaves alone rows
+                    # that were replaced since they were read.
+                    if archive:
+                        db_cursor.executemany(
+                            f"{self._archive_sql()} WHERE _id = %(_id)s "
+                            "AND date <=> %(date)s;",
+                            doomed,
+                        )
+                    db_cursor.executemany(
+                        "DELETE FROM pages2 WHERE _id = %(_id)s AND date <=> %(date)s;",
+                        doomed,
+                    )
+                    deleted = db_cursor.rowcount
+                    db_conn.commit()
+                return deleted, rows[-1][0]
+            finally:
+                db_cursor.close()
+
+    def trim_history_batch(
+        self,
+        keep: int | None,
+        before: datetime | None,
+        after: bytes = b"",
+        limit: int = 1000,
+    ) -> tuple[int, bytes | None]:
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                # The batch ends with every version of the limit'th URL, so
+                # that none of them are numbered without the newer ones.
+                db_cursor.execute(
+                    "SELECT url_hash FROM pages2_history WHERE url_hash > %(after)s "
+                    "ORDER BY url_hash LIMIT 1 OFFSET %(offset)s;",
+                    dict(after=after, offset=max(limit, 1) - 1),
+                )
+                upper_rows: list[tuple[Any, ...]] = db_cursor.fetchall()  # type: ignore[assignment]
+                upper: bytes | None = bytes(upper_rows[0][0]) if upper_rows else None
+                db_cursor.execute(
+                    "SELECT _id, date, ROW_NUMBER() OVER (PARTITION BY url_hash "
+                    "ORDER BY date DESC, _id DESC) FROM pages2_history "
+                    "WHERE url_hash > %(after)s"
+                    + (" AND url_hash <= %(upper)s;" if upper is not None else ";"),
+                    dict(after=after, upper=upper),
+                )
+                doomed: list[dict[str, Any]] = [
+                    dict(_id=_id, date=date)
+                    for _id, date, version in db_cursor.fetchall()  # type: ignore[misc]
+                    if (keep is not None and version > keep)
+                    or (before is not None and self.utc_date(date) < before)  # type: ignore[operator]
+                ]
+                if doomed:
+                    # With the date, each delete only looks in one partition.
+                    db_cursor.executemany(
+                        "DELETE FROM pages2_history WHERE _id = %(_id)s AND date = %(date)s;",
+                        doomed,
+                    )
+                    db_conn.commit()
+                return len(doomed), upper
+            finally:
+                db_cursor.close()
+
+    def delete_orphan_bodies_batch(
+        self, after: bytes = b"", limit: int = 1000
+    ) -> tuple[int, bytes | None]:
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute(
+                    "SELECT body_hash FROM bodies WHERE body_hash > %(after)s "
+                    "ORDER BY body_hash LIMIT %(limit)s;",
+                    dict(after=after, limit=limit),
+                )
+                digests: list[bytes] = [bytes(digest) for (digest,) in db_cursor.fetchall()]  # type: ignore[misc]
+                if not digests:
+                    return 0, None
+                # Whether a body is still referenced is checked by the DELETE
+                # itself, so a row stored since the bodies were read keeps its
+                # body.
+                db_cursor.execute(
+                    "DELETE FROM bodies WHERE body_hash IN "
+                    f"({', '.join(['%s'] * len(digests))}) AND NOT EXISTS "
+                    "(SELECT 1 FROM pages2 WHERE pages2.body_hash = bodies.body_hash) "
+                    "AND NOT EXISTS (SELECT 1 FROM pages2_history "
+                    "WHERE pages2_history.body_hash = bodies.body_hash);",
+                    tuple(digests),
+                )
+                deleted: int = db_cursor.rowcount
+                db_conn.commit()
+                return deleted, digests[-1]
+            finally:
+                db_cursor.close()
+
+    # Partitions are named pYYYYMM for the month whose rows they hold, with a
+    # catch-all pmax partition after them, as in pages2.sql. New months are
+    # split off pmax, which should be empty, so that's quick.
+    def rotate_history_partitions(
+        self, before: datetime, months_ahead: int = 3
+    ) -> list[str]:
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                db_cursor.execute(
+                    "SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+                    "FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() "
+                    "AND TABLE_NAME = 'pages2_history' AND PARTITION_NAME IS NOT NULL "
+                    "ORDER BY PARTITION_ORDINAL_POSITION;"
+                )
+                partitions: list[tuple[str, str]] = db_cursor.fetchall()  # type: ignore[assignment]
+                if not partitions:
+                    return list()
+                # A partition's description is the UNIX time its rows are
+                # dated before.
+                dropped: list[str] = [
+                    name
+                    for name, bound in partitions
+                    if bound != "MAXVALUE" and int(bound) <= before.timestamp()
+                ]
+                if dropped:
+                    db_cursor.execute(
+                        f"ALTER TABLE pages2_history DROP PARTITION {', '.join(dropped)};"
+                    )
+                names: list[str] = sorted(name for name, _ in partitions if name != "pmax")
+                if len(names) == len(partitions):
+                    return dropped
+                added: list[str] = list()
+                month: datetime = datetime.now(timezone.utc).replace(
+                    day=1, hour=0, minute=0, second=0, microsecond=0
+                )
+                for _ in range(max(months_ahead, 0) + 1):
+                    next_month: datetime = (month + timedelta(days=32)).replace(day=1)
+                    name: str = f"p{month:%Y%m}"
+                    # Ranges have to go up, so only months after the last
+                    # partition there is can be added.
+                    if not names or name > names[-1]:
+                        added.append(
+                            f"PARTITION {name} VALUES LESS THAN "
+                            f"(UNIX_TIMESTAMP('{next_month:%Y-%m-%d} 00:00:00'))"
+                        )
+                    month = next_month
+                if added:
+                    db_cursor.execute(
+                        "ALTER TABLE pages2_history REORGANIZE PARTITION pmax INTO "
+                        f"({', '.join(added)}, PARTITION pmax VALUES LESS THAN MAXVALUE);"
+                    )
+                return dropped
+            finally:
+                db_cursor.close()
+
+    # Pins one connection to the calling thread for the whole load, so that
+    # session settings made for it apply to every put_many(). If unchecked is
+    # True, InnoDB's unique key checks are turned off for the session, which
+    # lets it buffer changes to the url_hash index rather than reading it in
+    # for every row. Durability is left to the server's settings, so durable
+    # makes no difference.
+    @contextmanager
+    def bulk_load(self, unchecked: bool = False, durable: bool = False) -> Iterator[None]:
+        with self._connection() as db_conn:
+            db_cursor: MySQLCursor = db_conn.cursor()
+            try:
+                if unchecked:
+                    db_cursor.execute("SET SESSION unique_checks = 0;")
+                self.local.pinned = db_conn
+                yield
+            finally:
+                self.local.pinned = None
+                if unchecked:
+                    db_cursor.execute("SET SESSION unique_checks = 1;")
+                db_cursor.close()
+
+    # Gives up this backend's hold on its pools. Shared pools stay open until
+    # every backend using them has been closed.
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.release()
+        if self.read_pool is not None:
+            self.read_pool.release()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+from contextlib import contextmanager
+from mysql.connector.abstracts import MySQLConnectionAbstract
+from mysql.connector.cursor import MySQLCursor
+from typing import Any, Iterator
+
+from ..credits import CreditLedger
+from .pool import ConnectionPool, PooledConnection
+
+
+__all__ = ("MySQLCreditLedger",)
+
+
+# A credit budget kept as a row of the credit_ledger table (see pages2.sql),
+# for sharded crawls spread over several machines. Reservations lock the row
+# with SELECT ... FOR UPDATE, so concurrent ones queue up behind each other
+# rather than overspending. Budgets are told apart by name, so several can
+# share the table.
+class MySQLCreditLedger(CreditLedger):
+    name: str
+    pool: ConnectionPool
+
+    def __init__(self, name: str, pool: ConnectionPool) -> None:
+        self.name = name
+        self.pool = pool
+
+    # The budget is named by DBCACHE_CREDIT_LEDGER_NAME, and kept in the
+    # database the MYSQL_* settings point to. A reservation only happens once
+    # per block of credits, so one connection is all it needs.
+    @classmethod
+    def from_settings(cls, settings: Any) -> "MySQLCreditLedger":
+        return cls(
+            name=settings.get("DBCACHE_CREDIT_LEDGER_NAME", "default"),
+            pool=ConnectionPool(
+                name="credit-ledger",
+                size=1,
+                connect_args=dict(
+                    user=settings.get("MYSQL_USERNAME"),
+                    password=settings.get("MYSQL_PASSWORD"),
+                    host=settings.get("MYSQL_HOST"),
+                    database=settings.get("MYSQL_DATABASE"),
+                    charset=settings.get("MYSQL_CHARSET"),
+                ),
+                recycle=settings.getfloat("DBCACHE_POOL_RECYCLE", 3600.0),
+                ping_interval=settings.getfloat("DBCACHE_POOL_PING_INTERVAL", 30.0),
+            ),
+        )
+
+    # Runs a with block in a transaction on a cursor, committing it if the
+    # block succeeds. A failed transaction is rolled back when the connection
+    # goes back in the pool.
+    @contextmanager
+    def _transaction(self) -> Iterator[MySQLCursor]:
+        pooled: PooledConnection = self.pool.checkout()
+        conn: MySQLConnectionAbstract = pooled.conn
+        db_cursor: MySQLCursor = conn.cursor()
+        try:
+            conn.start_transaction()
+            yield db_cursor
+            conn.commit()
+        finally:
+            db_cursor.close()
+            self.pool.checkin(pooled)
+
+    def open(self, credits_used: int, credits_threshold: int) -> None:
+        with self._transaction() as db_cursor:
+            db_cursor.execute(
+                "INSERT IGNORE INTO credit_ledger (name, credits_used, "
+                "credits_threshold) VALUES (%(name)s, %(used)s, %(threshold)s);",
+                dict(name=self.name, used=credits_used, threshold=credits_threshold),
+            )
+
+    def reset(self, credits_used: int, credits_threshold: int) -> None:
+        with self._transaction() as db_cursor:
+            db_cursor.execute(
+                "INSERT INTO credit_ledger (name, credits_used, credits_threshold) "
+                "VALUES (%(name)s, %(used)s, %(threshold)s) ON DUPLICATE KEY "
+                "UPDATE credits_used = VALUES(credits_used), "
+                "credits_threshold = VALUES(credits_threshold);",
+                dict(name=self.name, used=credits_used, threshold=credits_threshold),
+            )
+
+    def reserve(self, count: int) -> int:
+        with self._transaction() as db_cursor:
+            db_cursor.execute(
+                "SELECT credits_used, credits_threshold FROM credit_ledger "
+                "WHERE name = %(name)s FOR UPDATE;",
+                dict(name=self.name),
+            )
+            credits_used, credits_threshold = db_cursor.fetchall()[0]  # type: ignore[misc]
+            granted: int = max(min(int(count), credits_threshold - credits_used), 0)
+            if granted > 0:
+                db_cursor.execute(
+                    "UPDATE credit_ledger SET credits_used = credits_used + %(granted)s "
+                    "WHERE name = %(name)s;",
+                    dict(name=self.name, granted=granted),
+                )
+        return granted
+
+    def release(self, count: int) -> None:
+        with self._transaction() as db_cursor:
+            db_cursor.execute(
+                "UPDATE credit_ledger SET credits_used = credits_used - %(count)s "
+                "WHERE name = %(name)s;",
+                dict(name=self.name, count=count),
+            )
+
+    def balance(self) -> tuple[int, int]:
+        with self._transaction() as db_cursor:
+            db_cursor.execute(
+                "SELECT credits_used, credits_threshold FROM credit_ledger "
+                "WHERE name = %(name)s;",
+                dict(name=self.name),
+            )
+            credits_used, credits_threshold = db_cursor.fetchall()[0]  # type: ignore[misc]
+        return int(credits_used), int(credits_threshold)
+
+    def close(self) -> None:
+        self.pool.release()
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+import logging
+import queue
+import threading
+import time
+import weakref
+
+from dataclasses import dataclass, field
+from mysql.connector import connect
+from mysql.connector.abstracts import MySQLConnectionAbstract
+from mysql.connector.errors import Error, PoolError
+from typing import Any, Callable
+
+
+__all__ = ("ConnectionPool", "PooledConnection", "shared_pool")
+
+
+# A connection checked out of a ConnectionPool, with the times the pool needs
+# to decide whether it can be handed out again.
+@dataclass
+class PooledConnection:
+    conn: MySQLConnectionAbstract
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+# A thread-safe pool of MySQL connections, used by MySQLBackend in place of
+# mysql.connector's own MySQLConnectionPool, which caps pools at 32
+# connections, raises PoolError immediately when they're all checked out, and
+# resets each connection's session (a round trip to the server) every time
+# one is returned.
+#
+# Connections are opened lazily, up to `size` of them. A checkout waits up to
+# `timeout` seconds for one to be returned before raising PoolError.
+# Connections older than `recycle` seconds are closed and replaced rather than
+# handed out, so the server's wait_timeout or a load balancer never drops one
+# from under a query. A connection that has sat idle for more than
+# `ping_interval` seconds is pinged before it's handed out, and replaced if
+# it's gone; busier ones are assumed to be fine. Idle connections are kept in
+# a stack, so the pool works from the most recently used ones and the rest age
+# out.
+#
+# On checkin any transaction left open is rolled back and any unread result
+# is consumed, which is all the session reset was really needed for.
+#
+# A pool can be shared by several users; see shared_pool(). It's closed when
+# the last of them releases it, and a connection checked back in after that,
+# such as one a lookup thread was still using, is closed rather than kept.
+class ConnectionPool:
+    name: str
+    size: int
+    recycle: float
+    ping_interval: float
+    timeout: float
+    connect_args: dict[str, Any]
+    idle: "queue.LifoQueue[PooledConnection]"
+    opened: int
+    users: int
+    closed: bool
+    lock: threading.Lock
+
+    def __init__(
+        self,
+        name: str,
+        size: int,
+        connect_args: dict[str, Any],
+        recycle: float = 3600.0,
+        ping_interval: float = 30.0,
+        timeout: float = 30.0,
+    ) -> None:
+        logging.info(
+            f"ConnectionPool.__init__(): opening database connection pool "
+            f"'{name}' of up to {size} connections to {connect_args.get('host')}"
+        )
+        self.name = name
+        self.size = max(int(size), 1)
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.connect_args = connect_args
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.users = 1
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def checkout(self) -> PooledConnection:
+        deadline: float = time.monotonic() + self.timeout
+        while True:
+            try:
+                pooled: PooledConnection = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_open: bool = self.opened < self.size
+                    if can_open:
+                        self.opened += 1
+                if can_open:
+                    return self._open()
+                try:
+                    pooled = self.idle.get(
+                        timeout=max(deadline - time.monotonic(), 0.0)
+                    )
+                except queue.Empty:
+                    raise PoolError(
+                        f"no connection in pool '{self.name}' was free after "
+                        f"{self.timeout}s"
+                    ) from None
+            now: float = time.monotonic()
+            if self.recycle > 0 and now - pooled.created_at > self.recycle:
+                self._discard(pooled)
+                continue
+            if now - pooled.last_used > self.ping_interval:
+                try:
+                    pooled.conn.ping(reconnect=False)
+                except Error:
+                    logging.warning(
+                        f"ConnectionPool.checkout(): idle connection in pool "
+                        f"'{self.name}' is gone; replacing it"
+                    )
+                    self._discard(pooled)
+                    continue
+            return pooled
+
+    # Returns a connection to the pool. One that broke while it was checked
+    # out is closed instead, making room for a new one, as is any connection
+    # returned once the pool has been closed.
+    def checkin(self, pooled: PooledConnection, broken: bool = False) -> None:
+        if not broken:
+            try:
+                if pooled.conn.unread_result:
+                    pooled.conn.consume_results()
+                if pooled.conn.in_transaction:
+                    pooled.conn.rollback()
+            except Error:
+                broken = True
+        if not broken:
+            pooled.last_used = time.monotonic()
+            # Checked under the lock, so the connection can't be put back
+            # after release() has closed the idle ones.
+            with self.lock:
+                if not self.closed:
+                    self.idle.put(pooled)
+                    return
+        self._discard(pooled)
+
+    def _open(self) -> PooledConnection:
+        try:
+            return PooledConnection(connect(**self.connect_args))
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def _discard(self, pooled: PooledConnection) -> None:
+        with self.lock:
+            self.opened -= 1
+        try:
+            pooled.conn.close()
+        except Error:
+            pass
+
+    # Gives up one user's hold on the pool, closing it when there are none left.
+    def release(self) -> None:
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.closed = True
+        logging.info(
+            f"ConnectionPool.release(): closing database connection pool '{self.name}'"
+        )
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+# The pools shared by the components of each crawler, keyed by the crawler and
+# then by whatever distinguishes the pools (such as primary and replica). They
+# go when the crawler does.
+_shared_pools: "weakref.WeakKeyDictionary[Any, dict[str, ConnectionPool]]" = (
+    weakref.WeakKeyDictionary()
+)
+_shared_pools_lock: threading.Lock = threading.Lock()
+
+
+# Returns the pool registered for `owner` (normally a Crawler) under `key`,
+# creating it with `factory` the first time, so DatabaseCachingMiddleware and
+# SerializingDatabasePipeline share one pool rather than opening one each.
+# Every call counts as a user of the pool, and has to be matched by a call to
+# its release().
+def shared_pool(
+    owner: Any, key: str, factory: Callable[[], ConnectionPool]
+) -> ConnectionPool:
+    with _shared_pools_lock:
+        pools: dict[str, ConnectionPool] = _shared_pools.setdefault(owner, dict())
+        pool: ConnectionPool | None = pools.get(key)
+        if pool is not None:
+            with pool.lock:
+                if pool.users > 0:
+                    pool.users += 1
+                    return pool
+        pool = factory()
+        pools[key] = pool
+        return pool
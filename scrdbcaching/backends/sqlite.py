@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+
+import logging
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Iterable, Iterator
+
+from ..utility import url_digest
+from .base import BODY_COLUMNS, CacheBackend, HISTORY_COLUMNS, INSERT_COLUMNS, ROW_COLUMNS
+
+
+__all__ = ("SQLiteBackend",)
+
+
+# The embedded equivalent of pages2.sql. It's always keyed by url_hash.
+SCHEMA_SQL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS pages2 (
+        _id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        url_hash BLOB NOT NULL UNIQUE,
+        status INTEGER NOT NULL,
+        encoding TEXT NOT NULL,
+        headers TEXT,
+        headers_blob BLOB,
+        date TEXT,
+        body TEXT,
+        body_blob BLOB,
+        body_codec TEXT NOT NULL DEFAULT 'text',
+        body_hash BLOB
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS bodies (
+        body_hash BLOB PRIMARY KEY,
+        body TEXT,
+        body_blob BLOB,
+        body_codec TEXT NOT NULL DEFAULT 'text'
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS pages2_history (
+        _id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        url_hash BLOB NOT NULL,
+        status INTEGER NOT NULL,
+        encoding TEXT NOT NULL,
+        headers TEXT,
+        headers_blob BLOB,
+        date TEXT,
+        body TEXT,
+        body_blob BLOB,
+        body_codec TEXT NOT NULL DEFAULT 'text',
+        body_hash BLOB,
+        archived_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""",
+)
+
+# The indexes the maintenance operations need, created once pages2 is sure to
+# have its body_hash column.
+INDEX_SQL: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS pages2_body_hash ON pages2 (body_hash)",
+    "CREATE INDEX IF NOT EXISTS pages2_history_url_hash_date "
+    "ON pages2_history (url_hash, date)",
+    "CREATE INDEX IF NOT EXISTS pages2_history_body_hash ON pages2_history (body_hash)",
+)
+
+
+# A page cache kept in a local SQLite database file, for single-machine crawls
+# that don't need a database server. The database is opened in WAL mode, so
+# lookups from the middleware's thread pool can run while the pipeline writes,
+# and is memory-mapped up to mmap_size bytes so that reads of a hot cache are
+# served straight from the page cache without a copy through read().
+#
+# SQLite connections can't be shared between threads, so each thread gets its
+# own.
+#
+# If dedup_bodies is True, bodies are kept once each in the bodies table. If
+# keep_versions is nonzero, replaced rows are kept in pages2_history.
+class SQLiteBackend(CacheBackend):
+    path: str
+    mmap_size: int
+    local: threading.local
+    connections: list[sqlite3.Connection]
+    connections_lock: threading.Lock
+
+    def __init__(
+        self,
+        path: str,
+        mmap_size: int = 256 * 1024 * 1024,
+        dedup_bodies: bool = False,
+        keep_versions: int = 0,
+    ) -> None:
+        super().__init__(
+            url_hash_key=True, dedup_bodies=dedup_bodies, keep_versions=keep_versions
+        )
+        self.path = path
+        self.mmap_size = int(mmap_size)
+        self.local = threading.local()
+        self.connections = list()
+        self.connections_lock = threading.Lock()
+        logging.info(f"SQLiteBackend.__init__(): opening database file '{path}'")
+        conn: sqlite3.Connection = self._connection()
+        for statement in SCHEMA_SQL:
+            conn.execute(statement)
+        # Database files from before bodies could be deduplicated don't have
+        # the body_hash column yet.
+        if "body_hash" not in {
+            column[1] for column in conn.execute("PRAGMA table_info(pages2);")
+        }:
+            conn.execute("ALTER TABLE pages2 ADD COLUMN body_hash BLOB;")
+        for statement in INDEX_SQL:
+            conn.execute(statement)
+
+    @classmethod
+    def from_settings(
+        cls, settings: Any, name: str, crawler: Any = None
+    ) -> "SQLiteBackend":
+        return cls(
+            path=settings.get("DBCACHE_SQLITE_PATH", "pages2.sqlite3"),
+            mmap_size=settings.getint("DBCACHE_SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+            dedup_bodies=settings.getbool("DBCACHE_DEDUP_BODIES", False),
+            keep_versions=settings.getint("DBCACHE_KEEP_VERSIONS", 0),
+        )
+
+    # Returns this thread's connection, opening it if need be.
+    def _connection(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection | None = getattr(self.local, "conn", None)
+        if conn is None:
+            # check_same_thread is off only so close() can close every
+            # thread's connection; each one is otherwise used by one thread.
+            conn = sqlite3.connect(
+                self.path, timeout=30.0, check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            conn.execute(f"PRAGMA mmap_size = {self.mmap_size};")
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    # Runs a with block in a transaction on this thread's connection,
+    # committing it if the block succeeds and rolling it back if it doesn't.
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn: sqlite3.Connection = self._connection()
+        conn.execute("BEGIN;")
+        try:
+            yield conn
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+
+    def get(self, url: str) -> dict[str, Any] | None:
+        with self.stats.timer("query"):
+            row: tuple[Any, ...] | None = (
+                self._connection()
+                .execute(
+                    f"{self.select_rows_sql(ROW_COLUMNS)} WHERE url_hash = ?;",
+                    (url_digest(url),),
+                )
+                .fetchone()
+            )
+        if row is None or not self.same_url(row[0], url):
+            return None
+        return self._row_dict(ROW_COLUMNS, row)
+
+    def get_many(self, urls: list[str]) -> dict[str, dict[str, Any]]:
+        urls_by_digest: dict[bytes, list[str]] = dict()
+        for url in urls:
+            urls_by_digest.setdefault(url_digest(url), []).append(url)
+        placeholders: str = ", ".join(["?"] * len(urls_by_digest))
+        rows: dict[str, dict[str, Any]] = dict()
+        with self.stats.timer("query"):
+            fetched: list[tuple[Any, ...]] = (
+                self._connection()
+                .execute(
+                    f"{self.select_rows_sql(ROW_COLUMNS + ('url_hash',))} "
+                    f"WHERE url_hash IN ({placeholders});",
+                    tuple(urls_by_digest),
+                )
+                .fetchall()
+            )
+        for fetched_row in fetched:
+            row: dict[str, Any] = self._row_dict(ROW_COLUMNS, fetched_row)
+            for url in urls_by_digest.get(fetched_row[-1], []):
+                if self.same_url(row["url"], url):
+                    rows[url] = row
+        return rows
+
+    def put_many(
+        self, rows: Iterable[dict[str, Any]], on_existing: str = "error"
+    ) -> None:
+        columns: tuple[str, ...] = INSERT_COLUMNS + ("url_hash", "body_hash")
+        page_rows: list[dict[str, Any]] = list(rows)
+        bodies: dict[bytes, dict[str, Any]] = dict()
+        if self.dedup_bodies:
+            page_rows, bodies = self.split_bodies(page_rows)
+        sql: str = (
+            f"INSERT INTO pages2 ({', '.join(columns)}) "
+            f"VALUES ({', '.join(f':{column}' for column in columns)})"
+        )
+        if on_existing == "ignore":
+            sql += " ON CONFLICT (url_hash) DO NOTHING"
+        elif on_existing == "replace":
+            sql += " ON CONFLICT (url_hash) DO UPDATE SET " + ", ".join(
+                f"{column} = excluded.{column}" for column in columns
+            )
+        conn: sqlite3.Connection = self._connection()
+        conn.execute("BEGIN;")
+        try:
+            if bodies:
+                self._put_bodies(conn, bodies, len(page_rows))
+            if on_existing == "replace" and self.keep_versions:
+                with self.stats.timer("archive"):
+                    conn.executemany(
+                        f"{self._archive_sql()} WHERE url_hash = ?;",
+                        {(url_digest(row["url"]),) for row in page_rows},
+                    )
+            with self.stats.timer("insert"):
+                conn.executemany(sql + ";", (self._adapt_row(row) for row in page_rows))
+            with self.stats.timer("commit"):
+                conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+
+    # Stores whichever of the bodies the bodies table doesn't have yet, in the
+    # same transaction as the rows that reference them.
+    def _put_bodies(
+        self, conn: sqlite3.Connection, bodies: dict[bytes, dict[str, Any]], row_count: int
+    ) -> None:
+        placeholders: str = ", ".join(["?"] * len(bodies))
+        stored: set[bytes] = {
+            digest
+            for (digest,) in conn.execute(
+                f"SELECT body_hash FROM bodies WHERE body_hash IN ({placeholders});",
+                tuple(bodies),
+            )
+        }
+        new_bodies: list[dict[str, Any]] = [
+            dict(body, body_hash=digest)
+            for digest, body in bodies.items()
+            if digest not in stored
+        ]
+        self.stats.inc("bodies_deduplicated", row_count - len(new_bodies))
+        if not new_bodies:
+            return
+        columns: tuple[str, ...] = ("body_hash",) + BODY_COLUMNS
+        with self.stats.timer("insert_bodies"):
+            conn.executemany(
+                f"INSERT INTO bodies ({', '.join(columns)}) "
+                f"VALUES ({', '.join(f':{column}' for column in columns)}) "
+                "ON CONFLICT (body_hash) DO NOTHING;",
+                new_bodies,
+            )
+
+    # The start of a statement that copies pages2 rows into pages2_history, up
+    # to where its WHERE clause would go.
+    @staticmethod
+    def _archive_sql() -> str:
+        columns: str = ", ".join(HISTORY_COLUMNS)
+        return f"INSERT INTO pages2_history ({columns}) SELECT {columns} FROM pages2"
+
+    def touch(self, url: str, date: datetime) -> None:
+        self._connection().execute(
+            "UPDATE pages2 SET date = ? WHERE url_hash = ?;",
+            (date.isoformat(), url_digest(url)),
+        )
+
+    # sqlite3 has no built-in storage for datetimes any more, so dates are
+    # stored as ISO 8601 strs, and turned back into datetimes by _row_dict().
+    # Rows from to_dict() might also not have their url_hash yet, and only
+    # have a body_hash if their bodies are deduplicated.
+    @staticmethod
+    def _adapt_row(row: dict[str, Any]) -> dict[str, Any]:
+        row = dict(row)
+        if isinstance(row.get("date"), datetime):
+            row["date"] = row["date"].isoformat()
+        if row.get("url_hash") is None:
+            row["url_hash"] = url_digest(row["url"])
+        row.setdefault("body_hash", None)
+        return row
+
+    def iter_range(
+        self,
+        start_id: int | None = None,
+        end_id: int | None = None,
+        batch_size: int = 1000,
+        url_like: str | None = None,
+    ) -> Iterator[dict[str, Any]]:
+        columns: tuple[str, ...] = ("_id",) + ROW_COLUMNS
+        params: tuple[Any, ...] = (
+            start_id if start_id is not None else 0,
+            end_id if end_id is not None else 2**63 - 1,
+        )
+        url_condition: str = ""
+        if url_like is not None:
+            url_condition = "AND url LIKE ? "
+            params += (url_like,)
+        cursor: sqlite3.Cursor = self._connection().execute(
+            f"{self.select_rows_sql(columns)} WHERE _id >= ? AND _id <= ? "
+            f"{url_condition}ORDER BY _id;",
+            params,
+        )
+        while True:
+            rows: list[tuple[Any, ...]] = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._row_dict(columns, row)
+
+    @staticmethod
+    def _row_dict(columns: tuple[str, ...], row: tuple[Any, ...]) -> dict[str, Any]:
+        row_dict: dict[str, Any] = dict(zip(columns, row))
+        if row_dict["date"] is not None:
+            row_dict["date"] = datetime.fromisoformat(row_dict["date"])
+        return row_dict
+
+    def iter_keys(self, batch_size: int = 10_000) -> Iterator[str | bytes]:
+        cursor: sqlite3.Cursor = self._connection().execute(
+            "SELECT url_hash FROM pages2;"
+        )
+        while True:
+            rows: list[tuple[bytes]] = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for (key,) in rows:
+                yield key
+
+    def count(self) -> int:
+        return self._connection().execute(  # type: ignore[no-any-return]
+            "SELECT COUNT(*) FROM pages2;"
+        ).fetchone()[0]
+
+    def expire_batch(
+        self,
+        expired: Callable[[int, datetime | None], bool],
+        after: int = 0,
+        limit: int = 1000,
+        archive: bool = False,
+    ) -> tuple[int, int | None]:
+        rows: list[tuple[int, int, str | None]] = (
+            self._connection()
+            .execute(
+                "SELECT _id, status, date FROM pages2 WHERE _id > ? ORDER BY _id LIMIT ?;",
+                (after, limit),
+            )
+            .fetchall()
+        )
+        if not rows:
+            return 0, None
+        doomed: list[tuple[int, str | None]] = [
+            (_id, date)
+            for _id, status, date in rows
+            if expired(
+                status,
+                self.utc_date(datetime.fromisoformat(date)) if date is not None else None,
+            )
+        ]
+        deleted: int = 0
+        if doomed:
+            # Matching the date as well as the _id leaves alone rows that were
+            # replaced since they were read.
+            with self._transaction() as conn:
+                if archive:
+                    conn.executemany(
+                        f"{self._archive_sql()} WHERE _id = ? AND date IS ?;", doomed
+                    )
+                deleted = conn.executemany(
+                    "DELETE FROM pages2 WHERE _id = ? AND date IS ?;", doomed
+                ).rowcount
+        return deleted, rows[-1][0]
+
+    def trim_history_batch(
+        self,
+        keep: int | None,
+        before: datetime | None,
+        after: bytes = b"",
+        limit: int = 1000,
+    ) -> tuple[int, bytes | None]:
+        conn: sqlite3.Connection = self._connection()
+        # The batch ends with every version of the limit'th URL, so that none
+        # of them are numbered without the newer ones.
+        upper_row: tuple[bytes] | None = conn.execute(
+            "SELECT url_hash FROM pages2_history WHERE url_hash > ? "
+            "ORDER BY url_hash LIMIT 1 OFFSET ?;",
+            (after, max(limit, 1) - 1),
+        ).fetchone()
+        upper: bytes | None = upper_row[0] if upper_row is not None else None
+        condition: str = "url_hash > ?" + (" AND url_hash <= ?" if upper is not None else "")
+        rows: list[tuple[int, str | None, int]] = conn.execute(
+            "SELECT _id, date, ROW_NUMBER() OVER (PARTITION BY url_hash "
+            f"ORDER BY date DESC, _id DESC) FROM pages2_history WHERE {condition};",
+            (after, upper) if upper is not None else (after,),
+        ).fetchall()
+        doomed: list[tuple[int]] = [
+            (_id,)
+            for _id, date, version in rows
+            if (keep is not None and version > keep)
+            or (
+                before is not None
+                and date is not None
+                and self.utc_date(datetime.fromisoformat(date)) < before  # type: ignore[operator]
+            )
+        ]
+        if doomed:
+            with self._transaction() as conn:
+                conn.executemany("DELETE FROM pages2_history WHERE _id = ?;", doomed)
+        return len(doomed), upper
+
+    def delete_orphan_bodies_batch(
+        self, after: bytes = b"", limit: int = 1000
+    ) -> tuple[int, bytes | None]:
+        digests: list[tuple[bytes]] = (
+            self._connection()
+            .execute(
+                "SELECT body_hash FROM bodies WHERE body_hash > ? "
+                "ORDER BY body_hash LIMIT ?;",
+                (after, limit),
+            )
+            .fetchall()
+        )
+        if not digests:
+            return 0, None
+        # Whether a body is still referenced is checked by the DELETE itself,
+        # so a row stored since the bodies were read keeps its body.
+        with self._transaction() as conn:
+            deleted: int = conn.executemany(
+                "DELETE FROM bodies WHERE body_hash = ? AND NOT EXISTS "
+                "(SELECT 1 FROM pages2 WHERE pages2.body_hash = bodies.body_hash) "
+                "AND NOT EXISTS (SELECT 1 FROM pages2_history "
+                "WHERE pages2_history.body_hash = bodies.body_hash);",
+                digests,
+            ).rowcount
+        return deleted, digests[-1][0]
+
+    # Unless the load has to be durable, transactions are committed without
+    # waiting for the WAL to reach the disk until the load is over. That's safe
+    # if the process crashes, since what it wrote is with the OS by then, but
+    # an OS crash or power loss can lose the last batches, or even corrupt the
+    # database. A durable load syncs the WAL as every transaction is
+    # committed, which NORMAL, the setting outside a load, only does at
+    # checkpoints. SQLite has no way to skip unique key checks, so `unchecked`
+    # makes no difference.
+    @contextmanager
+    def bulk_load(self, unchecked: bool = False, durable: bool = False) -> Iterator[None]:
+        conn: sqlite3.Connection = self._connection()
+        conn.execute(f"PRAGMA synchronous = {'FULL' if durable else 'OFF'};")
+        try:
+            yield
+        finally:
+            conn.execute("PRAGMA synchronous = NORMAL;")
+
+    def close(self) -> None:
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = list()
+        self.local = threading.local()
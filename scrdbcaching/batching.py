@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import logging
+
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from typing import Any, Callable
+
+
+__all__ = ("LookupBatcher",)
+
+
+# Coalesces cache lookups that arrive close together into one multi-row query.
+# Each call to lookup() returns a Deferred; the URLs are collected until either
+# max_size distinct URLs are pending or window seconds have passed since the
+# first of them arrived, and then fetch_rows() is called on the thread pool
+# with all of them at once. Its result, a dict mapping URLs to rows, is fanned
+# back out to the waiting Deferreds. URLs missing from that dict get None.
+#
+# lookup() and flush() must be called from the reactor thread.
+class LookupBatcher:
+    fetch_rows: Callable[[list[str]], dict[str, dict[str, Any]]]
+    threadpool: ThreadPool
+    max_size: int
+    window: float
+    pending: dict[str, list[Deferred]]
+    delayed_call: Any
+
+    def __init__(
+        self,
+        fetch_rows: Callable[[list[str]], dict[str, dict[str, Any]]],
+        threadpool: ThreadPool,
+        max_size: int,
+        window: float,
+    ) -> None:
+        self.fetch_rows = fetch_rows
+        self.threadpool = threadpool
+        self.max_size = int(max_size)
+        self.window = float(window)
+        self.pending = dict()
+        self.delayed_call = None
+
+    def lookup(self, url: str) -> Deferred:
+        # The twisted reactor can't be imported at module level in a scrapy
+        # component, since that would install the default reactor before
+        # scrapy gets to install the one it's configured to use.
+        from twisted.internet import reactor
+
+        deferred: Deferred = Deferred()
+        # Several requests for the same URL share one slot in the batch.
+        self.pending.setdefault(url, []).append(deferred)
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.delayed_call is None:
+            self.delayed_call = reactor.callLater(self.window, self.flush)
+        return deferred
+
+    # Sends every pending URL to fetch_rows() in one batch.
+    def flush(self) -> None:
+        from twisted.internet import reactor
+
+        if self.delayed_call is not None:
+            if self.delayed_call.active():
+                self.delayed_call.cancel()
+            self.delayed_call = None
+        if not self.pending:
+            return
+        pending: dict[str, list[Deferred]] = self.pending
+        self.pending = dict()
+        logging.info(
+            f"LookupBatcher.flush(): looking up batch of {len(pending)} URLs"
+        )
+        batch: Deferred = deferToThreadPool(
+            reactor, self.threadpool, self.fetch_rows, list(pending)
+        )
+        batch.addCallbacks(
+            self._fan_out,
+            self._fan_out_failure,
+            callbackArgs=(pending,),
+            errbackArgs=(pending,),
+        )
+
+    @staticmethod
+    def _fan_out(
+        rows: dict[str, dict[str, Any]], pending: dict[str, list[Deferred]]
+    ) -> None:
+        for url, deferreds in pending.items():
+            row: dict[str, Any] | None = rows.get(url)
+            for deferred in deferreds:
+                deferred.callback(row)
+
+    # If the batch query failed, every lookup in the batch fails with it.
+    @staticmethod
+    def _fan_out_failure(
+        failure: Failure, pending: dict[str, list[Deferred]]
+    ) -> None:
+        for deferreds in pending.values():
+            for deferred in deferreds:
+                deferred.errback(failure)
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import hashlib
+import math
+
+
+__all__ = ("BloomFilter",)
+
+
+# A Bloom filter over URLs, or over their digests if the pages2 table is keyed
+# by url_hash. DatabaseCachingMiddleware builds one from the pages2 table when
+# it starts up and consults it before querying the database: a URL the filter
+# says isn't there definitely has no record, so the lookup can be skipped. A
+# URL the filter says is there probably has one, and is looked up as normal.
+#
+# The filter is sized from the number of URLs it's expected to hold and the
+# false positive rate wanted at that many URLs. If max_bytes is given and the
+# filter would be larger than that, it's shrunk to fit and the false positive
+# rate goes up accordingly.
+class BloomFilter:
+    capacity: int
+    error_rate: float
+    num_bits: int
+    num_hashes: int
+    count: int
+    bits: bytearray
+
+    def __init__(
+        self, capacity: int, error_rate: float = 0.01, max_bytes: int = 0
+    ) -> None:
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = float(error_rate)
+        num_bits: int = math.ceil(
+            -self.capacity * math.log(self.error_rate) / math.log(2) ** 2
+        )
+        if max_bytes > 0:
+            num_bits = min(num_bits, int(max_bytes) * 8)
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(round(self.num_bits / self.capacity * math.log(2)), 1)
+        self.count = 0
+        self.bits = bytearray(math.ceil(self.num_bits / 8))
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Derives the bit positions for a URL from two 64-bit halves of a single
+    # digest (Kirsch & Mitzenmacher's double hashing), so only one hash has to
+    # be computed per URL no matter how many positions are needed. URLs are
+    # casefolded first since the url column's collation is case-insensitive;
+    # URL digests are used as they are.
+    def _positions(self, url: str | bytes) -> list[int]:
+        key: bytes = url if isinstance(url, bytes) else url.casefold().encode("utf-8")
+        digest: bytes = hashlib.blake2b(key, digest_size=16).digest()
+        hash1: int = int.from_bytes(digest[:8], "little")
+        hash2: int = int.from_bytes(digest[8:], "little") | 1
+        return [(hash1 + i * hash2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, url: str | bytes) -> None:
+        for position in self._positions(url):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, url: str | bytes) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(url)
+        )
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.bits)
+
+    # The false positive rate to expect given how many URLs have been added
+    # and the filter's actual size.
+    @property
+    def expected_error_rate(self) -> float:
+        return (
+            1 - math.exp(-self.num_hashes * self.count / self.num_bits)
+        ) ** self.num_hashes
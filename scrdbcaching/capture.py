@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+import logging
+
+from datetime import timedelta
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from typing import Any
+
+from .backends import CacheBackend
+from .stats import CacheStats
+
+
+__all__ = ("DEFAULT_STATUS_POLICY", "ResponseWriter", "parse_status_policy")
+
+
+# The statuses DatabaseCachingMiddleware captures responses with if the
+# DBCACHE_STATUS_POLICY setting isn't set, mapped to how many seconds a stored
+# response with that status stays fresh; None defers to DBCACHE_TTL. Pages and
+# permanent redirects are kept as long as anything else, and 404s and 410s are
+# cached negatively, so known-dead URLs cost nothing on a repeat run: 410 Gone
+# for as long as anything else, and 404 Not Found, which is sometimes only
+# temporary, for a week.
+DEFAULT_STATUS_POLICY: dict[int, float | None] = {
+    200: None,
+    301: None,
+    308: None,
+    404: 7 * 24 * 60 * 60,
+    410: None,
+}
+
+
+# Turns the DBCACHE_STATUS_POLICY setting, a dict mapping statuses to seconds
+# fresh (or to None, to defer to DBCACHE_TTL), into a dict mapping each status
+# to a TTL, where None means the default TTL. Statuses come through as strings
+# if the setting was given as JSON; a TTL of 0 means forever, as DBCACHE_TTL's
+# does.
+def parse_status_policy(
+    policy: dict[Any, Any], default_ttl: timedelta | None
+) -> dict[int, timedelta | None]:
+    parsed: dict[int, timedelta | None] = dict()
+    for status, seconds in policy.items():
+        if seconds is None:
+            parsed[int(status)] = default_ttl
+        else:
+            parsed[int(status)] = (
+                timedelta(seconds=float(seconds)) if float(seconds) > 0 else None
+            )
+    return parsed
+
+
+# Stores the rows DatabaseCachingMiddleware captures from responses, off the
+# reactor thread. Rows are buffered and written batch_rows at a time, and
+# every `interval` seconds if that's nonzero, by put_many() on a single worker
+# thread, so writes happen in the order they were captured. A captured
+# response is newer than whatever row it might be replacing, so it always
+# replaces it.
+#
+# A batch that fails to store is logged and counted as dbcache/capture_errors,
+# and dropped; its pages will just be fetched again next time.
+#
+# add(), flush() and close() must be called from the reactor thread.
+class ResponseWriter:
+    backend: CacheBackend
+    stats: CacheStats
+    batch_rows: int
+    buffer: list[dict[str, Any]]
+    threadpool: ThreadPool
+    flush_loop: LoopingCall | None
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        stats: CacheStats,
+        batch_rows: int,
+        interval: float,
+        name: str,
+    ) -> None:
+        self.backend = backend
+        self.stats = stats
+        self.batch_rows = max(int(batch_rows), 1)
+        self.buffer = list()
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=1, name=name)
+        self.threadpool.start()
+        self.flush_loop = None
+        if float(interval) > 0:
+            self.flush_loop = LoopingCall(self.flush)
+            self.flush_loop.start(float(interval), now=False)
+
+    def add(self, row: dict[str, Any]) -> None:
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_rows:
+            self.flush()
+
+    # Hands the buffered rows to the worker thread, and returns a Deferred
+    # that fires once they're stored, or None if there weren't any.
+    def flush(self) -> Deferred | None:
+        if not self.buffer:
+            return None
+        # The twisted reactor can't be imported at module level in a scrapy
+        # component, since that would install the default reactor before
+        # scrapy gets to install the one it's configured to use.
+        from twisted.internet import reactor
+
+        rows: list[dict[str, Any]] = self.buffer
+        self.buffer = list()
+        deferred: Deferred = deferToThreadPool(reactor, self.threadpool, self._write, rows)
+        deferred.addErrback(self._write_failed, rows)
+        return deferred
+
+    def _write(self, rows: list[dict[str, Any]]) -> None:
+        self.backend.put_many(rows, on_existing="replace")
+        self.stats.inc("responses_stored", len(rows))
+
+    def _write_failed(self, failure: Failure, rows: list[dict[str, Any]]) -> None:
+        self.stats.inc("capture_errors", len(rows))
+        logging.error(
+            f"ResponseWriter._write_failed(): storing {len(rows)} captured "
+            f"responses failed: {failure.getErrorMessage()}"
+        )
+
+    # Writes whatever's still buffered and waits for the worker thread to
+    # finish. The backend is left open.
+    def close(self) -> None:
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        self.threadpool.stop()
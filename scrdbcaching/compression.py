@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import hashlib
+import zlib
+
+from typing import Any
+
+try:
+    import zstandard  # type: ignore[import-untyped]
+except ImportError:
+    zstandard = None
+
+
+__all__ = (
+    "BODY_CODECS",
+    "body_digest",
+    "body_from_row",
+    "compress_body",
+    "decompress_body",
+)
+
+
+# The ways a page body can be stored in the pages2 table, as recorded in each
+# row's body_codec column. "text" is the original format: the decoded body in
+# the MEDIUMTEXT body column. The others store the raw bytes of the body, as
+# they were received, in the MEDIUMBLOB body_blob column: "raw" as they are,
+# "zlib" and "zstd" compressed. None of those need any transcoding to turn the
+# body back into an HtmlResponse.
+BODY_CODECS: tuple[str, ...] = ("text", "raw", "zlib", "zstd")
+
+
+def _require_zstandard() -> None:
+    if zstandard is None:
+        raise ValueError(
+            "the 'zstd' body codec requires the zstandard package, which isn't "
+            "installed"
+        )
+
+
+def compress_body(data: bytes, codec: str, level: int = -1) -> bytes:
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    elif codec == "zstd":
+        _require_zstandard()
+        compressor = zstandard.ZstdCompressor(level=level if level > 0 else 3)
+        return compressor.compress(data)  # type: ignore[no-any-return]
+    raise ValueError(f"'{codec}' isn't a compressing body codec")
+
+
+def decompress_body(blob: bytes, codec: str) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(blob)
+    elif codec == "zstd":
+        _require_zstandard()
+        return zstandard.ZstdDecompressor().decompress(blob)  # type: ignore[no-any-return]
+    raise ValueError(f"'{codec}' isn't a compressing body codec")
+
+
+# Recovers the body of a pages2 row as bytes in the page's encoding, whichever
+# codec it was stored with. Rows from before the body_codec column existed
+# count as "text".
+def body_from_row(row_dict: dict[str, Any]) -> bytes:
+    codec: str | None = row_dict.get("body_codec")
+    if codec is None or codec == "text":
+        return row_dict["body"].encode(row_dict["encoding"])  # type: ignore[no-any-return]
+    body_blob: bytes | bytearray = row_dict["body_blob"]
+    if codec == "raw":
+        # The C extension of mysql.connector returns BLOBs as bytes, which are
+        # passed through as they are. The pure Python one returns bytearrays,
+        # which HtmlResponse won't accept, so those have to be copied.
+        return body_blob if isinstance(body_blob, bytes) else bytes(body_blob)
+    return decompress_body(body_blob, codec)  # type: ignore[arg-type]
+
+
+# The SHA-256 digest a stored body is deduplicated by, which is the key of the
+# bodies table. It's taken over the body as it's stored, along with its codec,
+# so rows only share a stored body if it would have been stored identically
+# for each of them; text bodies are digested as UTF-8.
+def body_digest(row_dict: dict[str, Any]) -> bytes:
+    codec: str = row_dict.get("body_codec") or "text"
+    stored: bytes = (
+        row_dict["body"].encode("utf-8")
+        if codec == "text"
+        else bytes(row_dict["body_blob"])
+    )
+    return hashlib.sha256(codec.encode("ascii") + b"\0" + stored).digest()
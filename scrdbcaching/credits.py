@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+import fcntl
+import json
+import logging
+import os
+
+from contextlib import contextmanager
+from scrapy.utils.misc import load_object  # type: ignore[import-untyped]
+from typing import Any, Iterator
+
+
+__all__ = ("CreditLedger", "FileCreditLedger", "load_credit_ledger")
+
+
+# The credit ledgers that can be picked by name with the DBCACHE_CREDIT_LEDGER
+# setting. As with the backends, a ledger's module is only imported when it's
+# picked.
+LEDGERS: dict[str, str] = {
+    "file": "scrdbcaching.credits.FileCreditLedger",
+    "mysql": "scrdbcaching.backends.mysql_credits.MySQLCreditLedger",
+}
+
+
+# An API credit budget shared by several crawler processes, possibly on
+# different machines, so that between them they never spend more than its
+# threshold. Each process reserves credits a block at a time, spends them
+# locally, and hands back whatever it didn't spend when it finishes; the
+# ledger only counts what's been reserved, so a process that dies keeps its
+# unspent reservation and the budget errs on the side of underspending.
+#
+# Every operation is atomic across processes.
+class CreditLedger:
+    @classmethod
+    def from_settings(cls, settings: Any) -> "CreditLedger":
+        raise NotImplementedError
+
+    # Creates the budget with these values if it doesn't exist yet. An
+    # existing budget is left as it is, so every worker in a sharded crawl can
+    # call this.
+    def open(self, credits_used: int, credits_threshold: int) -> None:
+        raise NotImplementedError
+
+    # Sets the budget to these values whether or not it exists.
+    def reset(self, credits_used: int, credits_threshold: int) -> None:
+        raise NotImplementedError
+
+    # Reserves up to `count` credits, and returns how many were reserved,
+    # which is 0 once the budget is spent.
+    def reserve(self, count: int) -> int:
+        raise NotImplementedError
+
+    # Gives back `count` reserved credits that weren't spent.
+    def release(self, count: int) -> None:
+        raise NotImplementedError
+
+    # Returns the credits used (that is, reserved) so far and the threshold.
+    def balance(self) -> tuple[int, int]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+# A credit budget kept in a small JSON file, for sharded crawls on one
+# machine. Every operation holds an exclusive fcntl lock on the file while it
+# reads and rewrites it.
+class FileCreditLedger(CreditLedger):
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @classmethod
+    def from_settings(cls, settings: Any) -> "FileCreditLedger":
+        return cls(settings.get("DBCACHE_CREDIT_LEDGER_PATH", "credits.ledger"))
+
+    # Opens the file locked for the duration of a with block, and yields its
+    # contents as a dict, which is empty if the budget doesn't exist yet. If
+    # the block changes the dict, it's written back before the lock is let go.
+    @contextmanager
+    def _locked(self) -> Iterator[dict[str, Any]]:
+        fd: int = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                content: str = fh.read()
+                state: dict[str, Any] = json.loads(content) if content else dict()
+                before: dict[str, Any] = dict(state)
+                yield state
+                if state != before:
+                    fh.seek(0)
+                    fh.truncate()
+                    json.dump(state, fh)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def open(self, credits_used: int, credits_threshold: int) -> None:
+        with self._locked() as state:
+            if not state:
+                state.update(
+                    credits_used=int(credits_used),
+                    credits_threshold=int(credits_threshold),
+                )
+
+    def reset(self, credits_used: int, credits_threshold: int) -> None:
+        with self._locked() as state:
+            state.update(
+                credits_used=int(credits_used), credits_threshold=int(credits_threshold)
+            )
+
+    def reserve(self, count: int) -> int:
+        with self._locked() as state:
+            granted: int = max(
+                min(int(count), state["credits_threshold"] - state["credits_used"]), 0
+            )
+            state["credits_used"] += granted
+        return granted
+
+    def release(self, count: int) -> None:
+        with self._locked() as state:
+            state["credits_used"] -= int(count)
+
+    def balance(self) -> tuple[int, int]:
+        with self._locked() as state:
+            return state["credits_used"], state["credits_threshold"]
+
+
+# Instances the credit ledger named by the DBCACHE_CREDIT_LEDGER setting: one
+# of the names in LEDGERS, or the import path of a CreditLedger subclass. If
+# the setting is empty there's no ledger, and DatabaseCachingMiddleware counts
+# credits in-process as it always has.
+def load_credit_ledger(settings: Any) -> CreditLedger | None:
+    ledger: str = settings.get("DBCACHE_CREDIT_LEDGER") or ""
+    if not ledger:
+        return None
+    ledger_cls: type[CreditLedger] = load_object(LEDGERS.get(ledger, ledger))
+    logging.info(f"load_credit_ledger(): using '{ledger}' credit ledger")
+    return ledger_cls.from_settings(settings)
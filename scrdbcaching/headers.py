@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+import json
+import struct
+
+from itertools import accumulate, islice
+from typing import Any, Iterator, Mapping, Sequence
+
+
+__all__ = ("HEADERS_FORMATS", "headers_from_row", "pack_headers", "unpack_headers")
+
+
+# The ways response headers can be stored in the pages2 table. "json" is the
+# original format: a JSON object of decoded strs in the headers column.
+# "binary" packs the header bytes as they are into the headers_blob column, so
+# they round-trip to scrapy's bytes-keyed Headers with no transcoding.
+HEADERS_FORMATS: tuple[str, ...] = ("json", "binary")
+
+# The binary format is laid out so it can be unpacked with a couple of struct
+# calls and slicing, rather than a read per field: a version byte; the number
+# of header names as a 2-byte unsigned int; the number of values each name has,
+# as 2-byte unsigned ints; the lengths of each name followed by its values, as
+# 4-byte unsigned ints; and then the bytes of every name and value, end to end,
+# in the same order. All ints are big-endian.
+FORMAT_VERSION: bytes = b"\x01"
+
+
+def _to_bytes(value: bytes | str, encoding: str) -> bytes:
+    return value if isinstance(value, bytes) else value.encode(encoding)
+
+
+# Packs a mapping of header names to lists of values into the binary format.
+# Names and values are expected to be bytes, as they are in scrapy's Headers;
+# strs are encoded with the given encoding.
+def pack_headers(
+    headers: Mapping[bytes | str, Sequence[bytes | str]], encoding: str = "utf-8"
+) -> bytes:
+    counts: list[int] = list()
+    lengths: list[int] = list()
+    data: list[bytes] = list()
+    for key, values in headers.items():
+        key_bytes: bytes = _to_bytes(key, encoding)
+        counts.append(len(values))
+        lengths.append(len(key_bytes))
+        data.append(key_bytes)
+        for value in values:
+            value_bytes: bytes = _to_bytes(value, encoding)
+            lengths.append(len(value_bytes))
+            data.append(value_bytes)
+    prefix: bytes = struct.pack(
+        f"!H{len(counts)}H{len(lengths)}I", len(counts), *counts, *lengths
+    )
+    return b"".join((FORMAT_VERSION, prefix, *data))
+
+
+def unpack_headers(blob: bytes | bytearray) -> dict[bytes, list[bytes]]:
+    if blob[:1] != FORMAT_VERSION:
+        raise ValueError(f"unrecognized binary headers format {bytes(blob[:1])!r}")
+    blob = bytes(blob)
+    (key_count,) = struct.unpack_from("!H", blob, 1)
+    counts: tuple[int, ...] = struct.unpack_from(f"!{key_count}H", blob, 3)
+    field_count: int = key_count + sum(counts)
+    offset: int = 3 + 2 * key_count
+    lengths: tuple[int, ...] = struct.unpack_from(f"!{field_count}I", blob, offset)
+    offsets: list[int] = list(accumulate(lengths, initial=offset + 4 * field_count))
+    fields: Iterator[bytes] = iter(
+        [blob[start:end] for start, end in zip(offsets, offsets[1:])]
+    )
+    # Each name is followed by as many values as its count says.
+    return {next(fields): list(islice(fields, count)) for count in counts}
+
+
+# Recovers the headers of a pages2 row as a dict of bytes to lists of bytes,
+# whichever format they were stored in.
+def headers_from_row(row_dict: dict[str, Any]) -> dict[bytes, list[bytes]]:
+    if row_dict.get("headers_blob") is not None:
+        return unpack_headers(row_dict["headers_blob"])
+    # The JSON format holds strs, which have to be cast back to bytes.
+    encoding: str = row_dict["encoding"]
+    return {
+        key.encode(encoding): [v.encode(encoding) for v in value]
+        for key, value in json.loads(row_dict["headers"]).items()
+    }
@@ -3,9 +3,15 @@
 import json
 import logging
 
+from datetime import datetime, timezone
 from email.utils import parsedate_to_datetime
 from scrapy import Field, Item  # type: ignore[import-untyped]
 from scrapy.http import HtmlResponse  # type: ignore[import-untyped]
+from typing import Any
+
+from .compression import compress_body
+from .headers import pack_headers
+from .utility import debug_logging_enabled, url_digest
 
 
 __all__ = ("SerializableItem",)
@@ -20,45 +26,124 @@ class SerializableItem(Item):  # type: ignore[misc]
     body: Field = Field()
     encoding: Field = Field()
     date: Field = Field()
+    # True if the response is already in the database, because
+    # DatabaseCachingMiddleware served it from there rather than downloading
+    # it, or captured it as it was downloaded. It isn't stored.
+    from_cache: Field = Field()
 
     # Factory method that draws upon an HtmlResponse object to initialize values.
+    # The headers and body are decoded to strs, so the item can go to a feed
+    # export or any other pipeline as it is. With keep_bytes they're kept as
+    # the bytes they arrived as instead, which saves decoding them only to
+    # encode them again when the item is going to be stored with a binary body
+    # codec; to_dict() takes either.
     @classmethod
-    def from_htmlresponse(cls, hresp: HtmlResponse) -> Item:
-        logging.info(
-            "SerializableItem.from_htmlresponse(): instancing item from "
-            f"HtmlResponse for URL '{hresp.url}'"
-        )
+    def from_htmlresponse(cls, hresp: HtmlResponse, keep_bytes: bool = False) -> Item:
+        if debug_logging_enabled():
+            logging.debug(
+                "SerializableItem.from_htmlresponse(): instancing item from "
+                f"HtmlResponse for URL '{hresp.url}'"
+            )
         this = cls()
         this["url"] = hresp.url
         this["status"] = hresp.status
         this["encoding"] = hresp.encoding
         # hresp.headers is a pseudo-dict where all the data are bytes objects,
         # and the values are lists not single objects.
-        this["headers"] = {
-            key.decode(hresp.encoding): [v.decode(hresp.encoding) for v in value]
-            for key, value in hresp.headers.items()
-        }
-        # Storing the server date & time of the resource. For use with
-        # If-Modified-Since if that becomes a suitable download strategy.
-        this["date"] = (
-            parsedate_to_datetime(hresp.headers["Date"].decode(hresp.encoding))
-            if "Date" in hresp.headers
-            else None
+        this["headers"] = (
+            dict(hresp.headers.items())
+            if keep_bytes
+            else {
+                key.decode(hresp.encoding): [v.decode(hresp.encoding) for v in value]
+                for key, value in hresp.headers.items()
+            }
+        )
+        # Storing the server date & time of the resource, which is when the
+        # stored row counts as fresh from (see DBCACHE_TTL), and what's sent
+        # as If-Modified-Since when it's revalidated. If the server didn't
+        # send a Date header, a response that just came over the network is
+        # dated with the local time it arrived, which is as good. Any other
+        # undated response, such as one built by hand or one with no request,
+        # could be of any age, so it's left without a date and never counts
+        # as fresh.
+        if "Date" in hresp.headers:
+            this["date"] = parsedate_to_datetime(
+                hresp.headers["Date"].decode(hresp.encoding)
+            )
+        elif hresp.request is not None and not hresp.request.meta.get(
+            "dbcache_served", False
+        ):
+            this["date"] = datetime.now(timezone.utc)
+        else:
+            this["date"] = None
+        this["body"] = hresp.body if keep_bytes else hresp.body.decode(hresp.encoding)
+        this["from_cache"] = hresp.request is not None and bool(
+            hresp.request.meta.get("dbcache_served", False)
+            or hresp.request.meta.get("dbcache_stored", False)
         )
-        this["body"] = hresp.body.decode(hresp.encoding)
         return this
 
-    def to_dict(self) -> dict[str, str | int]:
-        logging.info(
-            f"SerializableItem.to_dict(): converting item for URL {self['url']} to dict"
-        )
+    # The body is stored with the given codec; see compression.BODY_CODECS. The
+    # headers are stored in the given format; see headers.HEADERS_FORMATS.
+    def to_dict(
+        self,
+        body_codec: str = "text",
+        compression_level: int = -1,
+        headers_format: str = "json",
+    ) -> dict[str, Any]:
+        if debug_logging_enabled():
+            logging.debug(
+                f"SerializableItem.to_dict(): converting item for URL {self['url']} "
+                "to dict"
+            )
+        # The body and headers are strs or bytes, depending on how the item
+        # was built; see from_htmlresponse().
+        raw_body: bytes | str = self["body"]
+        body: str | None = None
+        body_blob: bytes | None = None
+        if body_codec == "text":
+            body = (
+                raw_body.decode(self["encoding"])
+                if isinstance(raw_body, bytes)
+                else raw_body
+            )
+        else:
+            if isinstance(raw_body, str):
+                raw_body = raw_body.encode(self["encoding"])
+            body_blob = (
+                raw_body
+                if body_codec == "raw"
+                else compress_body(raw_body, body_codec, compression_level)
+            )
+        headers: str | None = None
+        headers_blob: bytes | None = None
+        if headers_format == "binary":
+            headers_blob = pack_headers(self["headers"], self["encoding"])
+        else:
+            # This dict is intended for storage to the database. So JSON is
+            # used to serialize the headers dict, which means any bytes in it
+            # have to be decoded first.
+            headers = json.dumps(
+                {
+                    _to_str(key, self["encoding"]): [
+                        _to_str(v, self["encoding"]) for v in value
+                    ]
+                    for key, value in self["headers"].items()
+                }
+            )
         return {
             "url": self["url"],
+            "url_hash": url_digest(self["url"]),
             "status": self["status"],
-            # This dict is intended for storage to the database. So JSON is used
-            # to serialize the headers dict.
-            "headers": json.dumps(self["headers"]),
-            "body": self["body"],
+            "headers": headers,
+            "headers_blob": headers_blob,
+            "body": body,
+            "body_blob": body_blob,
+            "body_codec": body_codec,
             "encoding": self["encoding"],
             "date": self["date"],
         }
+
+
+def _to_str(value: bytes | str, encoding: str) -> str:
+    return value.decode(encoding) if isinstance(value, bytes) else value
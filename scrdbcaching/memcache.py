@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+from collections import OrderedDict
+from typing import Any
+
+
+__all__ = ("LruRowCache",)
+
+
+# An in-process cache of pages2 rows, keyed by URL, that evicts the least
+# recently used rows once the total size of the rows it holds exceeds a byte
+# cap. It's used by DatabaseCachingMiddleware as a memory tier in front of the
+# database, so repeat lookups for the same URL (redirect chains, retries,
+# duplicate links) skip the pool checkout and the network round trip.
+#
+# It isn't thread-safe; DatabaseCachingMiddleware only touches it from the
+# reactor thread.
+class LruRowCache:
+    max_bytes: int
+    max_entry_bytes: int
+    current_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    rows: OrderedDict[str, tuple[dict[str, Any], int]]
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int = 0) -> None:
+        self.max_bytes = int(max_bytes)
+        # A max entry size of 0 means any row that fits in the cache at all
+        # can be stored.
+        self.max_entry_bytes = int(max_entry_bytes) or self.max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rows = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.rows
+
+    # Estimates the memory footprint of a row from the sizes of its str and
+    # bytes values, which is where nearly all of it is.
+    @staticmethod
+    def row_size(row: dict[str, Any]) -> int:
+        return sum(
+            len(value)
+            for value in row.values()
+            if isinstance(value, (str, bytes, bytearray))
+        )
+
+    def get(self, url: str) -> dict[str, Any] | None:
+        entry: tuple[dict[str, Any], int] | None = self.rows.get(url)
+        if entry is None:
+            self.misses += 1
+            return None
+        # Marking the row as most recently used.
+        self.rows.move_to_end(url)
+        self.hits += 1
+        return entry[0]
+
+    # Stores a row, evicting least recently used rows to make room for it.
+    # Returns False if the row is too large to be cached.
+    def put(self, url: str, row: dict[str, Any]) -> bool:
+        size: int = self.row_size(row)
+        if size > self.max_entry_bytes or size > self.max_bytes:
+            return False
+        self.discard(url)
+        self.rows[url] = (row, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.rows.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        return True
+
+    def discard(self, url: str) -> None:
+        entry: tuple[dict[str, Any], int] | None = self.rows.pop(url, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def clear(self) -> None:
+        self.rows.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.rows),
+            "bytes": self.current_bytes,
+        }
@@ -1,19 +1,33 @@
 #!/usr/bin/python3
 
-import json
 import logging
 import os
-import time
 
-from mysql.connector.cursor import MySQLCursor
-from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
 from scrapy.crawler import Crawler  # type: ignore[import-untyped]
 from scrapy.exceptions import CloseSpider  # type: ignore[import-untyped]
-from scrapy.http import Request, HtmlResponse  # type: ignore[import-untyped]
+from scrapy.http import HtmlResponse, Request, Response, TextResponse  # type: ignore[import-untyped]
 from scrapy import Spider, signals  # type: ignore[import-untyped]
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from typing import Any
 
+from .backends import CacheBackend, load_backend
+from .batching import LookupBatcher
+from .capture import DEFAULT_STATUS_POLICY, ResponseWriter, parse_status_policy
+from .bloom import BloomFilter
+from .compression import body_from_row
+from .credits import CreditLedger, load_credit_ledger
+from .headers import headers_from_row
+from .items import SerializableItem
+from .memcache import LruRowCache
+from .ratelimit import TokenBucket
 from .spider import UrlSetSpider
+from .stats import CacheStats
+from .utility import debug_logging_enabled
 
 
 __all__ = ("DatabaseCachingMiddleware", "RenderingRateLimitingMiddleware")
@@ -24,80 +38,318 @@ __all__ = ("DatabaseCachingMiddleware", "RenderingRateLimitingMiddleware")
 # retrieved, an HtmlResponse object is deserialized from its attributes, and
 # returned in place of a retrieved one. This is done to save API credits and
 # time.
+#
+# Responses served from the database are flagged with a "dbcache_served" key in
+# their request's meta, and responses this middleware captured (see below)
+# with a "dbcache_stored" one. SerializableItem.from_htmlresponse() carries
+# either over to the item so SerializingDatabasePipeline knows not to store it
+# again. RedirectMiddleware and RetryMiddleware copy a request's meta onto the
+# requests they make, so process_request() clears the flags from every request
+# it sees; they only ever describe the response to that request.
+#
+# The database is reached through the page cache backend picked by the
+# DBCACHE_BACKEND setting; see backends.load_backend(). With the mysql backend
+# its connection pool is shared with SerializingDatabasePipeline, and lookups
+# go to a read replica if MYSQL_REPLICA_HOST is set; see backends.pool.
+#
+# If the DBCACHE_ASYNC_LOOKUPS setting is True, the database query is run on a
+# bounded worker thread pool (DBCACHE_LOOKUP_THREADS threads, capped at
+# CONCURRENT_REQUESTS) and process_request() returns a Deferred, so the
+# reactor thread is never blocked waiting on MySQL.
+#
+# If the DBCACHE_MEMORY_CACHE_BYTES setting is nonzero, rows that have been
+# served, and rows captured from responses (see below), are also kept in an
+# in-process LRU cache capped at that many bytes, so a repeat lookup for the
+# same URL doesn't touch the database at all. Rows larger than
+# DBCACHE_MEMORY_CACHE_MAX_ENTRY_BYTES aren't kept, and a row that's gone
+# stale is dropped from it.
+#
+# If the DBCACHE_BATCH_SIZE setting is greater than 1, lookups arriving within
+# DBCACHE_BATCH_WINDOW seconds of each other, up to DBCACHE_BATCH_SIZE distinct
+# URLs, are coalesced into a single SELECT ... WHERE url IN (...) query on one
+# pooled connection. Batching implies asynchronous lookups.
+#
+# If the DBCACHE_BLOOM_FILTER setting is True, a Bloom filter of every URL in
+# pages2 is built at startup and saved to the spider as `url_filter`, where
+# SerializingDatabasePipeline adds newly stored URLs to it. URLs the filter
+# rules out are treated as cache misses without querying the database. The
+# filter is sized for DBCACHE_BLOOM_CAPACITY URLs (by default twice the current
+# row count) at a false positive rate of DBCACHE_BLOOM_ERROR_RATE, and is
+# capped at DBCACHE_BLOOM_MAX_BYTES bytes if that's nonzero.
+#
+# If the DBCACHE_URL_HASH_KEY setting is True, rows are looked up by the
+# fixed-width url_hash digest of the URL's canonical form rather than by the
+# url column, so equivalent URLs share a record. The table has to have been
+# migrated to have that column (see pages2_migrate.py url-hash). Since a digest
+# could in principle collide, the canonical form of the stored URL is checked
+# against the requested one before a row is served. The sqlite backend is
+# always keyed this way.
+#
+# If the DBCACHE_DEDUP_BODIES setting is True, bodies stored once each in the
+# bodies table are joined in by the backend as rows are looked up.
+#
+# If the DBCACHE_TTL setting is nonzero, a row is only served as it is for
+# that many seconds after its date. A row older than that is stale: the
+# request goes to the network as a miss, and if DBCACHE_REVALIDATE is True it
+# carries If-Modified-Since (and If-None-Match, if an ETag was stored) so the
+# server can answer 304 Not Modified. On a 304 the stored row's date is
+# refreshed and it's served in place of the empty response, counted as a hit
+# as well as under dbcache/revalidated; otherwise the new response replaces
+# the row by way of SerializingDatabasePipeline. Rows with no date, which only
+# responses that didn't come over the network can have (see
+# SerializableItem.from_htmlresponse()), are always stale.
+#
+# If the DBCACHE_KEEP_VERSIONS setting is nonzero, a row that a new fetch
+# replaces is kept in the pages2_history table, and compact_pages.py trims the
+# history to that many versions per URL. pages2 only ever holds the newest
+# version, so that's the one that's served.
+#
+# If the DBCACHE_CREDIT_LEDGER setting is set, the credit budget is kept in a
+# ledger shared with other crawler processes (see credits.CreditLedger), so
+# several shards of a crawl can spend one budget without overspending it.
+# Credits are reserved from it DBCACHE_CREDIT_BLOCK at a time, and whatever's
+# left of the last block is handed back when the spider closes. The
+# credits_used and credits_threshold spider arguments then only seed the
+# ledger if it doesn't exist yet.
+#
+# If the DBCACHE_CAPTURE_RESPONSES setting is True, responses that come over
+# the network are stored by this middleware, without waiting for the spider to
+# yield an item for them, if their status is in the DBCACHE_STATUS_POLICY
+# setting: a dict mapping statuses to how many seconds rows with them stay
+# fresh (0 for forever, or None for DBCACHE_TTL). It defaults to
+# capture.DEFAULT_STATUS_POLICY, which caches 404s and 410s negatively, so
+# known-dead URLs cost no credits on a repeat run. Captured rows are buffered
+# and written DBCACHE_CAPTURE_BATCH_ROWS at a time, or every
+# DBCACHE_CAPTURE_INTERVAL seconds, on a writer thread off the reactor; see
+# capture.ResponseWriter. They're stored in the formats the
+# DBCACHE_BODY_CODEC and DBCACHE_HEADERS_FORMAT settings pick, as the
+# pipeline's are. To capture redirects, this middleware has to come after
+# RedirectMiddleware (600) in the DOWNLOADER_MIDDLEWARES order, so it sees
+# their responses first. That also puts it ahead of HttpCompressionMiddleware
+# (590), so a response that still has a Content-Encoding is left for the
+# response_received signal, which is sent once the response has been
+# decompressed; a compressed redirect never reaches it, and isn't captured. A
+# response that can't be serialized is logged, counted as
+# dbcache/capture_errors and passed on as it is.
+#
+# Hits, misses, bytes served and the time spent deserializing responses are
+# published to the crawler's stats collector under "dbcache/", along with the
+# backend's query and pool checkout timings; see stats.CacheStats. Per-request
+# log messages are only formatted if DEBUG logging is actually being written
+# out.
 class DatabaseCachingMiddleware:
-    db_user: str
-    db_password: str
-    db_host: str
-    db_database: str
-    db_charset: str
     credits_used: int
     credits_threshold: int
     concurrent_requests: int
-    db_conx_pool: MySQLConnectionPool
+    backend: CacheBackend
     stop_triggered: bool
+    async_lookups: bool
+    lookup_threadpool: ThreadPool | None
+    memory_cache: LruRowCache | None
+    lookup_batcher: LookupBatcher | None
+    url_filter: BloomFilter | None
+    ttl: timedelta | None
+    revalidate: bool
+    stats: CacheStats
+    log_requests: bool
+    credit_ledger: CreditLedger | None
+    credit_block: int
+    credits_reserved: int
+    status_ttls: dict[int, timedelta | None]
+    response_writer: ResponseWriter | None
+    body_codec: str
+    compression_level: int
+    headers_format: str
 
     def __init__(
         self,
-        db_user: str,
-        db_password: str,
-        db_host: str,
-        db_database: str,
-        db_charset: str,
+        backend: CacheBackend,
         concurrent_requests: int,
         credits_used: int,
         credits_threshold: int,
         crawler: Crawler,
+        async_lookups: bool = False,
+        lookup_threads: int = 0,
+        memory_cache_bytes: int = 0,
+        memory_cache_max_entry_bytes: int = 0,
+        batch_size: int = 0,
+        batch_window: float = 0.01,
+        bloom_filter: bool = False,
+        bloom_capacity: int = 0,
+        bloom_error_rate: float = 0.01,
+        bloom_max_bytes: int = 0,
+        ttl: float = 0,
+        revalidate: bool = True,
+        credit_ledger: CreditLedger | None = None,
+        credit_block: int = 100,
+        capture_responses: bool = False,
+        status_policy: dict[Any, Any] | None = None,
+        capture_batch_rows: int = 50,
+        capture_interval: float = 1.0,
+        body_codec: str = "text",
+        compression_level: int = -1,
+        headers_format: str = "json",
     ) -> None:
-        self.db_user = db_user
-        self.db_password = db_password
-        self.db_host = db_host
-        self.db_database = db_database
-        self.db_charset = db_charset
+        self.backend = backend
         self.concurrent_requests = concurrent_requests
+        # A TTL of 0 means rows never go stale.
+        self.ttl = timedelta(seconds=float(ttl)) if float(ttl) > 0 else None
+        self.revalidate = bool(revalidate)
+        # Responses are captured with the statuses in the status policy, which
+        # defaults to DEFAULT_STATUS_POLICY if they're being captured at all.
+        # The TTLs in it apply to rows with those statuses however they were
+        # stored.
+        if not status_policy and capture_responses:
+            status_policy = DEFAULT_STATUS_POLICY
+        self.status_ttls = parse_status_policy(status_policy or dict(), self.ttl)
+        self.body_codec = body_codec
+        self.compression_level = int(compression_level)
+        self.headers_format = headers_format
 
         # These are two commandline arguments that are saved to the spider
         # object during its constructor, then retrieved from there by
         # from_crawler() and passed to *this* constructor.
         self.credits_used = int(credits_used)
         self.credits_threshold = int(credits_threshold)
+        # With a credit ledger the budget is shared with other processes, and
+        # those values only seed it if it doesn't exist yet.
+        self.credit_ledger = credit_ledger
+        self.credit_block = max(int(credit_block), 1)
+        self.credits_reserved = 0
+        if self.credit_ledger is not None:
+            self.credit_ledger.open(self.credits_used, self.credits_threshold)
         logging.info(
             f"DatabaseCachingMiddleware.__init__(): set credits_used={credits_used}, "
             f"credits_threshold={credits_threshold}"
         )
         self.crawler = crawler
         self.stop_triggered = False
+        self.stats = CacheStats(crawler.stats)
+        self.backend.stats = self.stats
+        self.log_requests = debug_logging_enabled()
         self.crawler.signals.connect(
             self.on_spider_closed, signal=signals.spider_closed
         )
 
-        # Instancing the connection pool.
-        pool_name = self.__class__.__name__
-        logging.info(
-            f"DatabaseCachingMiddleware.__init__(): opening database connection "
-            f"pool '{pool_name}'"
-        )
-        self.db_conx_pool = MySQLConnectionPool(
-            pool_name=pool_name,
-            pool_size=self.concurrent_requests,
-            pool_reset_session=True,
-            user=self.db_user,
-            password=self.db_password,
-            host=self.db_host,
-            database=self.db_database,
-            charset=self.db_charset,
-        )
+        # Instancing the lookup thread pool if asynchronous lookups are
+        # enabled. Every worker thread holds a pooled connection while it
+        # queries, so there's no point in having more threads than
+        # connections; with the mysql backend the extra threads would just
+        # wait on the pool, which the pipeline draws on too.
+        self.async_lookups = bool(async_lookups) or int(batch_size) > 1
+        self.lookup_threadpool = None
+        if self.async_lookups:
+            lookup_threads = min(
+                int(lookup_threads) or self.concurrent_requests,
+                self.concurrent_requests,
+            )
+            logging.info(
+                f"DatabaseCachingMiddleware.__init__(): starting lookup thread "
+                f"pool with {lookup_threads} threads"
+            )
+            self.lookup_threadpool = ThreadPool(
+                minthreads=1,
+                maxthreads=lookup_threads,
+                name=f"{self.__class__.__name__}Lookups",
+            )
+            self.lookup_threadpool.start()
+
+        # Instancing the writer for captured responses if they're captured.
+        self.response_writer = None
+        if capture_responses:
+            logging.info(
+                "DatabaseCachingMiddleware.__init__(): capturing responses with "
+                f"statuses {', '.join(str(status) for status in sorted(self.status_ttls))}"
+            )
+            self.response_writer = ResponseWriter(
+                self.backend,
+                self.stats,
+                capture_batch_rows,
+                capture_interval,
+                f"{self.__class__.__name__}Writes",
+            )
+            self.crawler.signals.connect(
+                self.on_response_received, signal=signals.response_received
+            )
+
+        # Instancing the lookup batcher if batching is enabled.
+        self.lookup_batcher = None
+        if self.lookup_threadpool is not None and int(batch_size) > 1:
+            logging.info(
+                f"DatabaseCachingMiddleware.__init__(): batching lookups, up to "
+                f"{batch_size} URLs per {batch_window}s window"
+            )
+            self.lookup_batcher = LookupBatcher(
+                self.backend.get_many,
+                self.lookup_threadpool,
+                batch_size,
+                batch_window,
+            )
+
+        # Building the URL membership filter if it's enabled, and sharing it
+        # with the pipeline by way of the spider.
+        self.url_filter = None
+        if bloom_filter:
+            self.url_filter = self._build_url_filter(
+                bloom_capacity, bloom_error_rate, bloom_max_bytes
+            )
+            self.crawler.spider.url_filter = self.url_filter
+
+        # Instancing the in-memory row cache if it's enabled.
+        self.memory_cache = None
+        if int(memory_cache_bytes) > 0:
+            logging.info(
+                f"DatabaseCachingMiddleware.__init__(): enabling in-memory row "
+                f"cache capped at {memory_cache_bytes} bytes"
+            )
+            self.memory_cache = LruRowCache(
+                memory_cache_bytes, memory_cache_max_entry_bytes
+            )
 
     def on_spider_closed(self, spider: UrlSetSpider, reason: str) -> None:
         self.stop_triggered = True
+        # Downloader middlewares don't get a close_spider() call, so
+        # everything is shut down here. The lookup thread pool goes first,
+        # after any lookups still waiting on a batch window have been sent
+        # off, then the response writer, once it's stored whatever captured
+        # rows it has buffered, and the backend last of all.
+        if self.lookup_batcher is not None:
+            self.lookup_batcher.flush()
+        if self.lookup_threadpool is not None:
+            self.lookup_threadpool.stop()
+            self.lookup_threadpool = None
+        if self.response_writer is not None:
+            self.response_writer.close()
+            self.response_writer = None
+        if self.memory_cache is not None:
+            logging.info(
+                "DatabaseCachingMiddleware.on_spider_closed(): in-memory row "
+                f"cache stats: {self.memory_cache.stats()}"
+            )
+            self.memory_cache.clear()
+        # Handing back the credits reserved from the ledger that weren't spent,
+        # so other processes can have them.
+        if self.credit_ledger is not None:
+            if self.credits_reserved > 0:
+                self.credit_ledger.release(self.credits_reserved)
+                self.credits_reserved = 0
+            self.credit_ledger.close()
+        self.backend.close()
+
+    # Captures the responses process_response() left because they were still
+    # compressed, now that HttpCompressionMiddleware has decoded them. The
+    # signal is sent for every response, so anything that was served or has
+    # already been captured is passed over by _capture().
+    def on_response_received(
+        self, response: Response, request: Request, spider: UrlSetSpider
+    ) -> None:
+        if self.response_writer is not None:
+            self._capture(request, response)
 
     @classmethod
     def from_crawler(cls, crawler: Crawler) -> object:
         return cls(
-            db_user=crawler.settings.get("MYSQL_USERNAME"),
-            db_password=crawler.settings.get("MYSQL_PASSWORD"),
-            db_host=crawler.settings.get("MYSQL_HOST"),
-            db_database=crawler.settings.get("MYSQL_DATABASE"),
-            db_charset=crawler.settings.get("MYSQL_CHARSET"),
+            backend=load_backend(crawler.settings, cls.__name__, crawler),
             concurrent_requests=crawler.settings.get("CONCURRENT_REQUESTS"),
             # Passing these two values, which are commandline arguments
             # furnished to the spider constructor, to the middleware constructor
@@ -105,148 +357,440 @@ class DatabaseCachingMiddleware:
             credits_used=crawler.spider.credits_used,
             credits_threshold=crawler.spider.credits_threshold,
             crawler=crawler,
+            async_lookups=crawler.settings.getbool("DBCACHE_ASYNC_LOOKUPS", False),
+            lookup_threads=crawler.settings.getint("DBCACHE_LOOKUP_THREADS", 0),
+            memory_cache_bytes=crawler.settings.getint(
+                "DBCACHE_MEMORY_CACHE_BYTES", 0
+            ),
+            memory_cache_max_entry_bytes=crawler.settings.getint(
+                "DBCACHE_MEMORY_CACHE_MAX_ENTRY_BYTES", 0
+            ),
+            batch_size=crawler.settings.getint("DBCACHE_BATCH_SIZE", 0),
+            batch_window=crawler.settings.getfloat("DBCACHE_BATCH_WINDOW", 0.01),
+            bloom_filter=crawler.settings.getbool("DBCACHE_BLOOM_FILTER", False),
+            bloom_capacity=crawler.settings.getint("DBCACHE_BLOOM_CAPACITY", 0),
+            bloom_error_rate=crawler.settings.getfloat(
+                "DBCACHE_BLOOM_ERROR_RATE", 0.01
+            ),
+            bloom_max_bytes=crawler.settings.getint("DBCACHE_BLOOM_MAX_BYTES", 0),
+            ttl=crawler.settings.getfloat("DBCACHE_TTL", 0),
+            revalidate=crawler.settings.getbool("DBCACHE_REVALIDATE", True),
+            credit_ledger=load_credit_ledger(crawler.settings),
+            credit_block=crawler.settings.getint("DBCACHE_CREDIT_BLOCK", 100),
+            capture_responses=crawler.settings.getbool(
+                "DBCACHE_CAPTURE_RESPONSES", False
+            ),
+            status_policy=crawler.settings.getdict("DBCACHE_STATUS_POLICY"),
+            capture_batch_rows=crawler.settings.getint(
+                "DBCACHE_CAPTURE_BATCH_ROWS", 50
+            ),
+            capture_interval=crawler.settings.getfloat(
+                "DBCACHE_CAPTURE_INTERVAL", 1.0
+            ),
+            body_codec=crawler.settings.get("DBCACHE_BODY_CODEC", "text"),
+            compression_level=crawler.settings.getint(
+                "DBCACHE_BODY_COMPRESSION_LEVEL", -1
+            ),
+            headers_format=crawler.settings.get("DBCACHE_HEADERS_FORMAT", "json"),
         )
 
-    def close_spider(self, spider: Spider) -> None:
-        # Close the database connection
-        if hasattr(self, "db_conx_pool"):
-            delattr(self, "db_conx_pool")
+    # Builds a Bloom filter from the lookup key of every row in the cache,
+    # which the backend streams in chunks. If the table is keyed by url_hash
+    # that's the digests, which are much less to transfer than the URLs.
+    def _build_url_filter(
+        self, capacity: int, error_rate: float, max_bytes: int
+    ) -> BloomFilter:
+        if int(capacity) <= 0:
+            # Leaving room for the table to double in size before the false
+            # positive rate climbs past what was asked for.
+            capacity = max(self.backend.count() * 2, 100_000)
+        url_filter: BloomFilter = BloomFilter(capacity, error_rate, max_bytes)
+        for key in self.backend.iter_keys():
+            url_filter.add(key)
+        logging.info(
+            f"DatabaseCachingMiddleware._build_url_filter(): built URL filter "
+            f"of {url_filter.size_bytes} bytes over {len(url_filter)} URLs, "
+            f"expected false positive rate {url_filter.expected_error_rate:.4f}"
+        )
+        return url_filter
 
     def process_request(
         self, request: Request, spider: UrlSetSpider
+    ) -> HtmlResponse | Deferred | None:
+        url: str = request.url
+        # Dropping whatever flags were copied from the request this one was
+        # made from, such as the cached redirect it follows.
+        for key in ("dbcache_served", "dbcache_stored", "dbcache_stale_row"):
+            request.meta.pop(key, None)
+        # Checking the in-memory row cache first, if there is one.
+        if self.memory_cache is not None:
+            cached_row: dict[str, Any] | None = self.memory_cache.get(url)
+            if cached_row is not None:
+                self.stats.inc("memory_hits")
+                return self._handle_row(cached_row, request, spider)
+        # If the URL filter rules the URL out there's no record for it, so the
+        # database doesn't need to be asked.
+        if self.url_filter is not None and self.backend.key_for(url) not in self.url_filter:
+            self.stats.inc("filter_skips")
+            return self._handle_row(None, request, spider)
+        deferred: Deferred
+        if self.lookup_batcher is not None:
+            # Handing the URL to the batcher, which will look it up along with
+            # whatever other URLs arrive within the batch window.
+            deferred = self.lookup_batcher.lookup(url)
+            deferred.addCallback(self._remember_row, url)
+            deferred.addCallback(self._handle_row, request, spider)
+            return deferred
+        if self.lookup_threadpool is not None:
+            # The twisted reactor can't be imported at module level in a
+            # scrapy component, since that would install the default reactor
+            # before scrapy gets to install the one it's configured to use.
+            from twisted.internet import reactor
+
+            # Running the query on the lookup thread pool. The row is handed
+            # back to the reactor thread, which is where the credits
+            # accounting and the HtmlResponse deserialization happen.
+            deferred = deferToThreadPool(
+                reactor, self.lookup_threadpool, self.backend.get, url
+            )
+            deferred.addCallback(self._remember_row, url)
+            deferred.addCallback(self._handle_row, request, spider)
+            return deferred
+        return self._handle_row(
+            self._remember_row(self.backend.get(url), url), request, spider
+        )
+
+    # Stores a row fetched from the database in the in-memory row cache, if
+    # there is one, and passes it through.
+    def _remember_row(
+        self, row: dict[str, Any] | None, url: str
+    ) -> dict[str, Any] | None:
+        if row is not None and self.memory_cache is not None:
+            self.memory_cache.put(url, row)
+        return row
+
+    # Turns the result of a lookup into the return value of process_request():
+    # a deserialized HtmlResponse on a cache hit, or None to let the request
+    # go to the network if there are credits left to spend.
+    def _handle_row(
+        self, row_dict: dict[str, Any] | None, request: Request, spider: UrlSetSpider
     ) -> HtmlResponse | None:
-        # Getting a connection from the pool
-        db_conn: PooledMySQLConnection = self.db_conx_pool.get_connection()
-        db_cursor: MySQLCursor = db_conn.cursor()
         url: str = request.url
-        # Check the database for the cached page
-        try:
-            # Checking the database for a record with this url. The columns of
-            # the pages2 table correspond to the constructor arguments needed to
-            # instance an HtmlResponse, plus 'date' for If-Modified-Since usage
-            # where needed.
-            db_cursor.execute(
-                "SELECT url, status, encoding, headers, body FROM pages2 WHERE url = %(url)s;",
-                dict(url=url),
-            )
-            row: tuple[Any, ...] = db_cursor.fetchone()  # type:ignore
-            if row is not None:
-                # A record was found, so an HtmlResponse object is deserialized
-                # from its values and returned in place of having to retrieve
-                # one over the network.
-                logging.info(
-                    f"DatabaseCachingMiddleware.process_request(): loaded record "
-                    f"from database for URL '{url}'; deserializing HtmlResponse "
-                    f"object"
+        if row_dict is not None and not self._is_fresh(row_dict):
+            # The record has outlived the TTL, so it's treated as a miss. If
+            # it's being revalidated, the request is made conditional on the
+            # page having changed since, and the row is kept on the request
+            # for process_response() to serve if it hasn't.
+            self.stats.inc("stale")
+            # Whatever the request brings back supersedes the row, so it
+            # mustn't be served from memory in the meantime.
+            if self.memory_cache is not None:
+                self.memory_cache.discard(url)
+            if self.log_requests:
+                logging.debug(
+                    f"DatabaseCachingMiddleware.process_request(): record for "
+                    f"URL '{url}' dated {row_dict['date']} is stale"
                 )
-                # Converting the row to a dict.
-                row_dict: dict[str, str | int] = dict(
-                    zip(("url", "status", "encoding", "headers", "body"), row)
+            if self.revalidate and row_dict["date"] is not None:
+                self._make_conditional(request, row_dict)
+            row_dict = None
+        if row_dict is not None:
+            # A record was found, so an HtmlResponse object is deserialized
+            # from its values and returned in place of having to retrieve
+            # one over the network.
+            if self.log_requests:
+                logging.debug(
+                    f"DatabaseCachingMiddleware.process_request(): loaded "
+                    f"record from database for URL '{url}'; deserializing "
+                    f"HtmlResponse object"
                 )
-                logging.info(
-                    f"DatabaseCachingMiddleware.process_request(): adding to "
-                    f"URLs deserialized set URL '{url}'"
+            request.meta["dbcache_served"] = True
+            self.stats.inc("hits")
+            return self._response_from_row(row_dict, request)
+        elif self.stop_triggered or not self._credits_left():
+            if not self.stop_triggered:
+                # We've met or exceeded the number of API credits this execution
+                # is authorized to use. That's it, close it down, we're done
+                # here.
+                credits_used, credits_threshold = (
+                    self.credit_ledger.balance()
+                    if self.credit_ledger is not None
+                    else (self.credits_used, self.credits_threshold)
                 )
-                spider.urls_deserialized.add(url)
-                return HtmlResponse(
-                    url=row_dict["url"],
-                    status=row_dict["status"],
-                    encoding=row_dict["encoding"],
-                    # n.b. the value for `headers` is a dict serialized via
-                    # JSON. HtmlResponse expects all its values to be bytes not
-                    # strs so this is needed to cast everything back to bytes.
-                    headers={
-                        key.encode(row_dict["encoding"]): [
-                            v.encode(row_dict["encoding"]) for v in value
-                        ]
-                        for key, value in json.loads(row_dict["headers"]).items()  # type: ignore[arg-type]
-                    },
-                    body=row_dict["body"].encode(row_dict["encoding"]),  # type: ignore[union-attr, arg-type]
-                    # The associated Request object is an optional but
-                    # nice-to-have for an HtmlResponse object. Obv. the original
-                    # can't be used, nor is it worth de/serializing, but the one
-                    # that's an argument to this method will do just as well.
-                    request=request,
+                logging.critical(
+                    "DatabaseCachingMiddleware.process_request(): credits "
+                    f"used {credits_used} meets or exceeds threshold "
+                    f"{credits_threshold}; SHUTTING DOWN SPIDER"
                 )
-            elif self.stop_triggered or self.credits_used >= self.credits_threshold:
-                if self.credits_used >= self.credits_threshold:
-                    # We've met or exceeded the number of API credits this execution
-                    # is authorized to use. That's it, close it down, we're done
-                    # here.
-                    logging.critical(
-                        "DatabaseCachingMiddleware.process_request(): credits "
-                        f"used {self.credits_used} meets or exceeds threshold "
-                        f"{self.credits_threshold}; SHUTTING DOWN SPIDER"
-                    )
-                    self.crawler.engine.close_spider(
-                        spider,
-                        f"API credits exhausted: {self.credits_used}/"
-                        f"{self.credits_threshold}",
-                    )
-                else:
-                    raise CloseSpider(
-                        "DatabaseCachingMiddleware.process_request(): API "
-                        "credits used has hit API credits threshold of "
-                        f"{self.credits_threshold}; spider closing down..."
-                    )
+                self.crawler.engine.close_spider(
+                    spider,
+                    f"API credits exhausted: {credits_used}/{credits_threshold}",
+                )
+                return None
             else:
-                # There's no record in the database for this URL and we still
-                # have credits to spare, so retrieving can happen normally
-                # (which is signalled by returning None).
-                logging.info(
+                raise CloseSpider(
+                    "DatabaseCachingMiddleware.process_request(): API "
+                    "credits used has hit API credits threshold of "
+                    f"{self.credits_threshold}; spider closing down..."
+                )
+        else:
+            # There's no record in the database for this URL and we still
+            # have credits to spare, so retrieving can happen normally
+            # (which is signalled by returning None).
+            self.stats.inc("misses")
+            self.credits_used += 1
+            if self.credit_ledger is not None:
+                self.credits_reserved -= 1
+            if self.log_requests:
+                logging.debug(
                     f"cache miss for URL '{url}', loading resource via network "
                     "as normal"
                 )
-                self.credits_used += 1
-                logging.info(
+                logging.debug(
                     f"incrementing credits_used value to {self.credits_used} "
                     f"(out of {self.credits_threshold})"
                 )
-                return None
-        finally:
-            # Ensuring the pool's connection is deallocated no matter what
-            # happens.
-            db_cursor.close()
-            db_conn.close()
+            return None
+
+    # Whether there's a credit left to spend on a request. With a credit
+    # ledger, another block of credits is reserved from it whenever the last
+    # one runs out; it's 0 once the shared budget is spent.
+    def _credits_left(self) -> bool:
+        if self.credit_ledger is None:
+            return self.credits_used < self.credits_threshold
+        if self.credits_reserved <= 0:
+            self.credits_reserved = self.credit_ledger.reserve(self.credit_block)
+            logging.info(
+                f"DatabaseCachingMiddleware._credits_left(): reserved "
+                f"{self.credits_reserved} credits from the ledger"
+            )
+        return self.credits_reserved > 0
+
+    def _response_from_row(
+        self, row_dict: dict[str, Any], request: Request
+    ) -> HtmlResponse:
+        with self.stats.timer("deserialize"):
+            response: HtmlResponse = self._deserialize_row(row_dict, request)
+        self.stats.inc("bytes_served", len(response.body))
+        return response
+
+    @staticmethod
+    def _deserialize_row(row_dict: dict[str, Any], request: Request) -> HtmlResponse:
+        return HtmlResponse(
+            url=row_dict["url"],
+            status=row_dict["status"],
+            encoding=row_dict["encoding"],
+            # n.b. HtmlResponse expects all the header names and values to be
+            # bytes not strs. headers_from_row() unpacks them as bytes from
+            # either of the formats they can be stored in.
+            headers=headers_from_row(row_dict),
+            # The body may be stored compressed; body_from_row() returns it as
+            # bytes in the page's encoding either way.
+            body=body_from_row(row_dict),
+            # The associated Request object is an optional but nice-to-have
+            # for an HtmlResponse object. Obv. the original can't be used, nor
+            # is it worth de/serializing, but the one that's an argument to
+            # process_request() will do just as well.
+            request=request,
+        )
+
+    # A row is fresh if there's no TTL, or if it's dated within the TTL of
+    # now. The TTL is the one the status policy gives the row's status, if it
+    # has one, or DBCACHE_TTL. Dates read back from MySQL DATETIME columns are
+    # naive, and are taken to be UTC. A row with no date can't be shown to be
+    # fresh.
+    def _is_fresh(self, row_dict: dict[str, Any]) -> bool:
+        ttl: timedelta | None = self.status_ttls.get(row_dict["status"], self.ttl)
+        if ttl is None:
+            return True
+        date: datetime | None = row_dict.get("date")
+        if date is None:
+            return False
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - date < ttl
+
+    # Adds the conditional request headers that let the server answer 304 Not
+    # Modified if the page hasn't changed since the row was stored.
+    @staticmethod
+    def _make_conditional(request: Request, row_dict: dict[str, Any]) -> None:
+        date: datetime = row_dict["date"]
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        request.headers[b"If-Modified-Since"] = format_datetime(
+            date.astimezone(timezone.utc), usegmt=True
+        )
+        for key, values in headers_from_row(row_dict).items():
+            if key.lower() == b"etag" and values:
+                request.headers[b"If-None-Match"] = values[0]
+                break
+        request.meta["dbcache_stale_row"] = row_dict
 
+    # If a revalidated request came back 304 Not Modified, the stored row is
+    # still good, so its date is brought up to now and it's served in place of
+    # the empty 304 response. Any other response goes on as it is.
+    def process_response(
+        self, request: Request, response: Response, spider: UrlSetSpider
+    ) -> Response | Deferred:
+        row_dict: dict[str, Any] | None = request.meta.get("dbcache_stale_row")
+        if row_dict is not None and response.status == 304:
+            return self._serve_revalidated(request, row_dict)
+        if self.response_writer is not None:
+            self._capture(request, response)
+        return response
 
-# Downloader middleware that activates if the render=True argument is being
-# passed to ScraperAPI via the HTTPS_PROXY username argument. If so it
-# rate-limits requests to ≤3 per second in conformance with ScraperAPI API
-# limits.
+    # Stores a response that came over the network, if its status is one the
+    # status policy covers, by way of the response writer. The request is
+    # flagged so that an item built from the response isn't stored again by
+    # SerializingDatabasePipeline. Responses without a text encoding can't be
+    # stored in pages2, so they're passed over, as are responses that are still
+    # compressed.
+    def _capture(self, request: Request, response: Response) -> None:
+        if (
+            request.meta.get("dbcache_served")
+            or request.meta.get("dbcache_stored")
+            or response.status not in self.status_ttls
+            or not isinstance(response, TextResponse)
+            or b"Content-Encoding" in response.headers
+        ):
+            return
+        try:
+            with self.stats.timer("serialize"):
+                row: dict[str, Any] = SerializableItem.from_htmlresponse(
+                    response, keep_bytes=self.body_codec != "text"
+                ).to_dict(self.body_codec, self.compression_level, self.headers_format)
+        except Exception as exception:
+            self.stats.inc("capture_errors")
+            logging.error(
+                f"DatabaseCachingMiddleware._capture(): serializing "
+                f"{response.status} response for URL '{request.url}' failed "
+                f"with {exception.__class__.__name__}: {str(exception)}"
+            )
+            return
+        request.meta["dbcache_stored"] = True
+        self.response_writer.add(row)  # type: ignore[union-attr]
+        self.stats.inc("responses_captured")
+        # The captured row replaces whatever was in the in-memory row cache
+        # for the URL, such as the stale row it was fetched again in place of.
+        self._remember_row(row, request.url)
+        # The URL goes into the filter as soon as it's captured, since the
+        # filter must never rule out a URL that's stored.
+        if self.url_filter is not None:
+            self.url_filter.add(self.backend.key_for(row["url"]))
+        if self.log_requests:
+            logging.debug(
+                f"DatabaseCachingMiddleware.process_response(): captured "
+                f"{response.status} response for URL '{request.url}'"
+            )
+
+    # Serves the stale row a 304 Not Modified response has revalidated, and
+    # refreshes its date in the database. The row is served even if its date
+    # can't be refreshed.
+    def _serve_revalidated(
+        self, request: Request, row_dict: dict[str, Any]
+    ) -> Response | Deferred:
+        url: str = request.url
+        # The row is served like any other hit, so it's counted as one too.
+        self.stats.inc("revalidated")
+        self.stats.inc("hits")
+        if self.log_requests:
+            logging.debug(
+                f"DatabaseCachingMiddleware.process_response(): record for URL "
+                f"'{url}' revalidated as not modified; serving it from database"
+            )
+        row_dict = dict(row_dict, date=datetime.now(timezone.utc))
+        self._remember_row(row_dict, url)
+        request.meta["dbcache_served"] = True
+        cached_response: HtmlResponse = self._response_from_row(row_dict, request)
+        if self.lookup_threadpool is not None:
+            from twisted.internet import reactor
+
+            deferred: Deferred = deferToThreadPool(
+                reactor, self.lookup_threadpool, self.backend.touch, url, row_dict["date"]
+            )
+            deferred.addCallbacks(
+                lambda _: cached_response,
+                self._touch_failed,
+                errbackArgs=(url, cached_response),
+            )
+            return deferred
+        try:
+            self.backend.touch(url, row_dict["date"])
+        except Exception:
+            return self._touch_failed(Failure(), url, cached_response)
+        return cached_response
+
+    # The 304 has already confirmed the row, so a failure to refresh its date
+    # only means it'll be revalidated again sooner than it needs to be. It's
+    # logged and counted as dbcache/touch_errors, and the row is served anyway.
+    def _touch_failed(
+        self, failure: Failure, url: str, cached_response: HtmlResponse
+    ) -> HtmlResponse:
+        self.stats.inc("touch_errors")
+        logging.error(
+            f"DatabaseCachingMiddleware._touch_failed(): refreshing the date of "
+            f"the record for URL '{url}' failed: {failure.getErrorMessage()}"
+        )
+        return cached_response
+
+
+# Downloader middleware that rate-limits requests going out over the network,
+# in conformance with ScraperAPI API limits. If "render=true" is being passed
+# to ScraperAPI via the HTTPS_PROXY username argument, requests are limited to
+# RATE_LIMIT_RENDER_PER_MINUTE per minute (3 by default) with bursts of up to
+# RATE_LIMIT_RENDER_BURST; otherwise to RATE_LIMIT_PER_MINUTE per minute with
+# bursts of up to RATE_LIMIT_BURST, where the default of 0 means no limit.
+#
+# A request over the limit isn't refused or slept on: process_request()
+# returns a Deferred that fires once the request's turn comes, so only that
+# request waits and the reactor carries on with everything else. This
+# middleware has to come after DatabaseCachingMiddleware in the
+# DOWNLOADER_MIDDLEWARES order, so that cache hits, which never reach it, pass
+# through unthrottled.
 class RenderingRateLimitingMiddleware:
-    hr_min: tuple[int, ...]
-    reqs_this_min: int
+    bucket: TokenBucket | None
 
-    def __init__(self) -> None:
-        self.hr_min = time.localtime()[3:5]
-        self.reqs_this_min = 0
+    def __init__(self, per_minute: float, burst: float) -> None:
+        self.bucket = None
+        if per_minute > 0:
+            logging.info(
+                f"RenderingRateLimitingMiddleware.__init__(): limiting requests "
+                f"to {per_minute} per minute, in bursts of up to {burst}"
+            )
+            self.bucket = TokenBucket(per_minute / 60, burst)
 
     @classmethod
     def from_crawler(cls, crawler: Crawler) -> object:
-        return cls()
+        # The proxy mode is fixed for the life of the process, so the
+        # environment is only read once.
+        if "render=true" in os.environ.get("HTTPS_PROXY", "").lower():
+            return cls(
+                per_minute=crawler.settings.getfloat("RATE_LIMIT_RENDER_PER_MINUTE", 3),
+                burst=crawler.settings.getfloat("RATE_LIMIT_RENDER_BURST", 3),
+            )
+        return cls(
+            per_minute=crawler.settings.getfloat("RATE_LIMIT_PER_MINUTE", 0),
+            burst=crawler.settings.getfloat("RATE_LIMIT_BURST", 1),
+        )
 
-    def process_request(self, request: Request, spider: Spider) -> None:
-        if "render=True" not in os.environ["HTTPS_PROXY"]:
-            # If "render=True" isn't being sent to ScraperAPI, this method
-            # should be a no-op.
-            return
-        time_tuple1: tuple[int, ...] = time.localtime()
-        if self.hr_min != time_tuple1[3:5]:
-            # This object's state is stale. Update the hour-and-minute stamp and
-            # reset the requests counter.
-            self.hr_min = time_tuple1[3:5]
-            self.reqs_this_min = 0
-        elif self.reqs_this_min >= 3:
-            # The state applies to this minute, and there's been 3+ connections
-            # this minute. sleep() until next minute.
-            time.sleep(60 - time_tuple1[5])
-            # Update the hour-and-minute stamp and reset the requests counter.
-            # Since it's a new minute a new call to time.localtime() is needed.
-            self.hr_min = time.localtime()[3:5]
-            self.reqs_this_min = 0
-        else:
-            # The state isn't stale and there's been less than 3 requests this
-            # minute. No need to rate-limit but increment the requests counter.
-            self.reqs_this_min += 1
-        return None
+    def process_request(self, request: Request, spider: Spider) -> Deferred | None:
+        if self.bucket is None:
+            # If there's no limit for this proxy mode, this method should be a
+            # no-op.
+            return None
+        delay: float = self.bucket.reserve()
+        if delay <= 0:
+            return None
+        # The twisted reactor can't be imported at module level in a scrapy
+        # component, since that would install the default reactor before scrapy
+        # gets to install the one it's configured to use.
+        from twisted.internet import reactor
+        from twisted.internet.task import deferLater
+
+        if debug_logging_enabled():
+            logging.debug(
+                f"RenderingRateLimitingMiddleware.process_request(): delaying "
+                f"request for URL '{request.url}' by {delay:.1f}s"
+            )
+        # Firing with None lets the request carry on to the downloader.
+        return deferLater(reactor, delay, lambda: None)
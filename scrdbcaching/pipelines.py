@@ -5,71 +5,201 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import base64
+import json
 import logging
+import time
 
-from mysql.connector.cursor import MySQLCursor
-from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from typing import Any
 
+from .backends import CacheBackend, load_backend
+from .compression import BODY_CODECS
+from .headers import HEADERS_FORMATS
 from .items import SerializableItem
 from .spider import UrlSetSpider
+from .stats import CacheStats
+from .utility import debug_logging_enabled
 
 
 __all__ = "SerializingDatabasePipeline",
 
 
-# Pipeline to save every page, in its entirety, to the database
+# Pipeline to save every page, in its entirety, to the database, by way of the
+# page cache backend picked by the DBCACHE_BACKEND setting.
+#
+# By default every item is inserted and committed on its own. If the
+# DBCACHE_INSERT_BATCH_ROWS setting is nonzero, rows are buffered instead and
+# flushed with a single executemany() in one transaction once that many rows,
+# or DBCACHE_INSERT_BATCH_BYTES bytes of them, have accumulated, or every
+# DBCACHE_INSERT_BATCH_INTERVAL seconds, and at close_spider(). Flushes are
+# made one at a time on a worker thread, so the reactor isn't blocked on the
+# database; with no reactor running, as under replay.ReplayEngine, they're
+# made there and then. A failed flush puts the rows back in the buffer, and
+# the next flush is held off for 2 seconds, doubling with each failure in a
+# row, so an unreachable database isn't hammered with retries; once a batch
+# has failed DBCACHE_INSERT_MAX_RETRIES times its rows are inserted one by one
+# so a single bad row can't hold up the rest. Rows that still can't be stored
+# are appended to DBCACHE_INSERT_SPILL_FILE as JSON lines rather than being
+# lost.
+#
+# The DBCACHE_BODY_CODEC setting picks how page bodies are stored: "text" (the
+# default) decodes them and stores them in the body column, "raw" stores their
+# bytes as received in the body_blob column, and "zlib" and "zstd" compress
+# those bytes into the body_blob column at DBCACHE_BODY_COMPRESSION_LEVEL.
+#
+# The DBCACHE_HEADERS_FORMAT setting picks how response headers are stored:
+# "json" (the default) in the headers column, or "binary" in the headers_blob
+# column.
+#
+# If the DBCACHE_URL_HASH_KEY setting is True, rows are inserted with their
+# url_hash digest, which the pages2 table has to have been migrated to have.
+#
+# If the DBCACHE_DEDUP_BODIES setting is True, each distinct body is stored
+# once in the bodies table and rows reference it by digest, so a body that's
+# already stored, such as an error page or a mirrored page, isn't sent to the
+# database again.
+#
+# If the DBCACHE_TTL setting is nonzero, stored rows can go stale and be
+# fetched again, so an item for a URL that's already stored replaces its row.
+#
+# The number of items and bytes stored and the time spent serializing items
+# are published to the crawler's stats collector under "dbcache/", along with
+# the backend's insert and commit timings; see stats.CacheStats.
 class SerializingDatabasePipeline:
-    db_conx_pool: MySQLConnectionPool
+    backend: CacheBackend
+    stats: CacheStats
+    log_items: bool
+    replace_existing: bool
+    body_codec: str
+    compression_level: int
+    headers_format: str
+    insert_batch_rows: int
+    insert_batch_bytes: int
+    insert_batch_interval: float
+    insert_max_retries: int
+    insert_spill_file: str
+    insert_buffer: list[dict[str, Any]]
+    insert_buffer_bytes: int
+    insert_failures: int
+    insert_retry_at: float
+    insert_threadpool: ThreadPool | None
+    flushing: Deferred | None
+    flush_loop: LoopingCall | None
 
     def open_spider(self, spider: UrlSetSpider) -> None:
-        # Opening the MySQL connection pool.
-        pool_name = self.__class__.__name__
-        logging.info(
-            f"ToSqlDatabasePipeline.open_spider(): opening database connection "
-            f"pool '{pool_name}'"
+        # Opening the page cache backend.
+        self.backend = load_backend(
+            spider.settings, self.__class__.__name__, spider.crawler
         )
-        self.db_conx_pool = MySQLConnectionPool(
-            pool_name=pool_name,
-            pool_size=spider.settings.get("CONCURRENT_REQUESTS"),
-            pool_reset_session=True,
-            user=spider.settings.get("MYSQL_USERNAME"),
-            password=spider.settings.get("MYSQL_PASSWORD"),
-            host=spider.settings.get("MYSQL_HOST"),
-            database=spider.settings.get("MYSQL_DATABASE"),
-            charset=spider.settings.get("MYSQL_CHARSET"),
+        self.stats = CacheStats(spider.crawler.stats)
+        self.backend.stats = self.stats
+        self.log_items = debug_logging_enabled()
+        self.replace_existing = spider.settings.getfloat("DBCACHE_TTL", 0) > 0
+        self.body_codec = spider.settings.get("DBCACHE_BODY_CODEC", "text")
+        if self.body_codec not in BODY_CODECS:
+            raise ValueError(
+                f"DBCACHE_BODY_CODEC setting '{self.body_codec}' isn't one of "
+                f"{', '.join(BODY_CODECS)}"
+            )
+        self.compression_level = spider.settings.getint(
+            "DBCACHE_BODY_COMPRESSION_LEVEL", -1
         )
+        self.headers_format = spider.settings.get("DBCACHE_HEADERS_FORMAT", "json")
+        if self.headers_format not in HEADERS_FORMATS:
+            raise ValueError(
+                f"DBCACHE_HEADERS_FORMAT setting '{self.headers_format}' isn't "
+                f"one of {', '.join(HEADERS_FORMATS)}"
+            )
+
+        # Setting up the insert buffer.
+        self.insert_batch_rows = spider.settings.getint("DBCACHE_INSERT_BATCH_ROWS", 0)
+        self.insert_batch_bytes = spider.settings.getint(
+            "DBCACHE_INSERT_BATCH_BYTES", 16 * 1024 * 1024
+        )
+        self.insert_batch_interval = spider.settings.getfloat(
+            "DBCACHE_INSERT_BATCH_INTERVAL", 0.0
+        )
+        self.insert_max_retries = spider.settings.getint("DBCACHE_INSERT_MAX_RETRIES", 3)
+        self.insert_spill_file = spider.settings.get(
+            "DBCACHE_INSERT_SPILL_FILE", "pages2_unstored.jsonl"
+        )
+        self.insert_buffer = list()
+        self.insert_buffer_bytes = 0
+        self.insert_failures = 0
+        self.insert_retry_at = 0.0
+        self.insert_threadpool = None
+        self.flushing = None
+        self.flush_loop = None
+        if self.insert_batch_rows > 0:
+            logging.info(
+                "ToSqlDatabasePipeline.open_spider(): buffering inserts, "
+                f"flushing every {self.insert_batch_rows} rows or "
+                f"{self.insert_batch_bytes} bytes"
+            )
+            self.insert_threadpool = ThreadPool(
+                minthreads=1, maxthreads=1, name=f"{self.__class__.__name__}Inserts"
+            )
+            self.insert_threadpool.start()
+            if self.insert_batch_interval > 0:
+                self._start_flush_loop()
+
+    def _start_flush_loop(self) -> None:
+        self.flush_loop = LoopingCall(self._flush_buffer)
+        deferred: Deferred = self.flush_loop.start(self.insert_batch_interval, now=False)
+        deferred.addErrback(self._flush_loop_failed)
+
+    # A LoopingCall stops for good if its function raises, so an exception
+    # that gets out of a timed flush is logged and the loop is started again.
+    # The rows stay in the buffer for the next flush.
+    def _flush_loop_failed(self, failure: Failure) -> None:
+        logging.error(
+            "ToSqlDatabasePipeline._flush_loop_failed(): timed flush raised "
+            f"{failure.type.__name__}: {failure.getErrorMessage()}; restarting "
+            "flush loop"
+        )
+        self._start_flush_loop()
 
     # Saves an item to the database.
     def process_item(
         self, item: SerializableItem, spider: UrlSetSpider
     ) -> None:
-        # Getting a connection from the pool.
-        if item["url"] in spider.urls_deserialized:
-            logging.info(
-                "ToSqlDatabasePipeline.process_item(): skipping bc URLs "
-                f"deserialized set already contains URL {item['url']}"
-            )
+        # Items built from responses the middleware served from the database,
+        # or captured on their way in, are already stored.
+        if item.get("from_cache"):
+            self.stats.inc("items_skipped")
+            if self.log_items:
+                logging.debug(
+                    "ToSqlDatabasePipeline.process_item(): skipping bc item for "
+                    f"URL {item['url']} is already in the database"
+                )
+            return
+        if self.insert_batch_rows > 0:
+            self._buffer_item(item, spider)
             return
-        db_conn: PooledMySQLConnection = self.db_conx_pool.get_connection()
-        db_cursor: MySQLCursor = db_conn.cursor()
         try:
-            logging.info(
-                "ToSqlDatabasePipeline.process_item(): storing item for URL "
-                f"{item['url']} to database"
+            if self.log_items:
+                logging.debug(
+                    "ToSqlDatabasePipeline.process_item(): storing item for URL "
+                    f"{item['url']} to database"
+                )
+            # Inserting the item into the database. to_dict() converts item
+            # to a dict which can be used to populate this row with all of its
+            # values.
+            row: dict[str, Any] = self._serialize(item)
+            self.backend.put_many(
+                [row], on_existing="replace" if self.replace_existing else "error"
             )
-            # Inserting the item into the database.
-            db_cursor.execute(
-                """
-                INSERT INTO pages2 (
-                    `url`, `status`, `encoding`, `headers`, `date`, `body`
-                ) VALUES (
-                    %(url)s, %(status)s, %(encoding)s, %(headers)s, %(date)s, %(body)s
-                ); """,
-                # This method converts item to a dict which can be used to
-                # populate this row with all of its values.
-                item.to_dict(),  # type: ignore[arg-type]
-            )
-            db_conn.commit()
+            self.stats.inc("items_stored")
+            self.stats.inc("bytes_stored", self._row_size(row))
+            # Keeping the middleware's URL membership filter, if there is one,
+            # up to date with the table.
+            if spider.url_filter is not None:
+                spider.url_filter.add(self.backend.key_for(row["url"]))
         except Exception as exception:
             # Logging the exception
             logging.info(
@@ -77,17 +207,226 @@ class SerializingDatabasePipeline:
                 f"item for url {item['url']} threw an exception "
                 f"{exception.__class__.__name__}: {str(exception)}"
             )
-            # Ensuring the rollback happens
-            db_conn.rollback()
-            # Re-raising the exception
+            # Re-raising the exception. The backend has already rolled back.
             raise exception
-        finally:
-            # Ensuring the connection resource is de-allocated no matter what
-            # happens.
-            db_cursor.close()
-            db_conn.close()
-
-    def close_spider(self, spider: UrlSetSpider) -> None:
-        # Not really sure if this is the best way to close the connection pool
-        # but there don't seem to be better ones.
-        del self.db_conx_pool
+
+    # Adds an item to the insert buffer, flushing the buffer if it's full.
+    def _buffer_item(self, item: SerializableItem, spider: UrlSetSpider) -> None:
+        row: dict[str, Any] = self._serialize(item)
+        self.insert_buffer.append(row)
+        self.insert_buffer_bytes += self._row_size(row)
+        # The URL goes into the filter as soon as it's buffered, since it'll
+        # be in the table once the buffer is flushed, and the filter must
+        # never rule out a URL that's stored.
+        if spider.url_filter is not None:
+            spider.url_filter.add(self.backend.key_for(row["url"]))
+        if len(self.insert_buffer) >= self.insert_batch_rows or (
+            self.insert_batch_bytes > 0
+            and self.insert_buffer_bytes >= self.insert_batch_bytes
+        ):
+            self._flush_buffer()
+
+    def _serialize(self, item: SerializableItem) -> dict[str, Any]:
+        with self.stats.timer("serialize"):
+            return item.to_dict(  # type: ignore[no-any-return]
+                self.body_codec, self.compression_level, self.headers_format
+            )
+
+    # The stored size of a row's body and headers, in whichever columns they
+    # went into.
+    @staticmethod
+    def _row_size(row: dict[str, Any]) -> int:
+        return len(row["body"] or row["body_blob"] or "") + len(
+            row["headers"] or row["headers_blob"] or ""
+        )
+
+    # Hands the buffered rows to the insert thread, unless a flush is already
+    # under way or the last one failed too recently, and returns the Deferred
+    # of the flush, which never fails; or None if no flush was started. With
+    # no reactor running, the rows are written before it returns.
+    def _flush_buffer(self) -> Deferred | None:
+        # The twisted reactor can't be imported at module level in a scrapy
+        # component, since that would install the default reactor before
+        # scrapy gets to install the one it's configured to use.
+        from twisted.internet import reactor
+
+        if (
+            not self.insert_buffer
+            or self.flushing is not None
+            or time.monotonic() < self.insert_retry_at
+        ):
+            return None
+        rows: list[dict[str, Any]] = self.insert_buffer
+        rows_bytes: int = self.insert_buffer_bytes
+        self.insert_buffer = list()
+        self.insert_buffer_bytes = 0
+        if not reactor.running:
+            try:
+                written: bool = self._write_rows(rows, rows_bytes)
+            except Exception:
+                self._requeue_rows(rows, rows_bytes)
+                raise
+            self._flush_done(written, rows, rows_bytes)
+            return None
+        self.flushing = deferToThreadPool(
+            reactor,
+            self.insert_threadpool,  # type: ignore[arg-type]
+            self._write_rows,
+            rows,
+            rows_bytes,
+        )
+        self.flushing.addCallbacks(
+            self._flush_done,
+            self._flush_failed,
+            callbackArgs=(rows, rows_bytes),
+            errbackArgs=(rows, rows_bytes),
+        )
+        return self.flushing
+
+    # Writes rows to the database in one transaction. Returns False if they
+    # failed and are to be tried again, or True once they're dealt with:
+    # stored, or, after the batch has failed DBCACHE_INSERT_MAX_RETRIES times,
+    # stored one by one with whichever can't be spilled. Runs on the insert
+    # thread, if there's a reactor running.
+    def _write_rows(self, rows: list[dict[str, Any]], rows_bytes: int) -> bool:
+        try:
+            self._insert_rows(rows)
+        except Exception as exception:
+            self.insert_failures += 1
+            logging.error(
+                f"ToSqlDatabasePipeline._write_rows(): flushing {len(rows)} "
+                f"rows failed (attempt {self.insert_failures} of "
+                f"{self.insert_max_retries}) with "
+                f"{exception.__class__.__name__}: {str(exception)}"
+            )
+            if self.insert_failures < self.insert_max_retries:
+                return False
+            # The batch keeps failing, so it might be one bad row that's at
+            # fault. Storing the rows individually so that only the bad ones
+            # are spilled.
+            self._insert_rows_individually(rows)
+        else:
+            self.stats.inc("items_stored", len(rows))
+            self.stats.inc("bytes_stored", rows_bytes)
+        logging.info(
+            f"ToSqlDatabasePipeline._write_rows(): flushed {len(rows)} rows "
+            "to database"
+        )
+        self.insert_failures = 0
+        return True
+
+    def _flush_done(
+        self, written: bool, rows: list[dict[str, Any]], rows_bytes: int
+    ) -> bool:
+        self.flushing = None
+        if not written:
+            self._requeue_rows(rows, rows_bytes)
+        return written
+
+    # Anything other than the insert failing, such as the spill file being
+    # unwritable, is logged, and the rows are tried again like a failed batch.
+    def _flush_failed(
+        self, failure: Failure, rows: list[dict[str, Any]], rows_bytes: int
+    ) -> bool:
+        logging.error(
+            "ToSqlDatabasePipeline._flush_failed(): flush raised "
+            f"{failure.type.__name__}: {failure.getErrorMessage()}"
+        )
+        self.flushing = None
+        self._requeue_rows(rows, rows_bytes)
+        return False
+
+    # Puts rows that weren't stored back at the front of the buffer, ahead of
+    # any buffered since, and holds off the next flush for the backoff.
+    def _requeue_rows(self, rows: list[dict[str, Any]], rows_bytes: int) -> None:
+        self.insert_buffer[:0] = rows
+        self.insert_buffer_bytes += rows_bytes
+        self.insert_retry_at = time.monotonic() + 2 ** max(self.insert_failures, 1)
+
+    # A URL that's already stored would otherwise fail the whole batch, so
+    # instead the existing row is left as it is, or replaced if rows can go
+    # stale.
+    def _insert_rows(self, rows: list[dict[str, Any]]) -> None:
+        self.backend.put_many(
+            rows, on_existing="replace" if self.replace_existing else "ignore"
+        )
+
+    def _insert_rows_individually(self, rows: list[dict[str, Any]]) -> None:
+        unstored: list[dict[str, Any]] = list()
+        for row in rows:
+            try:
+                self._insert_rows([row])
+            except Exception as exception:
+                logging.error(
+                    "ToSqlDatabasePipeline._insert_rows_individually(): storing "
+                    f"row for URL {row['url']} failed with "
+                    f"{exception.__class__.__name__}: {str(exception)}"
+                )
+                unstored.append(row)
+            else:
+                self.stats.inc("items_stored")
+                self.stats.inc("bytes_stored", self._row_size(row))
+        if unstored:
+            self._spill_rows(unstored)
+
+    # Appends rows that couldn't be stored to the spill file, so they can be
+    # loaded by hand later. Binary values are base64-encoded.
+    def _spill_rows(self, rows: list[dict[str, Any]]) -> None:
+        logging.critical(
+            f"ToSqlDatabasePipeline._spill_rows(): writing {len(rows)} rows that "
+            f"couldn't be stored to {self.insert_spill_file}"
+        )
+        self.stats.inc("items_spilled", len(rows))
+        with open(self.insert_spill_file, "at") as fh:
+            for row in rows:
+                fh.write(json.dumps(row, default=_spill_value) + "\n")
+
+    # Makes the final flush, after waiting for any flush under way, and for
+    # the backoff after a failed one; a failed final flush is retried the same
+    # way until the rows are dealt with. The backend is closed once it's done.
+    # The waiting is done with a Deferred, which scrapy waits on in turn, so
+    # the reactor isn't blocked while other components are closing; with no
+    # reactor running, as under replay.ReplayEngine, there's nothing to block,
+    # and the backoff is slept on.
+    def close_spider(self, spider: UrlSetSpider) -> Deferred | None:
+        # The twisted reactor can't be imported at module level in a scrapy
+        # component, since that would install the default reactor before
+        # scrapy gets to install the one it's configured to use.
+        from twisted.internet import reactor
+
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        if reactor.running:
+            return self._final_flush()
+        while self.insert_buffer:
+            time.sleep(max(self.insert_retry_at - time.monotonic(), 0))
+            self._flush_buffer()
+        self._close_backend()
+        return None
+
+    def _final_flush(self) -> Deferred | None:
+        from twisted.internet import reactor
+
+        if self.flushing is not None:
+            # The flush under way is checked on again shortly.
+            delay: float = 0.1
+        elif self.insert_buffer:
+            delay = max(self.insert_retry_at - time.monotonic(), 0)
+        else:
+            self._close_backend()
+            return None
+        deferred: Deferred = deferLater(reactor, delay, self._flush_buffer)
+        deferred.addCallback(lambda _: self._final_flush())
+        return deferred
+
+    def _close_backend(self) -> None:
+        if self.insert_threadpool is not None:
+            self.insert_threadpool.stop()
+            self.insert_threadpool = None
+        self.backend.close()
+
+
+def _spill_value(value: Any) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    return str(value)
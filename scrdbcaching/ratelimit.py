@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+import time
+
+
+__all__ = ("TokenBucket",)
+
+
+# A token bucket rate limiter. Tokens accrue at `rate` per second up to a
+# maximum of `burst`, and each request takes one. Rather than making callers
+# wait, reserve() always takes the token, letting the balance go negative, and
+# returns how many seconds the caller has to wait before its token is actually
+# earned. That way requests that arrive while the bucket is empty are queued in
+# arrival order without the limiter having to keep a queue itself.
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now: float = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
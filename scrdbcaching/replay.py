@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+
+import inspect
+import logging
+import time
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from scrapy import Spider  # type: ignore[import-untyped]
+from scrapy.exceptions import DropItem  # type: ignore[import-untyped]
+from scrapy.http import HtmlResponse, Request  # type: ignore[import-untyped]
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from scrapy.statscollectors import MemoryStatsCollector  # type: ignore[import-untyped]
+from scrapy.utils.conf import build_component_list  # type: ignore[import-untyped]
+from scrapy.utils.misc import arg_to_iter, build_from_crawler, load_object  # type: ignore[import-untyped]
+from scrapy.utils.request import request_from_dict  # type: ignore[import-untyped]
+from typing import Any, Iterable, Iterator
+
+from .backends import CacheBackend
+from .middlewares import DatabaseCachingMiddleware
+from .stats import CacheStats
+
+
+__all__ = ("ReplayEngine",)
+
+
+# A row to replay, and the request it's the response to as a dict from
+# Request.to_dict(), or None to make a request for the start callback.
+ReplayTask = tuple[dict[str, Any], dict[str, Any] | None]
+
+
+# What a worker sends back for a batch of tasks: the items the callbacks
+# produced, the requests they made (as dicts, if they're being followed), and
+# counts of what happened along the way.
+@dataclass
+class ReplayBatchResult:
+    items: list[Any] = field(default_factory=list)
+    followups: list[dict[str, Any]] = field(default_factory=list)
+    counts: dict[str, int] = field(default_factory=dict)
+
+    def inc(self, name: str, count: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+# Stands in for a crawler's signal manager, ignoring everything.
+class _NullSignals:
+    def connect(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def disconnect(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def send_catch_log(self, *args: Any, **kwargs: Any) -> list[Any]:
+        return list()
+
+
+# A crawler that's just enough of one for spider callbacks and item
+# pipelines: it has settings, a stats collector and a signal manager that
+# ignores everything, but no engine, scheduler or downloader. It has to be an
+# ordinary class, since backends.pool.shared_pool() keys the pools it shares
+# by a weak reference to the crawler.
+class _ReplayCrawler:
+    settings: Settings
+    signals: _NullSignals
+    stats: MemoryStatsCollector
+    spider: Spider | None
+    engine: None
+
+    def __init__(self, settings: Settings) -> None:
+        self.settings = settings
+        self.signals = _NullSignals()
+        self.spider = None
+        self.engine = None
+        self.stats = MemoryStatsCollector(self)
+
+
+# Instances the spider on a _ReplayCrawler.
+def make_replay_spider(
+    spidercls: type[Spider], settings: Settings, spider_kwargs: dict[str, Any]
+) -> Spider:
+    crawler: _ReplayCrawler = _ReplayCrawler(settings)
+    crawler.spider = spidercls.from_crawler(crawler, **spider_kwargs)
+    return crawler.spider
+
+
+# The spider each worker process replays with, and the name of the callback
+# rows are handed to if they aren't the response to a followed request. Set
+# by _init_worker() when the process starts.
+_worker_spider: Spider | None = None
+_worker_callback: str = "parse"
+
+
+def _init_worker(
+    spidercls: type[Spider],
+    settings_dict: dict[str, Any],
+    spider_kwargs: dict[str, Any],
+    callback: str,
+) -> None:
+    global _worker_spider, _worker_callback
+    _worker_spider = make_replay_spider(spidercls, Settings(settings_dict), spider_kwargs)
+    _worker_callback = callback
+
+
+# Runs in a worker process. Each row is turned back into an HtmlResponse just
+# as DatabaseCachingMiddleware would serve it, flagged as served from the
+# cache, and handed to its callback. A callback that raises is logged and
+# counted, and the batch carries on.
+def _replay_batch(tasks: list[ReplayTask], follow: bool) -> ReplayBatchResult:
+    spider: Spider = _worker_spider  # type: ignore[assignment]
+    result: ReplayBatchResult = ReplayBatchResult()
+    for row, request_dict in tasks:
+        result.inc("rows")
+        try:
+            request: Request = (
+                request_from_dict(request_dict, spider=spider)
+                if request_dict is not None
+                else Request(
+                    row["url"],
+                    callback=getattr(spider, _worker_callback),
+                    dont_filter=True,
+                )
+            )
+            request.meta["dbcache_served"] = True
+            response: HtmlResponse = DatabaseCachingMiddleware._deserialize_row(
+                row, request
+            )
+            output: Any = (request.callback or spider._parse)(
+                response, **request.cb_kwargs
+            )
+            if inspect.isawaitable(output) or inspect.isasyncgen(output):
+                raise TypeError("asynchronous callbacks can't be replayed")
+            for produced in arg_to_iter(output):
+                if isinstance(produced, Request):
+                    if follow:
+                        result.followups.append(produced.to_dict(spider=spider))
+                    else:
+                        result.inc("requests_dropped")
+                else:
+                    result.items.append(produced)
+        except Exception:
+            logging.exception(
+                f"_replay_batch(): replaying URL '{row['url']}' failed"
+            )
+            result.inc("callback_errors")
+    return result
+
+
+# Re-runs a spider's callbacks over pages in the cache, with no network,
+# scheduler or downloader involved, so changed parsing logic can be applied
+# to everything that's already been fetched.
+#
+# Rows are read from the backend in batches and sent off, batch_size at a
+# time, to a pool of `processes` worker processes, each with its own instance
+# of the spider; a bounded number of batches are in flight at once, so memory
+# use stays flat however many rows are replayed. Every row is handed to the
+# `callback` method of the spider. The items the callbacks produce come back
+# to this process and are run through the project's ITEM_PIPELINES in the
+# order they return. Their responses are flagged as served from the cache, so
+# SerializingDatabasePipeline doesn't store them again.
+#
+# Requests the callbacks make are dropped, unless `follow` is True. Then the
+# rows given to run() are only the starting points: each request made is
+# looked up in the cache and, if it's there, its response is replayed to the
+# request's own callback, once per URL. Requests for pages that aren't cached
+# are counted and dropped.
+#
+# Callbacks have to be ordinary functions or generators, and item pipelines'
+# process_item() has to return the item (or raise DropItem) rather than a
+# Deferred, since there's no reactor running. What happened is counted under
+# "replay/" in the stats run() returns.
+class ReplayEngine:
+    spidercls: type[Spider]
+    settings: Settings
+    spider_kwargs: dict[str, Any]
+    backend: CacheBackend
+    processes: int
+    batch_size: int
+    callback: str
+    follow: bool
+    spider: Spider
+    stats: CacheStats
+    pipelines: list[Any]
+    followups: deque[dict[str, Any]]
+    seen_keys: set[str | bytes]
+
+    def __init__(
+        self,
+        spidercls: type[Spider],
+        settings: Settings,
+        backend: CacheBackend,
+        spider_kwargs: dict[str, Any] | None = None,
+        processes: int = 1,
+        batch_size: int = 100,
+        callback: str = "parse",
+        follow: bool = False,
+    ) -> None:
+        self.spidercls = spidercls
+        self.settings = settings
+        self.spider_kwargs = spider_kwargs or dict()
+        self.backend = backend
+        self.processes = max(int(processes), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.callback = callback
+        self.follow = follow
+        self.followups = deque()
+        self.seen_keys = set()
+
+    def run(self, rows: Iterable[dict[str, Any]]) -> dict[str, Any]:
+        self.spider = make_replay_spider(self.spidercls, self.settings, self.spider_kwargs)
+        self.stats = CacheStats(self.spider.crawler.stats, prefix="replay")
+        self._open_pipelines()
+        start_time: float = time.monotonic()
+        row_count: int = 0
+        # Twice as many batches in flight as there are processes keeps every
+        # process busy while the next batch is being fetched.
+        window: int = self.processes * 2
+        pending: deque[Future] = deque()  # type: ignore[type-arg]
+        batches: Iterator[list[ReplayTask]] = self._batches(rows)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=_init_worker,
+                initargs=(
+                    self.spidercls,
+                    self.settings.copy_to_dict(),
+                    self.spider_kwargs,
+                    self.callback,
+                ),
+            ) as executor:
+                while True:
+                    while len(pending) < window:
+                        batch: list[ReplayTask] | None = next(batches, None)
+                        if batch is None:
+                            batch = self._followup_batch()
+                        if batch is None:
+                            break
+                        pending.append(executor.submit(_replay_batch, batch, self.follow))
+                    if not pending:
+                        break
+                    result: ReplayBatchResult = pending.popleft().result()
+                    self._handle_result(result)
+                    previous_count: int = row_count
+                    row_count += result.counts.get("rows", 0)
+                    if row_count // 1000 > previous_count // 1000:
+                        logging.info(
+                            f"ReplayEngine.run(): replayed {row_count} rows; "
+                            f"{row_count / (time.monotonic() - start_time):.1f} rows/s"
+                        )
+        finally:
+            self._close_pipelines()
+        elapsed: float = time.monotonic() - start_time
+        logging.info(
+            f"ReplayEngine.run(): replayed {row_count} rows in {elapsed:.2f}s "
+            f"({row_count / elapsed if elapsed > 0 else 0:.1f} rows/s)"
+        )
+        return {
+            key: value
+            for key, value in self.spider.crawler.stats.get_stats().items()
+            if key.startswith("replay/")
+        }
+
+    # Groups the rows into batches of tasks for the start callback. When
+    # following requests, each row's URL is remembered so it isn't replayed
+    # again when a callback asks for it.
+    def _batches(self, rows: Iterable[dict[str, Any]]) -> Iterator[list[ReplayTask]]:
+        batch: list[ReplayTask] = list()
+        for row in rows:
+            if self.follow:
+                self.seen_keys.add(self.backend.key_for(row["url"]))
+            batch.append((row, None))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    # Looks up the next batch_size of the requests waiting to be followed,
+    # and returns a batch of tasks for the ones that are cached, or None if
+    # none are waiting.
+    def _followup_batch(self) -> list[ReplayTask] | None:
+        while self.followups:
+            requests: dict[str, dict[str, Any]] = dict()
+            while self.followups and len(requests) < self.batch_size:
+                request_dict: dict[str, Any] = self.followups.popleft()
+                requests.setdefault(request_dict["url"], request_dict)
+            rows: dict[str, dict[str, Any]] = self.backend.get_many(list(requests))
+            self.stats.inc("followups_uncached", len(requests) - len(rows))
+            if rows:
+                self.stats.inc("followups", len(rows))
+                return [(row, requests[url]) for url, row in rows.items()]
+        return None
+
+    def _handle_result(self, result: ReplayBatchResult) -> None:
+        for name, count in result.counts.items():
+            self.stats.inc(name, count)
+        for item in result.items:
+            self._process_item(item)
+        for request_dict in result.followups:
+            key: str | bytes = self.backend.key_for(request_dict["url"])
+            if key not in self.seen_keys:
+                self.seen_keys.add(key)
+                self.followups.append(request_dict)
+
+    def _open_pipelines(self) -> None:
+        self.pipelines = [
+            build_from_crawler(load_object(path), self.spider.crawler)
+            for path in build_component_list(self.settings.getwithbase("ITEM_PIPELINES"))
+        ]
+        for pipeline in self.pipelines:
+            if hasattr(pipeline, "open_spider"):
+                pipeline.open_spider(self.spider)
+
+    def _close_pipelines(self) -> None:
+        for pipeline in reversed(self.pipelines):
+            if hasattr(pipeline, "close_spider"):
+                pipeline.close_spider(self.spider)
+
+    def _process_item(self, item: Any) -> None:
+        self.stats.inc("items")
+        try:
+            for pipeline in self.pipelines:
+                if hasattr(pipeline, "process_item"):
+                    item = pipeline.process_item(item, self.spider)
+        except DropItem:
+            self.stats.inc("items_dropped")
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import logging
+
+from scrapy.crawler import Crawler  # type: ignore[import-untyped]
+from scrapy.exceptions import NotConfigured  # type: ignore[import-untyped]
+from scrapy.http import Request  # type: ignore[import-untyped]
+from typing import Any, AsyncIterator, Iterable, Iterator
+
+from .stats import CacheStats
+from .utility import url_digest
+
+
+__all__ = ("ShardingMiddleware", "shard_of")
+
+
+# The shard out of `shard_count` that a URL belongs to. It's taken from the
+# URL's url_digest(), so it's the same in every process, and equivalent URLs
+# land in the same shard.
+def shard_of(url: str, shard_count: int) -> int:
+    return int.from_bytes(url_digest(url)[:8], "big") % shard_count
+
+
+# spider middleware that partitions a crawl's start requests between the
+# processes of a sharded crawl (see launch_sharded_crawl.py). Each process is
+# told its shard by the DBCACHE_SHARD_INDEX setting and how many there are by
+# DBCACHE_SHARD_COUNT, and only keeps the start requests whose URLs fall in
+# its shard. Requests made by callbacks aren't filtered, since a page can
+# only be reached through the pages that link to it, and the shard a link
+# target falls in may never crawl them.
+#
+# That means the shards can overlap: every process has its own dupefilter, so
+# a page linked to from pages in several shards is requested once by each of
+# them, and spends a credit from the shared ledger each time it's fetched. The
+# cache only saves the repeat fetches once one shard has stored the page
+# before another shard asks for it.
+#
+# The start requests kept and skipped are counted in the crawler's stats as
+# dbcache/shard_kept and dbcache/shard_skipped. With DBCACHE_SHARD_COUNT of 1
+# or less the middleware isn't enabled.
+class ShardingMiddleware:
+    shard_index: int
+    shard_count: int
+    stats: CacheStats
+
+    def __init__(
+        self, shard_index: int, shard_count: int, stats: CacheStats | None = None
+    ) -> None:
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(
+                f"DBCACHE_SHARD_INDEX setting {shard_index} isn't between 0 and "
+                f"DBCACHE_SHARD_COUNT - 1 ({shard_count - 1})"
+            )
+        logging.info(
+            f"ShardingMiddleware.__init__(): crawling shard {shard_index} of "
+            f"{shard_count}"
+        )
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.stats = stats if stats is not None else CacheStats()
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> "ShardingMiddleware":
+        shard_count: int = crawler.settings.getint("DBCACHE_SHARD_COUNT", 1)
+        if shard_count <= 1:
+            raise NotConfigured("DBCACHE_SHARD_COUNT is 1")
+        return cls(
+            crawler.settings.getint("DBCACHE_SHARD_INDEX", 0),
+            shard_count,
+            CacheStats(crawler.stats),
+        )
+
+    def _in_shard(self, output: Any) -> bool:
+        if not isinstance(output, Request):
+            return True
+        if shard_of(output.url, self.shard_count) == self.shard_index:
+            self.stats.inc("shard_kept")
+            return True
+        self.stats.inc("shard_skipped")
+        return False
+
+    # scrapy 2.13 and later.
+    async def process_start(self, start: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        async for output in start:
+            if self._in_shard(output):
+                yield output
+
+    # Earlier versions of scrapy.
+    def process_start_requests(
+        self, start_requests: Iterable[Any], spider: Any
+    ) -> Iterator[Any]:
+        for output in start_requests:
+            if self._in_shard(output):
+                yield output
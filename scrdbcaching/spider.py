@@ -2,11 +2,14 @@
 
 import scrapy  # type: ignore[import-untyped]
 
+from .bloom import BloomFilter
+
 
 __all__ = "UrlSetSpider",
 
 class UrlSetSpider(scrapy.Spider):  # type: ignore[misc]
-    urls_deserialized: set[str]
+    # Set by DatabaseCachingMiddleware if it's using a URL membership filter.
+    url_filter: BloomFilter | None
 
     def __init__(  # type: ignore[no-untyped-def]
         self,
@@ -14,5 +17,5 @@ class UrlSetSpider(scrapy.Spider):  # type: ignore[misc]
         **kwargs,
     ) -> None:
         super().__init__(*args, **kwargs)
-        self.urls_deserialized = set()
+        self.url_filter = None
 
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+
+__all__ = ("CacheStats", "TIMING_BUCKETS")
+
+
+# The upper bounds, in seconds, of the buckets timings are counted into. A
+# timing goes in the first bucket it's no greater than, or in the "inf" bucket
+# if it's greater than all of them.
+TIMING_BUCKETS: tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+
+# Publishes the caching layer's counters and timing histograms to a scrapy
+# stats collector, under keys starting with "dbcache/". Counters are plain
+# values; a timing named "query" is kept as dbcache/query/count and
+# dbcache/query/seconds, the number and total of the timings, and
+# dbcache/query/le_<bound> for each bucket, so the spread survives into the
+# stats dump at the end of the crawl.
+#
+# The backends record their timings from whatever thread they're called on, so
+# updates are made under a lock. With no stats collector every method is a
+# no-op, which is what the backends start out with.
+class CacheStats:
+    stats: Any
+    prefix: str
+    lock: threading.Lock
+
+    def __init__(self, stats: Any = None, prefix: str = "dbcache") -> None:
+        self.stats = stats
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, count: int = 1) -> None:
+        if self.stats is None:
+            return
+        with self.lock:
+            self.stats.inc_value(f"{self.prefix}/{name}", count)
+
+    def observe(self, name: str, seconds: float) -> None:
+        if self.stats is None:
+            return
+        bucket: str = next(
+            (f"le_{bound:g}" for bound in TIMING_BUCKETS if seconds <= bound), "le_inf"
+        )
+        key: str = f"{self.prefix}/{name}"
+        with self.lock:
+            self.stats.inc_value(f"{key}/count")
+            self.stats.inc_value(f"{key}/seconds", seconds, start=0.0)
+            self.stats.inc_value(f"{key}/{bucket}")
+
+    # Times the body of a with statement as the named timing.
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        if self.stats is None:
+            yield
+            return
+        start_time: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
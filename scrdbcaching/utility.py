@@ -1,13 +1,23 @@
 #!/usr/bin/python3
 
+import hashlib
+import logging
 import re
 import sys
 
-from logging import Logger, getLogger, INFO, Formatter, StreamHandler, FileHandler
+from logging import Logger, getLogger, DEBUG, INFO, Formatter, StreamHandler, FileHandler
 from typing import Iterable
+from w3lib.url import canonicalize_url
 
 
-__all__ = ("join_strs_w_comma_conj", "set_up_logging", "text2slug")
+__all__ = (
+    "canonical_url",
+    "debug_logging_enabled",
+    "join_strs_w_comma_conj",
+    "set_up_logging",
+    "text2slug",
+    "url_digest",
+)
 
 
 def text2slug(text: str) -> str:
@@ -18,6 +28,36 @@ def text2slug(text: str) -> str:
     return text
 
 
+# Normalizes a URL so that equivalent URLs (differing only in query argument
+# order, percent-encoding, fragment and so on) come out the same. This is the
+# same canonicalization scrapy uses for request fingerprints.
+def canonical_url(url: str) -> str:
+    return canonicalize_url(url)  # type: ignore[no-any-return]
+
+
+# The 20-byte SHA-1 digest of a URL's canonical form. This is the value of the
+# url_hash column in the pages2 table, which is its lookup key.
+def url_digest(url: str) -> bytes:
+    return hashlib.sha1(canonical_url(url).encode("utf-8")).digest()
+
+
+# Whether a DEBUG record logged to the given logger would actually be written
+# out by any handler. Logger.isEnabledFor() alone isn't enough under scrapy,
+# which sets the root logger's level to NOTSET and filters by LOG_LEVEL in its
+# handler instead, so every level looks enabled.
+def debug_logging_enabled(logger: Logger = logging.root) -> bool:
+    if not logger.isEnabledFor(DEBUG):
+        return False
+    current: Logger | None = logger
+    while current is not None:
+        if any(handler.level <= DEBUG for handler in current.handlers):
+            return True
+        current = current.parent if current.propagate else None
+    # With no handlers at all, logging's last resort handler is used, and it
+    # only writes out warnings and worse.
+    return False
+
+
 # This function borrowed wholesale from notifdler2.utility
 #
 # A factory function used to set up a Logger object just the way we want it
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import pytest
+
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from scrapy.utils.reactor import install_reactor  # type: ignore[import-untyped]
+from scrapy.utils.test import get_crawler  # type: ignore[import-untyped]
+from typing import Any, Callable, Iterator
+
+from scrdbcaching import DatabaseCachingMiddleware, UrlSetSpider
+from scrdbcaching.backends import CacheBackend, load_backend
+
+
+# The tests run against the sqlite backend, in a database file of their own.
+
+
+# Installing the reactor scrapy installs by default before anything imports
+# twisted.internet.reactor, since the crawlers the tests make expect one.
+def pytest_configure(config: Any) -> None:
+    install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+
+
+@pytest.fixture
+def settings(tmp_path: Any) -> Settings:
+    return Settings(
+        {
+            "DBCACHE_BACKEND": "sqlite",
+            "DBCACHE_SQLITE_PATH": str(tmp_path / "pages.sqlite3"),
+            "CONCURRENT_REQUESTS": 4,
+        }
+    )
+
+
+@pytest.fixture
+def backend(settings: Settings) -> Iterator[CacheBackend]:
+    backend: CacheBackend = load_backend(settings, "test")
+    yield backend
+    backend.close()
+
+
+# Instances a spider on a crawler for the given settings, with the credit
+# arguments the middleware expects.
+@pytest.fixture
+def make_spider(settings: Settings) -> Callable[..., UrlSetSpider]:
+    def make_spider(**overrides: Any) -> UrlSetSpider:
+        crawler_settings: dict[str, Any] = dict(settings.copy_to_dict(), **overrides)
+        crawler: Any = get_crawler(UrlSetSpider, crawler_settings)
+        spider: UrlSetSpider = UrlSetSpider.from_crawler(crawler, name="test")
+        spider.credits_used = 0
+        spider.credits_threshold = 1000
+        crawler.spider = spider
+        return spider
+
+    return make_spider
+
+
+# Instances the middleware for a new spider the way scrapy would, and closes
+# it again at the end of the test.
+@pytest.fixture
+def make_middleware(
+    make_spider: Callable[..., UrlSetSpider],
+) -> Iterator[Callable[..., tuple[DatabaseCachingMiddleware, UrlSetSpider]]]:
+    opened: list[tuple[DatabaseCachingMiddleware, UrlSetSpider]] = list()
+
+    def make_middleware(
+        **overrides: Any,
+    ) -> tuple[DatabaseCachingMiddleware, UrlSetSpider]:
+        spider: UrlSetSpider = make_spider(**overrides)
+        middleware: DatabaseCachingMiddleware = DatabaseCachingMiddleware.from_crawler(
+            spider.crawler
+        )
+        opened.append((middleware, spider))
+        return middleware, spider
+
+    yield make_middleware
+    for middleware, spider in opened:
+        if not middleware.stop_triggered:
+            middleware.on_spider_closed(spider, "finished")
+
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+import time
+
+from datetime import datetime, timezone
+from scrapy.http import HtmlResponse, Request  # type: ignore[import-untyped]
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from typing import Any
+
+from scrdbcaching import SerializableItem
+
+
+ENCODING: str = "utf-8"
+
+
+def make_response(
+    url: str,
+    status: int = 200,
+    body: str = "<html><body>page</body></html>",
+    headers: dict[str, Any] | None = None,
+    request: Request | None = None,
+) -> HtmlResponse:
+    return HtmlResponse(
+        url=url,
+        status=status,
+        headers=headers or dict(),
+        body=body.encode(ENCODING),
+        encoding=ENCODING,
+        request=request,
+    )
+
+
+# A row as the pipeline would store it for a response.
+def make_row(
+    url: str,
+    status: int = 200,
+    body: str = "<html><body>page</body></html>",
+    headers: dict[str, Any] | None = None,
+    date: datetime | None = None,
+    **to_dict_args: Any,
+) -> dict[str, Any]:
+    item: SerializableItem = SerializableItem.from_htmlresponse(
+        make_response(url, status, body, headers)
+    )
+    item["date"] = date or datetime.now(timezone.utc)
+    return item.to_dict(**to_dict_args)
+
+
+# Runs the reactor until the Deferred fires, and returns its result, or raises
+# its exception. Anything that isn't a Deferred is returned as it is.
+def wait_for(result: Any, timeout: float = 5.0) -> Any:
+    from twisted.internet import reactor
+
+    if not isinstance(result, Deferred):
+        return result
+    outcome: list[Any] = list()
+    result.addBoth(outcome.append)
+    deadline: float = time.monotonic() + timeout
+    while not outcome:
+        if time.monotonic() > deadline:
+            raise TimeoutError("Deferred didn't fire")
+        reactor.iterate(0.01)
+    if isinstance(outcome[0], Failure):
+        outcome[0].raiseException()
+    return outcome[0]
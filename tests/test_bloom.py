@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+from scrapy.http import Request  # type: ignore[import-untyped]
+
+from scrdbcaching.backends import CacheBackend
+from scrdbcaching.bloom import BloomFilter
+from scrdbcaching.utility import url_digest
+
+from .helpers import make_response, make_row
+
+
+def test_no_false_negatives() -> None:
+    bloom: BloomFilter = BloomFilter(1000, 0.01)
+    urls: list[str] = [f"https://example.com/{i}" for i in range(1000)]
+    for url in urls:
+        bloom.add(url)
+    assert len(bloom) == 1000
+    assert all(url in bloom for url in urls)
+
+
+def test_false_positive_rate() -> None:
+    bloom: BloomFilter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(url_digest(f"https://example.com/{i}"))
+    false_positives: int = sum(
+        url_digest(f"https://example.com/other/{i}") in bloom for i in range(10_000)
+    )
+    assert false_positives < 300
+    assert 0.001 < bloom.expected_error_rate < 0.03
+
+
+def test_max_bytes() -> None:
+    bloom: BloomFilter = BloomFilter(100_000, 0.001, max_bytes=1024)
+    assert bloom.size_bytes == 1024
+    assert bloom.expected_error_rate == 0.0
+
+
+def test_urls_are_casefolded() -> None:
+    bloom: BloomFilter = BloomFilter(10)
+    bloom.add("https://example.com/Page")
+    assert "https://EXAMPLE.com/page" in bloom
+
+
+# With the filter on, the middleware skips the database for URLs it rules
+# out, and captured URLs go into the filter straight away.
+def test_middleware_filter(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([make_row("https://example.com/stored")])
+    middleware, spider = make_middleware(
+        DBCACHE_BLOOM_FILTER=True,
+        DBCACHE_CAPTURE_RESPONSES=True,
+        DBCACHE_CAPTURE_INTERVAL=0,
+    )
+    assert spider.url_filter is middleware.url_filter
+    assert len(middleware.url_filter) == 1
+    assert middleware.process_request(Request("https://example.com/stored"), spider).status == 200
+    request: Request = Request("https://example.com/new")
+    assert middleware.process_request(request, spider) is None
+    assert spider.crawler.stats.get_value("dbcache/filter_skips") == 1
+
+    middleware.process_response(
+        request, make_response("https://example.com/new", request=request), spider
+    )
+    assert backend.key_for("https://example.com/new") in middleware.url_filter
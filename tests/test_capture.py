@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+import gzip
+import pytest
+
+from datetime import datetime, timedelta, timezone
+from scrapy import signals  # type: ignore[import-untyped]
+from scrapy.downloadermiddlewares.httpcompression import (  # type: ignore[import-untyped]
+    HttpCompressionMiddleware,
+)
+from scrapy.http import HtmlResponse, Request, Response  # type: ignore[import-untyped]
+
+from scrdbcaching.backends import CacheBackend
+from scrdbcaching.capture import DEFAULT_STATUS_POLICY, parse_status_policy
+from scrdbcaching.headers import headers_from_row
+
+from .helpers import make_response, make_row
+
+
+def test_parse_status_policy() -> None:
+    default_ttl: timedelta = timedelta(hours=1)
+    assert parse_status_policy({"200": None, 404: 60, "410": 0}, default_ttl) == {
+        200: default_ttl,
+        404: timedelta(seconds=60),
+        410: None,
+    }
+
+
+# Sends a response for each status through a capturing middleware, and
+# returns the statuses of the rows that were stored.
+def capture(backend: CacheBackend, make_middleware, statuses: list[int], **settings) -> dict:
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0, **settings
+    )
+    for status in statuses:
+        url: str = f"https://example.com/{status}"
+        request: Request = Request(url)
+        middleware.process_response(request, make_response(url, status, request=request), spider)
+        assert bool(request.meta.get("dbcache_stored")) == (status in middleware.status_ttls)
+    middleware.on_spider_closed(spider, "finished")
+    return {
+        status: row["status"]
+        for status in statuses
+        if (row := backend.get(f"https://example.com/{status}")) is not None
+    }
+
+
+def test_default_policy(backend: CacheBackend, make_middleware) -> None:
+    statuses: list[int] = [200, 301, 302, 308, 404, 410, 500, 503]
+    stored: dict = capture(backend, make_middleware, statuses)
+    assert set(stored) == set(DEFAULT_STATUS_POLICY)
+    assert all(stored[status] == status for status in stored)
+
+
+def test_custom_policy(backend: CacheBackend, make_middleware) -> None:
+    stored: dict = capture(
+        backend,
+        make_middleware,
+        [200, 404, 503],
+        DBCACHE_STATUS_POLICY={"200": None, "503": 60},
+    )
+    assert set(stored) == {200, 503}
+
+
+def test_nothing_captured_by_default(backend: CacheBackend, make_middleware) -> None:
+    middleware, spider = make_middleware()
+    assert middleware.response_writer is None
+    request: Request = Request("https://example.com/")
+    middleware.process_response(
+        request, make_response("https://example.com/", request=request), spider
+    )
+    assert "dbcache_stored" not in request.meta
+
+
+def test_responses_without_text_are_passed_over(
+    backend: CacheBackend, make_middleware
+) -> None:
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0
+    )
+    request: Request = Request("https://example.com/image.png")
+    middleware.process_response(
+        request, Response(request.url, body=b"\x89PNG", request=request), spider
+    )
+    assert "dbcache_stored" not in request.meta
+
+
+# This middleware sees a compressed response before HttpCompressionMiddleware
+# has decoded it, so it's captured from the response_received signal once it
+# has been, rather than from process_response().
+def test_compressed_responses_are_captured_once_decoded(
+    backend: CacheBackend, make_middleware
+) -> None:
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0
+    )
+    url: str = "https://example.com/"
+    request: Request = Request(url)
+    response: HtmlResponse = HtmlResponse(
+        url,
+        headers={"Content-Type": "text/html; charset=utf-8", "Content-Encoding": "gzip"},
+        body=gzip.compress(b"<html><body>page</body></html>"),
+        request=request,
+    )
+    assert middleware.process_response(request, response, spider) is response
+    assert "dbcache_stored" not in request.meta
+    response = HttpCompressionMiddleware.from_crawler(spider.crawler).process_response(
+        request, response
+    )
+    spider.crawler.signals.send_catch_log(
+        signal=signals.response_received, response=response, request=request, spider=spider
+    )
+    assert request.meta["dbcache_stored"]
+    middleware.on_spider_closed(spider, "finished")
+    row: dict = backend.get(url)
+    assert row["body"] == "<html><body>page</body></html>"
+    assert b"Content-Encoding" not in headers_from_row(row)
+    assert spider.crawler.stats.get_value("dbcache/responses_captured") == 1
+
+
+# A response that can't be serialized is counted and passed on as it is,
+# rather than failing the request.
+def test_unserializable_responses_are_passed_on(
+    backend: CacheBackend, make_middleware
+) -> None:
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0
+    )
+    url: str = "https://example.com/"
+    request: Request = Request(url)
+    response: HtmlResponse = HtmlResponse(
+        url, body=b"\xff\xfe\xfd", encoding="utf-8", request=request
+    )
+    assert middleware.process_response(request, response, spider) is response
+    assert "dbcache_stored" not in request.meta
+    assert spider.crawler.stats.get_value("dbcache/capture_errors") == 1
+
+
+# A response served from the cache isn't stored again.
+def test_served_responses_are_not_captured(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([make_row("https://example.com/")])
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0
+    )
+    request: Request = Request("https://example.com/")
+    response = middleware.process_request(request, spider)
+    middleware.process_response(request, response, spider)
+    assert "dbcache_stored" not in request.meta
+    assert spider.crawler.stats.get_value("dbcache/responses_captured") is None
+
+
+# Each status stays fresh for as long as the policy says: 404s for a week, and
+# everything else as long as DBCACHE_TTL.
+@pytest.mark.parametrize(
+    "status, age, fresh",
+    [
+        (404, timedelta(days=6), True),
+        (404, timedelta(days=8), False),
+        (200, timedelta(days=8), True),
+        (200, timedelta(days=31), False),
+    ],
+)
+def test_status_ttls(
+    backend: CacheBackend, make_middleware, status: int, age: timedelta, fresh: bool
+) -> None:
+    url: str = "https://example.com/"
+    backend.put_many([make_row(url, status, date=datetime.now(timezone.utc) - age)])
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True,
+        DBCACHE_CAPTURE_INTERVAL=0,
+        DBCACHE_TTL=30 * 24 * 60 * 60,
+    )
+    assert (middleware.process_request(Request(url), spider) is not None) == fresh
+
+
+# Downloader middlewares don't get a close_spider() call, so the captured rows
+# still buffered are written when the spider_closed signal is sent.
+def test_buffered_rows_are_stored_when_spider_closes(
+    backend: CacheBackend, make_middleware
+) -> None:
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True,
+        DBCACHE_CAPTURE_INTERVAL=0,
+        DBCACHE_CAPTURE_BATCH_ROWS=100,
+    )
+    assert not hasattr(middleware, "close_spider")
+    for i in range(3):
+        request: Request = Request(f"https://example.com/{i}")
+        middleware.process_response(
+            request, make_response(request.url, request=request), spider
+        )
+    assert backend.count() == 0
+    spider.crawler.signals.send_catch_log(
+        signal=signals.spider_closed, spider=spider, reason="finished"
+    )
+    assert middleware.response_writer is None
+    assert backend.count() == 3
+    assert spider.crawler.stats.get_value("dbcache/responses_stored") == 3
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import logging
+import pytest
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterator
+
+from compact_pages import retention_test, run_batches
+from scrdbcaching.backends.sqlite import SQLiteBackend
+
+from .helpers import make_row
+
+
+NOW: datetime = datetime.now(timezone.utc)
+DAY: timedelta = timedelta(days=1)
+
+
+@pytest.fixture
+def path(tmp_path: Any) -> str:
+    return str(tmp_path / "pages.sqlite3")
+
+
+@pytest.fixture
+def make_backend(path: str) -> Iterator[Callable[..., SQLiteBackend]]:
+    backends: list[SQLiteBackend] = list()
+
+    def make_backend(**kwargs: Any) -> SQLiteBackend:
+        backends.append(SQLiteBackend(path, **kwargs))
+        return backends[-1]
+
+    yield make_backend
+    for backend in backends:
+        backend.close()
+
+
+def count(path: str, table: str) -> int:
+    conn: sqlite3.Connection = sqlite3.connect(path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# Runs a batch operation to the end of its table, a couple of rows at a time.
+def run(step: Callable[[Any], tuple[int, Any]], start: Any) -> int:
+    return run_batches(step, start, 0, "test", logging.getLogger("test"))
+
+
+def test_retention_test() -> None:
+    expired = retention_test(10 * 86400, {404: 86400, 410: 0}, NOW)
+    assert expired(200, NOW - 11 * DAY)
+    assert not expired(200, NOW - 9 * DAY)
+    assert expired(404, NOW - 2 * DAY)
+    assert not expired(410, NOW - 1000 * DAY)
+    assert not expired(200, None)
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_expire_batch(make_backend, path: str, archive: bool) -> None:
+    backend: SQLiteBackend = make_backend()
+    backend.put_many(
+        [
+            make_row("https://example.com/old", date=NOW - 20 * DAY),
+            make_row("https://example.com/new", date=NOW - DAY),
+            make_row("https://example.com/missing", 404, date=NOW - 2 * DAY),
+            make_row("https://example.com/gone", 410, date=NOW - 200 * DAY),
+            make_row("https://example.com/older", date=NOW - 30 * DAY),
+        ]
+    )
+    backend.put_many([dict(make_row("https://example.com/undated"), date=None)])
+    expired = retention_test(10 * 86400, {404: 86400, 410: 0}, NOW)
+    deleted: int = run(lambda after: backend.expire_batch(expired, after, 2, archive), 0)
+    assert deleted == 3
+    assert {row["url"] for row in backend.iter_range()} == {
+        "https://example.com/new",
+        "https://example.com/gone",
+        "https://example.com/undated",
+    }
+    assert count(path, "pages2_history") == (3 if archive else 0)
+
+
+# Replacing a row keeps the old one as a version in pages2_history, and the
+# versions can be trimmed to the newest few of each URL, or by age.
+def test_trim_history_batch(make_backend, path: str) -> None:
+    backend: SQLiteBackend = make_backend(keep_versions=10)
+    urls: list[str] = [f"https://example.com/{i}" for i in range(3)]
+    for version in range(5):
+        backend.put_many(
+            [make_row(url, body=str(version), date=NOW - (5 - version) * DAY) for url in urls],
+            on_existing="replace",
+        )
+    assert count(path, "pages2_history") == 12
+
+    assert run(lambda after: backend.trim_history_batch(2, None, after, 2), b"") == 6
+    assert count(path, "pages2_history") == 6
+    # The newest versions are the ones kept.
+    assert run(lambda after: backend.trim_history_batch(None, NOW - 2.5 * DAY, after, 2), b"") == 3
+    assert count(path, "pages2_history") == 3
+    assert all(backend.get(url)["body"] == "4" for url in urls)
+
+
+# A body is only deleted once no row references it.
+def test_delete_orphan_bodies_batch(make_backend, path: str) -> None:
+    backend: SQLiteBackend = make_backend(dedup_bodies=True)
+    backend.put_many(
+        [
+            make_row("https://example.com/a", body="shared"),
+            make_row("https://example.com/b", body="shared"),
+        ]
+    )
+    assert count(path, "bodies") == 1
+    assert backend.get("https://example.com/b")["body"] == "shared"
+
+    def delete_orphans() -> int:
+        return run(lambda after: backend.delete_orphan_bodies_batch(after, 1), b"")
+
+    backend.put_many([make_row("https://example.com/a", body="new")], on_existing="replace")
+    assert delete_orphans() == 0
+    assert count(path, "bodies") == 2
+
+    backend.put_many([make_row("https://example.com/b", body="new")], on_existing="replace")
+    assert delete_orphans() == 1
+    assert count(path, "bodies") == 1
+    assert backend.get("https://example.com/a")["body"] == "new"
+
+
+# A body referenced only by a version in pages2_history is kept.
+def test_history_keeps_bodies(make_backend, path: str) -> None:
+    backend: SQLiteBackend = make_backend(dedup_bodies=True, keep_versions=5)
+    backend.put_many([make_row("https://example.com/a", body="first")])
+    backend.put_many([make_row("https://example.com/a", body="second")], on_existing="replace")
+    assert run(lambda after: backend.delete_orphan_bodies_batch(after, 10), b"") == 0
+    assert run(lambda after: backend.trim_history_batch(None, NOW + DAY, after, 10), b"") == 1
+    assert run(lambda after: backend.delete_orphan_bodies_batch(after, 10), b"") == 1
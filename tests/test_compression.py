@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import pytest
+
+from scrapy.http import HtmlResponse, Request  # type: ignore[import-untyped]
+
+from scrdbcaching import DatabaseCachingMiddleware
+from scrdbcaching.backends import CacheBackend
+from scrdbcaching.compression import (
+    BODY_CODECS,
+    body_digest,
+    body_from_row,
+    compress_body,
+    decompress_body,
+    zstandard,
+)
+
+from .helpers import make_row
+
+
+BODY: str = "<html><body>" + "<p>café crème</p>" * 200 + "</body></html>"
+URL: str = "https://example.com/page"
+
+needs_zstandard = pytest.mark.skipif(
+    zstandard is None, reason="zstandard isn't installed"
+)
+CODECS: list = [
+    pytest.param(codec, marks=needs_zstandard) if codec == "zstd" else codec
+    for codec in BODY_CODECS
+]
+
+
+@pytest.mark.parametrize("codec", ["zlib", pytest.param("zstd", marks=needs_zstandard)])
+def test_compress_round_trip(codec: str) -> None:
+    data: bytes = BODY.encode("utf-8")
+    blob: bytes = compress_body(data, codec)
+    assert len(blob) < len(data)
+    assert decompress_body(blob, codec) == data
+
+
+def test_uncompressing_codecs_are_refused() -> None:
+    with pytest.raises(ValueError):
+        compress_body(b"data", "raw")
+    with pytest.raises(ValueError):
+        decompress_body(b"data", "text")
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_row_round_trip(codec: str) -> None:
+    row: dict = make_row(URL, body=BODY, body_codec=codec)
+    assert row["body_codec"] == codec
+    assert (row["body"] is None) == (codec != "text")
+    assert body_from_row(row) == BODY.encode("utf-8")
+
+
+# A row stored with any codec comes back out of the backend, and is served by
+# the middleware, as the body that went in.
+@pytest.mark.parametrize("codec", CODECS)
+def test_backend_round_trip(codec: str, backend: CacheBackend) -> None:
+    backend.put_many([make_row(URL, body=BODY, body_codec=codec)])
+    row: dict = backend.get(URL)
+    assert row["body_codec"] == codec
+    response: HtmlResponse = DatabaseCachingMiddleware._deserialize_row(row, Request(URL))
+    assert response.text == BODY
+
+
+# Legacy rows have no body_codec, and count as text.
+def test_row_without_codec_is_text() -> None:
+    assert body_from_row({"body": BODY, "encoding": "utf-8"}) == BODY.encode("utf-8")
+
+
+def test_body_digest_depends_on_codec() -> None:
+    digests: set[bytes] = {
+        body_digest(make_row(URL, body=BODY, body_codec=codec))
+        for codec in ("text", "raw", "zlib")
+    }
+    assert len(digests) == 3
+    assert body_digest(make_row(URL, body=BODY)) == body_digest(
+        make_row("https://example.com/other", body=BODY)
+    )
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+import json
+import pytest
+
+from scrdbcaching.headers import headers_from_row, pack_headers, unpack_headers
+
+from .helpers import make_row
+
+
+HEADERS: dict[bytes, list[bytes]] = {
+    b"Content-Type": [b"text/html; charset=utf-8"],
+    b"Set-Cookie": [b"a=1; Path=/", b"b=2; Path=/; Secure"],
+    b"X-Empty": [b""],
+    b"Etag": [b'W/"5f3a-18b2c0f1e6d"'],
+}
+
+
+def test_pack_round_trip() -> None:
+    assert unpack_headers(pack_headers(HEADERS)) == HEADERS
+
+
+def test_pack_empty() -> None:
+    assert unpack_headers(pack_headers(dict())) == dict()
+
+
+def test_pack_encodes_strs() -> None:
+    assert unpack_headers(pack_headers({"Server": ["nginx"]}, "utf-8")) == {
+        b"Server": [b"nginx"]
+    }
+
+
+def test_unpack_bytearray() -> None:
+    assert unpack_headers(bytearray(pack_headers(HEADERS))) == HEADERS
+
+
+def test_unpack_rejects_unknown_version() -> None:
+    with pytest.raises(ValueError):
+        unpack_headers(b"\x02" + pack_headers(HEADERS)[1:])
+
+
+# The headers of a row come back the same whichever format they were stored
+# in.
+@pytest.mark.parametrize("headers_format", ["json", "binary"])
+def test_headers_from_row(headers_format: str) -> None:
+    row: dict = make_row(
+        "https://example.com/",
+        headers={key.decode(): [v.decode() for v in value] for key, value in HEADERS.items()},
+        headers_format=headers_format,
+    )
+    assert (row["headers"] is None) == (headers_format == "binary")
+    if row["headers"] is not None:
+        assert json.loads(row["headers"])["Set-Cookie"] == ["a=1; Path=/", "b=2; Path=/; Secure"]
+    assert headers_from_row(row) == HEADERS
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+
+import argparse
+import base64
+import gzip
+import json
+import logging
+import pytest
+
+from datetime import datetime, timezone
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from typing import Any
+
+import import_archives
+
+from import_archives import (
+    BatchWriter,
+    Checkpoint,
+    dechunk,
+    import_archive,
+    iter_warc_records,
+    iter_warc_responses,
+    page_from_har,
+    page_from_warc,
+)
+from scrdbcaching.backends import CacheBackend
+
+
+HTML: bytes = "<html><body>café</body></html>".encode("utf-8")
+
+
+def warc_record(warc_type: str, url: str, block: bytes, content_type: str) -> bytes:
+    return (
+        b"WARC/1.0\r\n"
+        + f"WARC-Type: {warc_type}\r\n".encode()
+        + f"WARC-Target-URI: {url}\r\n".encode()
+        + b"WARC-Date: 2026-09-01T12:00:00Z\r\n"
+        + f"Content-Type: {content_type}\r\n".encode()
+        + f"Content-Length: {len(block)}\r\n".encode()
+        + b"\r\n"
+        + block
+        + b"\r\n\r\n"
+    )
+
+
+def http_response(
+    body: bytes = HTML,
+    status_line: bytes = b"HTTP/1.1 200 OK",
+    headers: list[bytes] | None = None,
+) -> bytes:
+    return b"\r\n".join(
+        [status_line, b"Content-Type: text/html; charset=utf-8", *(headers or list())]
+    ) + b"\r\n\r\n" + body
+
+
+def response_record(url: str, block: bytes) -> bytes:
+    return warc_record("response", url, block, "application/http; msgtype=response")
+
+
+# A WARC file with one record of each kind that has to be dealt with.
+def write_warc(path: Any, compress: bool = False) -> None:
+    records: list[bytes] = [
+        warc_record("warcinfo", "", b"software: test\r\n", "application/warc-fields"),
+        warc_record(
+            "request",
+            "https://example.com/a",
+            b"GET /a HTTP/1.1\r\n\r\n",
+            "application/http; msgtype=request",
+        ),
+        response_record("https://example.com/a", http_response()),
+        response_record(
+            "https://example.com/chunked",
+            http_response(
+                b"%x\r\n%s\r\n0\r\n\r\n" % (len(gzip.compress(HTML)), gzip.compress(HTML)),
+                headers=[b"Transfer-Encoding: chunked", b"Content-Encoding: gzip"],
+            ),
+        ),
+        response_record(
+            "https://example.com/bad-status", http_response(status_line=b"HTTP/1.1")
+        ),
+        response_record(
+            "https://example.com/bad-date", http_response(headers=[b"Date: not a date"])
+        ),
+        response_record(
+            "https://example.com/image.png",
+            http_response(b"\x89PNG").replace(b"text/html; charset=utf-8", b"image/png"),
+        ),
+        response_record("https://example.com/a", http_response(b"<html>second</html>")),
+    ]
+    data: bytes = b"".join(records)
+    if compress:
+        # One gzip member per record, as crawlers write them.
+        data = b"".join(gzip.compress(record) for record in records)
+    path.write_bytes(data)
+
+
+def make_args(**overrides: Any) -> argparse.Namespace:
+    return argparse.Namespace(
+        **{
+            "format": "auto",
+            "batch_rows": 2,
+            "replace": False,
+            "content_types": (b"text/html", b"application/xhtml+xml"),
+            "body_codec": "text",
+            "compression_level": -1,
+            "headers_format": "json",
+            **overrides,
+        }
+    )
+
+
+def run_import(
+    path: Any,
+    backend: CacheBackend,
+    checkpoint: Checkpoint | None = None,
+    **overrides: Any,
+) -> tuple[int, int, BatchWriter]:
+    args: argparse.Namespace = make_args(**overrides)
+    writer: BatchWriter = BatchWriter(
+        backend, "replace" if args.replace else "ignore", None
+    )
+    count, malformed = import_archive(
+        str(path), args, writer, checkpoint or Checkpoint(None), logging.getLogger("test")
+    )
+    return count, malformed, writer
+
+
+def test_dechunk() -> None:
+    assert dechunk(b"4\r\nWiki\r\n5;ext=1\r\npedia\r\n0\r\n\r\n") == b"Wikipedia"
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_iter_warc_records(tmp_path: Any, compress: bool) -> None:
+    path = tmp_path / ("test.warc.gz" if compress else "test.warc")
+    write_warc(path, compress)
+    with import_archives.open_archive(str(path)) as fh:
+        records: list = list(iter_warc_records(fh))
+    assert [headers["warc-type"] for _, headers, _ in records] == [
+        "warcinfo", "request", *(["response"] * 6)
+    ]
+    assert [number for number, _, _ in records] == list(range(8))
+    with import_archives.open_archive(str(path)) as fh:
+        assert [number for number, _ in iter_warc_responses(fh, skip=4)] == [4, 5, 6, 7]
+
+
+def test_page_from_warc(tmp_path: Any) -> None:
+    path = tmp_path / "test.warc"
+    write_warc(path)
+    with open(path, "rb") as fh:
+        records: list = [record for _, record in iter_warc_responses(fh)]
+    page = page_from_warc(records[1])
+    assert page.url == "https://example.com/chunked"
+    assert page.status == 200
+    assert page.body == HTML
+    assert page.date == datetime(2026, 9, 1, 12, tzinfo=timezone.utc)
+    # The headers describing the body as it was sent are dropped.
+    assert [name for name, _ in page.headers] == [b"Content-Type"]
+    with pytest.raises(IndexError):
+        page_from_warc(records[2])
+
+
+def test_page_from_har() -> None:
+    page = page_from_har(
+        {
+            "startedDateTime": "2026-09-01T12:00:00.000Z",
+            "request": {"url": "https://example.com/"},
+            "response": {
+                "status": 200,
+                "headers": [
+                    {"name": ":status", "value": "200"},
+                    {"name": "Content-Encoding", "value": "br"},
+                    {"name": "Server", "value": "nginx"},
+                ],
+                "content": {"mimeType": "text/html", "text": "<html>é</html>"},
+            },
+        }
+    )
+    assert page.body == "<html>é</html>".encode("utf-8")
+    assert page.encoding == "utf-8"
+    assert page.headers == [(b"Server", b"nginx"), (b"Content-Type", b"text/html")]
+    assert page.date == datetime(2026, 9, 1, 12, tzinfo=timezone.utc)
+    assert page_from_har({"request": {"url": "x"}, "response": {"status": 204}}) is None
+
+
+# Malformed records are skipped and counted, and the rest are imported, the
+# first page for a URL winning.
+@pytest.mark.parametrize("compress", [False, True])
+def test_import_warc(tmp_path: Any, backend: CacheBackend, compress: bool) -> None:
+    path = tmp_path / ("test.warc.gz" if compress else "test.warc")
+    write_warc(path, compress)
+    count, malformed, writer = run_import(path, backend)
+    assert (count, malformed) == (3, 2)
+    assert writer.stored == 2 and writer.duplicates == 1
+    assert backend.get("https://example.com/a")["body"] == HTML.decode("utf-8")
+    assert backend.get("https://example.com/chunked")["body"] == HTML.decode("utf-8")
+    assert backend.get("https://example.com/bad-date") is None
+    assert backend.get("https://example.com/image.png") is None
+
+
+# With --replace, the last page for a URL wins, whether it's in the same batch
+# as the first one or a later one.
+@pytest.mark.parametrize("batch_rows", [1, 100])
+def test_import_warc_replace(tmp_path: Any, backend: CacheBackend, batch_rows: int) -> None:
+    path = tmp_path / "test.warc"
+    write_warc(path)
+    run_import(path, backend, replace=True, batch_rows=batch_rows)
+    assert backend.get("https://example.com/a")["body"] == "<html>second</html>"
+
+
+def test_import_har(tmp_path: Any, backend: CacheBackend) -> None:
+    entries: list[dict] = [
+        {
+            "request": {"url": f"https://example.com/{i}"},
+            "response": {
+                "status": 200,
+                "headers": [{"name": "Content-Type", "value": "text/html; charset=utf-8"}],
+                "content": {"text": base64.b64encode(HTML).decode(), "encoding": "base64"},
+            },
+        }
+        for i in range(3)
+    ]
+    entries.insert(
+        1,
+        {
+            "request": {"url": "https://example.com/bad"},
+            "response": {"status": "OK", "content": {"text": ""}},
+        },
+    )
+    path = tmp_path / "test.har"
+    path.write_text(json.dumps({"log": {"entries": entries}}))
+    count, malformed, writer = run_import(path, backend)
+    assert (count, malformed) == (3, 1)
+    assert backend.count() == 3
+    assert backend.get("https://example.com/2")["body"] == HTML.decode("utf-8")
+
+
+# A resumed import passes over the records it's already dealt with without
+# decoding them.
+def test_resume(tmp_path: Any, backend: CacheBackend, monkeypatch) -> None:
+    path = tmp_path / "test.warc"
+    write_warc(path)
+    checkpoint: Checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    checkpoint.save(str(path), 4)
+
+    decoded: list[str] = list()
+
+    def recording_page_from_warc(record: tuple) -> Any:
+        decoded.append(record[0]["warc-target-uri"])
+        return page_from_warc(record)
+
+    monkeypatch.setattr(import_archives, "page_from_warc", recording_page_from_warc)
+    count, malformed, _ = run_import(path, backend, Checkpoint(checkpoint.path))
+    assert decoded == [
+        "https://example.com/bad-status",
+        "https://example.com/bad-date",
+        "https://example.com/image.png",
+        "https://example.com/a",
+    ]
+    assert (count, malformed) == (1, 2)
+    assert Checkpoint(checkpoint.path).position(str(path)) == (8, True)
+    assert run_import(path, backend, Checkpoint(checkpoint.path))[:2] == (0, 0)
+
+
+# A checkpointed import's batches have to be on disk before the checkpoint
+# says they are, so its bulk load syncs every commit; any other load doesn't.
+@pytest.mark.parametrize("durable, synchronous", [(False, 0), (True, 2)])
+def test_bulk_load_durability(backend: CacheBackend, durable: bool, synchronous: int) -> None:
+    with backend.bulk_load(durable=durable):
+        assert backend._connection().execute("PRAGMA synchronous;").fetchone()[0] == synchronous
+    assert backend._connection().execute("PRAGMA synchronous;").fetchone()[0] == 1
+
+
+# Records the rows written to it, keyed by URL as the url column is.
+class UrlKeyedBackend:
+    url_hash_key: bool = False
+
+    def __init__(self) -> None:
+        self.rows: list[dict[str, Any]] = list()
+        self.closed: bool = False
+
+    def key_for(self, url: str) -> str:
+        return url
+
+    def put_many(self, rows: list[dict[str, Any]], on_existing: str) -> None:
+        self.rows.extend(rows)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+# The url column's collation is case-insensitive, so URLs that differ only in
+# case are the same URL to it, and to the writer.
+@pytest.mark.parametrize("on_existing", ["ignore", "replace"])
+def test_urls_differing_in_case_are_duplicates(on_existing: str) -> None:
+    backend: UrlKeyedBackend = UrlKeyedBackend()
+    writer: BatchWriter = BatchWriter(backend, on_existing, None)  # type: ignore[arg-type]
+    writer.write([{"url": "https://example.com/Page"}, {"url": "https://example.com/page"}])
+    writer.write([{"url": "https://EXAMPLE.com/PAGE"}])
+    assert len(backend.rows) == (1 if on_existing == "ignore" else 2)
+    assert writer.duplicates == (2 if on_existing == "ignore" else 1)
+
+
+# Unique key checks can only be left to the import if rows are keyed by
+# url_hash.
+def test_defer_unique_checks_needs_url_hash(monkeypatch) -> None:
+    backend: UrlKeyedBackend = UrlKeyedBackend()
+    monkeypatch.setattr(
+        "sys.argv", ["import_archives.py", "--defer-unique-checks", "test.warc"]
+    )
+    monkeypatch.setattr(import_archives, "set_up_logging", logging.getLogger)
+    monkeypatch.setattr(import_archives, "settings_from_env", Settings)
+    monkeypatch.setattr(import_archives, "load_backend", lambda *args: backend)
+    with pytest.raises(SystemExit, match="DBCACHE_URL_HASH_KEY"):
+        import_archives.main()
+    assert backend.closed
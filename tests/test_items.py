@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import json
+import pytest
+
+from datetime import datetime, timedelta, timezone
+from scrapy.http import Request  # type: ignore[import-untyped]
+from scrapy.utils.serialize import ScrapyJSONEncoder  # type: ignore[import-untyped]
+
+from scrdbcaching import SerializableItem
+
+from .helpers import make_response
+
+
+HEADERS: dict[str, str] = {
+    "Content-Type": "text/html; charset=utf-8",
+    "Date": "Wed, 14 Oct 2026 18:02:11 GMT",
+}
+BODY: str = "<html><body>café</body></html>"
+
+
+# Items go to feed exports as well as to the pipeline, so by default their
+# fields are strs that JSON can encode.
+def test_fields_are_strs_by_default() -> None:
+    item: SerializableItem = SerializableItem.from_htmlresponse(
+        make_response("https://example.com/", body=BODY, headers=HEADERS)
+    )
+    assert item["body"] == BODY
+    assert item["headers"]["Content-Type"] == ["text/html; charset=utf-8"]
+    exported: dict = json.loads(json.dumps(dict(item), cls=ScrapyJSONEncoder))
+    assert exported["body"] == BODY
+
+
+def test_keep_bytes() -> None:
+    item: SerializableItem = SerializableItem.from_htmlresponse(
+        make_response("https://example.com/", body=BODY, headers=HEADERS),
+        keep_bytes=True,
+    )
+    assert item["body"] == BODY.encode("utf-8")
+    assert item["headers"][b"Content-Type"] == [b"text/html; charset=utf-8"]
+
+
+# Whichever way the item was built, it's stored the same.
+@pytest.mark.parametrize("body_codec", ["text", "raw", "zlib"])
+@pytest.mark.parametrize("headers_format", ["json", "binary"])
+def test_to_dict_is_the_same_for_strs_and_bytes(
+    body_codec: str, headers_format: str
+) -> None:
+    response = make_response("https://example.com/", body=BODY, headers=HEADERS)
+    rows: list[dict] = [
+        SerializableItem.from_htmlresponse(response, keep_bytes=keep_bytes).to_dict(
+            body_codec, headers_format=headers_format
+        )
+        for keep_bytes in (False, True)
+    ]
+    assert rows[0] == rows[1]
+
+
+def test_date_from_header() -> None:
+    item: SerializableItem = SerializableItem.from_htmlresponse(
+        make_response("https://example.com/", headers=HEADERS)
+    )
+    assert item["date"] == datetime(2026, 10, 14, 18, 2, 11, tzinfo=timezone.utc)
+
+
+# Without a Date header, a response that came over the network is dated when
+# it arrived, and any other response isn't dated at all.
+def test_undated_responses() -> None:
+    request: Request = Request("https://example.com/")
+    fetched: SerializableItem = SerializableItem.from_htmlresponse(
+        make_response("https://example.com/", request=request)
+    )
+    assert datetime.now(timezone.utc) - fetched["date"] < timedelta(minutes=1)
+
+    assert SerializableItem.from_htmlresponse(
+        make_response("https://example.com/")
+    )["date"] is None
+
+    request.meta["dbcache_served"] = True
+    served: SerializableItem = SerializableItem.from_htmlresponse(
+        make_response("https://example.com/", request=request)
+    )
+    assert served["date"] is None
+    assert served["from_cache"]
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+import pytest
+import sqlite3
+
+from scrapy.http import Request  # type: ignore[import-untyped]
+from twisted.internet.defer import DeferredList
+
+from scrdbcaching.backends import CacheBackend
+
+from .helpers import make_row, wait_for
+
+
+URLS: list[str] = [f"https://example.com/{i}" for i in range(10)]
+
+
+def test_get_many(backend: CacheBackend) -> None:
+    backend.put_many([make_row(url) for url in URLS[:5]])
+    rows: dict = backend.get_many(URLS)
+    assert set(rows) == set(URLS[:5])
+    assert all(rows[url]["url"] == url for url in rows)
+
+
+# Each of several equivalent URLs asked for gets the row they share.
+def test_get_many_equivalent_urls(backend: CacheBackend) -> None:
+    backend.put_many([make_row("https://example.com/a?x=1&y=2")])
+    rows: dict = backend.get_many(
+        ["https://example.com/a?x=1&y=2", "https://example.com/a?y=2&x=1"]
+    )
+    assert len(rows) == 2
+    assert {row["url"] for row in rows.values()} == {"https://example.com/a?x=1&y=2"}
+
+
+def test_get_many_nothing_stored(backend: CacheBackend) -> None:
+    assert backend.get_many(URLS) == dict()
+
+
+def test_put_many_on_existing(backend: CacheBackend) -> None:
+    backend.put_many([make_row(URLS[0], body="first")])
+    with pytest.raises(sqlite3.IntegrityError):
+        backend.put_many([make_row(URLS[0], body="second")])
+    backend.put_many([make_row(URLS[0], body="second")], on_existing="ignore")
+    assert backend.get(URLS[0])["body"] == "first"
+    backend.put_many([make_row(URLS[0], body="second")], on_existing="replace")
+    assert backend.get(URLS[0])["body"] == "second"
+
+
+# Lookups that arrive together go to the database as one query, and each
+# request gets its own answer back.
+def test_batched_lookups(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([make_row(url) for url in URLS[:5]])
+    middleware, spider = make_middleware(DBCACHE_BATCH_SIZE=len(URLS))
+    results: list = wait_for(
+        DeferredList(
+            [middleware.process_request(Request(url), spider) for url in URLS],
+            fireOnOneErrback=True,
+        )
+    )
+    responses: list = [response for _, response in results]
+    assert [response.url for response in responses[:5]] == URLS[:5]
+    assert responses[5:] == [None] * 5
+    assert spider.crawler.stats.get_value("dbcache/query/count") == 1
+    assert spider.crawler.stats.get_value("dbcache/hits") == 5
+    assert spider.crawler.stats.get_value("dbcache/misses") == 5
+
+
+# A batch that isn't full goes out once its window has passed.
+def test_batch_window(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([make_row(URLS[0])])
+    middleware, spider = make_middleware(
+        DBCACHE_BATCH_SIZE=100, DBCACHE_BATCH_WINDOW=0.05
+    )
+    response = wait_for(middleware.process_request(Request(URLS[0]), spider))
+    assert response.url == URLS[0]
+
+
+def test_async_lookups(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([make_row(URLS[0])])
+    middleware, spider = make_middleware(DBCACHE_ASYNC_LOOKUPS=True)
+    assert wait_for(middleware.process_request(Request(URLS[0]), spider)).url == URLS[0]
+    assert wait_for(middleware.process_request(Request(URLS[1]), spider)) is None
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+from scrapy.http import Request  # type: ignore[import-untyped]
+
+from scrdbcaching.backends import CacheBackend
+from scrdbcaching.memcache import LruRowCache
+
+from .helpers import make_row
+
+
+def row(size: int) -> dict:
+    return {"url": "", "body": "x" * size}
+
+
+def test_evicts_least_recently_used() -> None:
+    cache: LruRowCache = LruRowCache(300)
+    for url in ("a", "b", "c"):
+        assert cache.put(url, row(100))
+    assert cache.get("a") is not None
+    cache.put("d", row(100))
+    assert "b" not in cache
+    assert {"a", "c", "d"} <= set(cache.rows)
+    assert cache.current_bytes == 300
+    assert cache.stats()["evictions"] == 1
+
+
+def test_refuses_rows_that_are_too_large() -> None:
+    cache: LruRowCache = LruRowCache(1000, max_entry_bytes=100)
+    assert not cache.put("a", row(101))
+    assert cache.put("b", row(100))
+    assert not LruRowCache(50).put("c", row(51))
+    assert len(cache) == 1
+
+
+def test_replacing_a_row_keeps_the_size_right() -> None:
+    cache: LruRowCache = LruRowCache(1000)
+    cache.put("a", row(100))
+    cache.put("a", row(200))
+    assert len(cache) == 1
+    assert cache.current_bytes == 200
+    cache.discard("a")
+    assert cache.current_bytes == 0
+    cache.discard("a")
+
+
+def test_stats() -> None:
+    cache: LruRowCache = LruRowCache(1000)
+    cache.put("a", row(10))
+    cache.get("a")
+    cache.get("b")
+    assert cache.stats() == {
+        "hits": 1, "misses": 1, "evictions": 0, "entries": 1, "bytes": 10
+    }
+    cache.clear()
+    assert len(cache) == 0 and cache.current_bytes == 0
+
+
+# A URL looked up once is served from memory after that.
+def test_middleware_memory_cache(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([make_row("https://example.com/a")])
+    middleware, spider = make_middleware(DBCACHE_MEMORY_CACHE_BYTES=1024 * 1024)
+    for _ in range(3):
+        response = middleware.process_request(Request("https://example.com/a"), spider)
+        assert response.status == 200
+    assert spider.crawler.stats.get_value("dbcache/memory_hits") == 2
+    assert spider.crawler.stats.get_value("dbcache/hits") == 3
+    assert spider.crawler.stats.get_value("dbcache/query/count") == 1
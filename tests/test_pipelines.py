@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+import threading
+import time
+
+from scrapy.http import Request  # type: ignore[import-untyped]
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import deferLater
+
+from scrdbcaching import SerializableItem, SerializingDatabasePipeline, UrlSetSpider
+from scrdbcaching.backends import CacheBackend
+
+from .helpers import make_response, wait_for
+
+
+# The reactor is installed by conftest.pytest_configure() before this module
+# is imported.
+
+
+def make_item(url: str, body: str = "<html>page</html>") -> SerializableItem:
+    return SerializableItem.from_htmlresponse(
+        make_response(url, body=body, request=Request(url))
+    )
+
+
+def open_pipeline(spider: UrlSetSpider) -> SerializingDatabasePipeline:
+    pipeline: SerializingDatabasePipeline = SerializingDatabasePipeline()
+    pipeline.open_spider(spider)
+    return pipeline
+
+
+def test_items_are_stored(backend: CacheBackend, make_spider) -> None:
+    spider: UrlSetSpider = make_spider()
+    pipeline: SerializingDatabasePipeline = open_pipeline(spider)
+    pipeline.process_item(make_item("https://example.com/a"), spider)
+    served: SerializableItem = make_item("https://example.com/b")
+    served["from_cache"] = True
+    pipeline.process_item(served, spider)
+    assert pipeline.close_spider(spider) is None
+    assert backend.get("https://example.com/a")["body"] == "<html>page</html>"
+    assert backend.get("https://example.com/b") is None
+    assert spider.crawler.stats.get_value("dbcache/items_skipped") == 1
+
+
+def test_buffered_items_are_flushed_at_close(backend: CacheBackend, make_spider) -> None:
+    spider: UrlSetSpider = make_spider(DBCACHE_INSERT_BATCH_ROWS=3)
+    pipeline: SerializingDatabasePipeline = open_pipeline(spider)
+    for i in range(5):
+        pipeline.process_item(make_item(f"https://example.com/{i}"), spider)
+    assert backend.count() == 3
+    pipeline.close_spider(spider)
+    assert backend.count() == 5
+
+
+# An exception that gets out of a timed flush doesn't stop the flush loop.
+def test_flush_loop_survives_exceptions(make_spider, monkeypatch) -> None:
+    calls: list[int] = list()
+    flush_buffer = SerializingDatabasePipeline._flush_buffer
+
+    def failing_flush_buffer(self: SerializingDatabasePipeline) -> bool:
+        calls.append(len(self.insert_buffer))
+        if len(calls) == 1:
+            raise OSError("spill file unwritable")
+        return flush_buffer(self)
+
+    monkeypatch.setattr(SerializingDatabasePipeline, "_flush_buffer", failing_flush_buffer)
+    spider: UrlSetSpider = make_spider(
+        DBCACHE_INSERT_BATCH_ROWS=100, DBCACHE_INSERT_BATCH_INTERVAL=0.05
+    )
+    pipeline: SerializingDatabasePipeline = open_pipeline(spider)
+    pipeline.process_item(make_item("https://example.com/a"), spider)
+    wait_for(deferLater(reactor, 0.3, lambda: None))
+    assert len(calls) >= 2
+    assert pipeline.flush_loop.running
+    assert pipeline.insert_buffer == list()
+    pipeline.close_spider(spider)
+
+
+# With the reactor running, a full buffer is flushed on the insert thread, and
+# process_item() returns without waiting for it.
+def test_flushes_are_made_off_the_reactor(
+    backend: CacheBackend, make_spider, monkeypatch
+) -> None:
+    spider: UrlSetSpider = make_spider(DBCACHE_INSERT_BATCH_ROWS=2)
+    pipeline: SerializingDatabasePipeline = open_pipeline(spider)
+    insert_rows = pipeline._insert_rows
+    threads: list[int] = list()
+
+    def recording_insert_rows(rows: list) -> None:
+        threads.append(threading.get_ident())
+        insert_rows(rows)
+
+    monkeypatch.setattr(pipeline, "_insert_rows", recording_insert_rows)
+    monkeypatch.setattr(reactor, "running", True)
+    for i in range(2):
+        pipeline.process_item(make_item(f"https://example.com/{i}"), spider)
+    assert isinstance(pipeline.flushing, Deferred)
+    assert wait_for(pipeline.flushing) is True
+    assert backend.count() == 2
+    assert threads and threading.get_ident() not in threads
+    wait_for(pipeline.close_spider(spider))
+
+
+# A failed flush puts its rows back in the buffer, and no flush is made again
+# until the backoff is over.
+def test_failed_flush_backs_off(backend: CacheBackend, make_spider, monkeypatch) -> None:
+    spider: UrlSetSpider = make_spider(DBCACHE_INSERT_BATCH_ROWS=1)
+    pipeline: SerializingDatabasePipeline = open_pipeline(spider)
+    insert_rows = pipeline._insert_rows
+    calls: list[int] = list()
+
+    def flaky_insert_rows(rows: list) -> None:
+        calls.append(len(rows))
+        if len(calls) == 1:
+            raise RuntimeError("lost connection")
+        insert_rows(rows)
+
+    monkeypatch.setattr(pipeline, "_insert_rows", flaky_insert_rows)
+    monkeypatch.setattr(reactor, "running", True)
+    pipeline.process_item(make_item("https://example.com/a"), spider)
+    assert wait_for(pipeline.flushing) is False
+    assert len(pipeline.insert_buffer) == 1
+    assert pipeline.insert_retry_at - time.monotonic() > 1
+    pipeline.process_item(make_item("https://example.com/b"), spider)
+    assert pipeline.flushing is None
+    assert calls == [1]
+
+    # Once the backoff is over, the next flush writes both rows.
+    pipeline.insert_retry_at = 0.0
+    assert wait_for(pipeline._flush_buffer()) is True
+    assert calls == [1, 2]
+    assert backend.count() == 2
+    wait_for(pipeline.close_spider(spider))
+
+
+# A failed final flush is retried on the reactor's clock rather than by
+# sleeping, and the backend is closed once it succeeds.
+def test_final_flush_is_retried_without_blocking(
+    backend: CacheBackend, make_spider, monkeypatch
+) -> None:
+    spider: UrlSetSpider = make_spider(DBCACHE_INSERT_BATCH_ROWS=100)
+    pipeline: SerializingDatabasePipeline = open_pipeline(spider)
+    pipeline.process_item(make_item("https://example.com/a"), spider)
+    insert_rows = pipeline._insert_rows
+    failures: list[int] = [1]
+
+    def flaky_insert_rows(rows: list) -> None:
+        if failures:
+            failures.pop()
+            raise RuntimeError("lost connection")
+        insert_rows(rows)
+
+    monkeypatch.setattr(pipeline, "_insert_rows", flaky_insert_rows)
+    monkeypatch.setattr(reactor, "running", True)
+    closed: Deferred = pipeline.close_spider(spider)
+    assert isinstance(closed, Deferred)
+    assert backend.count() == 0
+    wait_for(closed, timeout=10)
+    assert backend.count() == 1
+    assert pipeline.insert_threadpool is None
+    assert pipeline.backend.connections == list()
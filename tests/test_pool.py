@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import pytest
+
+pytest.importorskip("mysql.connector")
+
+from scrdbcaching.backends import pool  # noqa: E402
+from scrdbcaching.backends.pool import ConnectionPool, PooledConnection  # noqa: E402
+
+
+# Stands in for a MySQL connection, so the pool can be tested without a server.
+class FakeConnection:
+    unread_result: bool = False
+    in_transaction: bool = False
+
+    def __init__(self, **kwargs) -> None:
+        self.closed = False
+
+    def ping(self, reconnect: bool = False) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def connection_pool(monkeypatch) -> ConnectionPool:
+    monkeypatch.setattr(pool, "connect", FakeConnection)
+    return ConnectionPool("test", 2, dict(host="localhost"), timeout=0.1)
+
+
+def test_connections_are_reused(connection_pool: ConnectionPool) -> None:
+    pooled: PooledConnection = connection_pool.checkout()
+    connection_pool.checkin(pooled)
+    assert connection_pool.checkout() is pooled
+    assert connection_pool.opened == 1
+
+
+def test_broken_connections_are_closed(connection_pool: ConnectionPool) -> None:
+    pooled: PooledConnection = connection_pool.checkout()
+    connection_pool.checkin(pooled, broken=True)
+    assert pooled.conn.closed
+    assert connection_pool.opened == 0
+
+
+# A connection still checked out when the last user releases the pool is
+# closed when it comes back, rather than left open in a pool nobody uses.
+def test_checkin_after_release(connection_pool: ConnectionPool) -> None:
+    idle: PooledConnection = connection_pool.checkout()
+    busy: PooledConnection = connection_pool.checkout()
+    connection_pool.checkin(idle)
+    connection_pool.release()
+    assert connection_pool.closed
+    assert idle.conn.closed
+    assert not busy.conn.closed
+    connection_pool.checkin(busy)
+    assert busy.conn.closed
+    assert connection_pool.idle.empty()
+    assert connection_pool.opened == 0
+
+
+def test_pool_stays_open_while_shared(connection_pool: ConnectionPool) -> None:
+    connection_pool.users += 1
+    pooled: PooledConnection = connection_pool.checkout()
+    connection_pool.release()
+    connection_pool.checkin(pooled)
+    assert not connection_pool.closed
+    assert not pooled.conn.closed
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+from scrapy.downloadermiddlewares.redirect import RedirectMiddleware  # type: ignore[import-untyped]
+from scrapy.http import Request  # type: ignore[import-untyped]
+
+from scrdbcaching import SerializableItem
+from scrdbcaching.backends import CacheBackend
+
+from .helpers import make_response, make_row
+
+
+OLD_URL: str = "https://example.com/old"
+NEW_URL: str = "https://example.com/new"
+
+
+# A permanent redirect served from the cache leads to a page that isn't
+# cached. The redirected request inherits the 301's meta, but has to be
+# fetched, captured and stored like any other.
+def test_redirect_from_cache_to_uncached_page(
+    backend: CacheBackend, make_middleware
+) -> None:
+    backend.put_many([make_row(OLD_URL, 301, "", headers={"Location": NEW_URL})])
+    middleware, spider = make_middleware(
+        DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0
+    )
+    redirect_middleware = RedirectMiddleware.from_crawler(spider.crawler)
+
+    request: Request = Request(OLD_URL)
+    cached = middleware.process_request(request, spider)
+    assert cached.status == 301
+    assert request.meta["dbcache_served"]
+
+    redirected: Request = redirect_middleware.process_response(request, cached)
+    assert redirected.url == NEW_URL
+    assert middleware.process_request(redirected, spider) is None
+    assert "dbcache_served" not in redirected.meta
+
+    response = middleware.process_response(
+        redirected, make_response(NEW_URL, request=redirected), spider
+    )
+    assert redirected.meta["dbcache_stored"]
+    assert SerializableItem.from_htmlresponse(response)["from_cache"]
+    middleware.on_spider_closed(spider, "finished")
+
+    assert backend.get(NEW_URL)["status"] == 200
+    assert spider.crawler.stats.get_value("dbcache/misses") == 1
+    assert spider.crawler.stats.get_value("dbcache/responses_captured") == 1
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+import weakref
+
+from scrapy.http import HtmlResponse  # type: ignore[import-untyped]
+from scrapy.settings import Settings  # type: ignore[import-untyped]
+from typing import Any, Iterator
+
+from scrdbcaching import SerializableItem, UrlSetSpider
+from scrdbcaching.backends import CacheBackend
+from scrdbcaching.replay import ReplayEngine, make_replay_spider
+
+from .helpers import make_row
+
+
+# Stores a summary of every page it's given under a URL of its own, so that
+# replaying it has something for the pipeline to store.
+class SummarySpider(UrlSetSpider):
+    name = "summary"
+
+    def parse(self, response: HtmlResponse) -> Iterator[SerializableItem]:
+        item: SerializableItem = SerializableItem.from_htmlresponse(response)
+        item["url"] = f"{response.url}?summary=1"
+        item["from_cache"] = False
+        yield item
+
+
+# backends.pool.shared_pool() keys the pools it shares by a weak reference to
+# the crawler.
+def test_replay_crawler_can_be_weakly_referenced(settings: Settings) -> None:
+    spider: UrlSetSpider = make_replay_spider(SummarySpider, settings, dict())
+    assert weakref.ref(spider.crawler)() is spider.crawler
+    assert spider.crawler.spider is spider
+
+
+def test_replay_through_pipeline(settings: Settings, backend: CacheBackend) -> None:
+    urls: list[str] = [f"https://example.com/{i}" for i in range(5)]
+    backend.put_many([make_row(url) for url in urls])
+    settings.set(
+        "ITEM_PIPELINES", {"scrdbcaching.SerializingDatabasePipeline": 300}
+    )
+    engine: ReplayEngine = ReplayEngine(SummarySpider, settings, backend, batch_size=2)
+    stats: dict[str, Any] = engine.run(backend.iter_range())
+
+    assert stats["replay/rows"] == 5
+    assert stats["replay/items"] == 5
+    assert engine.spider.crawler.stats.get_value("dbcache/items_stored") == 5
+    for url in urls:
+        assert backend.get(f"{url}?summary=1") is not None
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import pytest
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+from scrapy.http import Request, Response  # type: ignore[import-untyped]
+
+from scrdbcaching.backends import CacheBackend
+
+from .helpers import make_response, make_row, wait_for
+
+
+URL: str = "https://example.com/page"
+ETAG: str = 'W/"5f3a"'
+HOUR: timedelta = timedelta(hours=1)
+
+
+def store(backend: CacheBackend, age: timedelta, status: int = 200) -> datetime:
+    date: datetime = datetime.now(timezone.utc) - age
+    backend.put_many(
+        [make_row(URL, status, body="stored", headers={"ETag": ETAG}, date=date)]
+    )
+    return date
+
+
+def test_fresh_row_is_served(backend: CacheBackend, make_middleware) -> None:
+    store(backend, timedelta(minutes=30))
+    middleware, spider = make_middleware(DBCACHE_TTL=3600)
+    assert middleware.process_request(Request(URL), spider).text == "stored"
+    assert spider.crawler.stats.get_value("dbcache/hits") == 1
+
+
+def test_rows_never_go_stale_without_ttl(backend: CacheBackend, make_middleware) -> None:
+    store(backend, timedelta(days=3650))
+    middleware, spider = make_middleware()
+    assert middleware.process_request(Request(URL), spider) is not None
+
+
+# A stale row is a miss, and the request is made conditional on the page
+# having changed since the row was stored.
+def test_stale_row_is_revalidated(backend: CacheBackend, make_middleware) -> None:
+    date: datetime = store(backend, 2 * HOUR)
+    middleware, spider = make_middleware(DBCACHE_TTL=3600)
+    request: Request = Request(URL)
+    assert middleware.process_request(request, spider) is None
+    assert spider.crawler.stats.get_value("dbcache/stale") == 1
+    assert spider.crawler.stats.get_value("dbcache/misses") == 1
+    assert request.headers[b"If-None-Match"] == ETAG.encode()
+    assert request.headers[b"If-Modified-Since"] == date.strftime(
+        "%a, %d %b %Y %H:%M:%S GMT"
+    ).encode()
+    assert request.meta["dbcache_stale_row"]["body"] == "stored"
+
+
+def test_stale_row_without_revalidation(backend: CacheBackend, make_middleware) -> None:
+    store(backend, 2 * HOUR)
+    middleware, spider = make_middleware(DBCACHE_TTL=3600, DBCACHE_REVALIDATE=False)
+    request: Request = Request(URL)
+    assert middleware.process_request(request, spider) is None
+    assert b"If-Modified-Since" not in request.headers
+    assert "dbcache_stale_row" not in request.meta
+
+
+# A 304 Not Modified serves the stored row in its place, and brings the row's
+# date up to now.
+def test_not_modified_serves_stored_row(backend: CacheBackend, make_middleware) -> None:
+    store(backend, 2 * HOUR)
+    middleware, spider = make_middleware(DBCACHE_TTL=3600)
+    request: Request = Request(URL)
+    middleware.process_request(request, spider)
+    response = middleware.process_response(
+        request, Response(URL, status=304, request=request), spider
+    )
+    assert response.status == 200
+    assert response.text == "stored"
+    assert request.meta["dbcache_served"]
+    assert spider.crawler.stats.get_value("dbcache/revalidated") == 1
+    assert spider.crawler.stats.get_value("dbcache/hits") == 1
+    assert datetime.now(timezone.utc) - backend.get(URL)["date"] < timedelta(minutes=1)
+
+    # The row is fresh again.
+    assert middleware.process_request(Request(URL), spider).text == "stored"
+
+
+# The stored row is still served if its date can't be refreshed, whether the
+# refresh is made on the lookup threadpool or not.
+@pytest.mark.parametrize("async_lookups", [False, True])
+def test_failed_touch_still_serves_row(
+    backend: CacheBackend, make_middleware, async_lookups: bool
+) -> None:
+    store(backend, 2 * HOUR)
+    middleware, spider = make_middleware(
+        DBCACHE_TTL=3600, DBCACHE_ASYNC_LOOKUPS=async_lookups
+    )
+
+    def touch(url: str, date: datetime) -> None:
+        raise sqlite3.OperationalError("database is locked")
+
+    middleware.backend.touch = touch
+    request: Request = Request(URL)
+    wait_for(middleware.process_request(request, spider))
+    response = wait_for(
+        middleware.process_response(
+            request, Response(URL, status=304, request=request), spider
+        )
+    )
+    assert response.text == "stored"
+    assert spider.crawler.stats.get_value("dbcache/touch_errors") == 1
+    assert spider.crawler.stats.get_value("dbcache/hits") == 1
+
+
+# A page that has changed comes back as it is, and replaces the stale row if
+# responses are being captured.
+def test_changed_page_replaces_stale_row(backend: CacheBackend, make_middleware) -> None:
+    store(backend, 2 * HOUR)
+    middleware, spider = make_middleware(
+        DBCACHE_TTL=3600, DBCACHE_CAPTURE_RESPONSES=True, DBCACHE_CAPTURE_INTERVAL=0
+    )
+    request: Request = Request(URL)
+    middleware.process_request(request, spider)
+    response = middleware.process_response(
+        request, make_response(URL, body="changed", request=request), spider
+    )
+    assert response.text == "changed"
+    middleware.on_spider_closed(spider, "finished")
+    assert backend.get(URL)["body"] == "changed"
+
+
+# The stale row is dropped from the in-memory row cache when it's found to be
+# stale, and the page fetched in its place goes in instead.
+def test_memory_cache_is_refreshed(backend: CacheBackend, make_middleware) -> None:
+    store(backend, 2 * HOUR)
+    middleware, spider = make_middleware(
+        DBCACHE_TTL=3600,
+        DBCACHE_MEMORY_CACHE_BYTES=1024 * 1024,
+        DBCACHE_CAPTURE_RESPONSES=True,
+        DBCACHE_CAPTURE_INTERVAL=0,
+    )
+    request: Request = Request(URL)
+    assert middleware.process_request(request, spider) is None
+    assert URL not in middleware.memory_cache
+    middleware.process_response(
+        request, make_response(URL, body="changed", request=request), spider
+    )
+    assert middleware.process_request(Request(URL), spider).text == "changed"
+    assert spider.crawler.stats.get_value("dbcache/memory_hits") == 1
+
+
+# A row with no date can't be shown to be fresh.
+def test_undated_row_is_stale(backend: CacheBackend, make_middleware) -> None:
+    backend.put_many([dict(make_row(URL), date=None)])
+    middleware, spider = make_middleware(DBCACHE_TTL=3600)
+    request: Request = Request(URL)
+    assert middleware.process_request(request, spider) is None
+    assert b"If-Modified-Since" not in request.headers
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import sqlite3
+
+from scrdbcaching.backends import CacheBackend
+from scrdbcaching.utility import canonical_url, url_digest
+
+from .helpers import make_row
+
+
+def test_equivalent_urls_share_a_digest() -> None:
+    assert url_digest("https://example.com/a?x=1&y=2") == url_digest(
+        "https://example.com/a?y=2&x=1"
+    )
+    assert url_digest("https://example.com/a#top") == url_digest("https://example.com/a")
+    assert url_digest("https://example.com/caf%c3%a9") == url_digest(
+        "https://example.com/café"
+    )
+    assert len(url_digest("https://example.com/")) == 20
+
+
+def test_different_urls_have_different_digests() -> None:
+    assert url_digest("https://example.com/a") != url_digest("https://example.com/b")
+    assert url_digest("https://example.com/a?x=1") != url_digest("https://example.com/a?x=2")
+
+
+def test_canonical_url() -> None:
+    assert canonical_url("https://example.com/a?y=2&x=1#frag") == "https://example.com/a?x=1&y=2"
+
+
+# A URL is found under any equivalent form of it, but the row keeps the URL it
+# was stored under.
+def test_lookup_by_equivalent_url(backend: CacheBackend) -> None:
+    backend.put_many([make_row("https://example.com/a?x=1&y=2")])
+    row: dict = backend.get("https://example.com/a?y=2&x=1#section")
+    assert row["url"] == "https://example.com/a?x=1&y=2"
+    assert backend.key_for("https://example.com/a?y=2&x=1") in set(backend.iter_keys())
+
+
+# Equivalent URLs are one row, so storing one replaces the other.
+def test_equivalent_urls_share_a_row(backend: CacheBackend) -> None:
+    backend.put_many([make_row("https://example.com/a?x=1&y=2", body="first")])
+    backend.put_many(
+        [make_row("https://example.com/a?y=2&x=1", body="second")], on_existing="replace"
+    )
+    assert backend.count() == 1
+    assert backend.get("https://example.com/a?x=1&y=2")["body"] == "second"
+
+
+# A row whose url_hash matches but whose URL doesn't, as if the digests had
+# collided, is treated as a miss.
+def test_colliding_digest_is_a_miss(settings, backend: CacheBackend) -> None:
+    backend.put_many([make_row("https://example.com/a")])
+    conn: sqlite3.Connection = sqlite3.connect(settings["DBCACHE_SQLITE_PATH"])
+    conn.execute(
+        "UPDATE pages2 SET url = ? WHERE url_hash = ?;",
+        ("https://example.com/elsewhere", url_digest("https://example.com/a")),
+    )
+    conn.commit()
+    conn.close()
+    assert backend.get("https://example.com/a") is None
+    assert backend.get_many(["https://example.com/a"]) == dict()